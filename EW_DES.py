@@ -1,28 +1,43 @@
 import numpy as np 
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
 import simpy
-from dataclasses import dataclass, field
-from cycler import cycler
+from dataclasses import dataclass
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import sys
+import hashlib
+import json
+import itertools
+import csv
+from collections import deque
+from statistics import NormalDist
+from time import perf_counter
+import heapq
+import re
+import sqlite3
+import socketserver
+import threading
+import tempfile
+import copy
+import atexit
+
+# Bumped whenever a change to the engines changes the results, invalidates the result cache
+ENGINE_VERSION: int = 3
 
 class worksite():
     def __init__(self, env, *, epp, num_chargers: int = None, charging_power: int = 150, charging_threshold: float = 0.1,
                  num_wl: int = None, num_ex_b: int = None, num_ex_c: int = None, num_du: int = None,
                  workday: int = 9*3600, break_1: int = 2*3600, break_2: int = 5*3600, break_duration: int = 30*60,
-                 wl_config: dict = {}, ex_config: dict = {}, du_config: dict = {}) -> None:
+                 wl_config: dict = {}, ex_config: dict = {}, du_config: dict = {}, engine: str = "step", 
+                 productivity_target: float = None, resolution: int = 1, instrument: int = None, initial_state: dict = None, 
+                 other_machines: list[dict] = (), charging_policy: str = "fifo", grid_limit: float = None, base_load: float = 0) -> None:
         
         self.env: simpy.Environment = env
-        self.epp = epp
-        self.chargers = simpy.Resource(env, capacity=num_chargers)
+        self.epp: power_profile = epp if isinstance(epp, power_profile) else power_profile(epp)
+        self.engine: str = engine
         self.charging_power: float = charging_power/3600
         self.charging_threshold: float = charging_threshold
-        self.data: dict = {"battery_levels":[],
-                           "power":{},
-                           "inactive_machines":{}}
 
         # Workday
         self.workday: int = workday
@@ -30,152 +45,1389 @@ class worksite():
         self.break_2: int = break_2
         self.break_duration: int = break_duration
 
-        # Machines
-        self.wheel_loaders_battery = [Machine(env=env, id=f"WL #{i+1}", **wl_config) for i in range(num_wl)]
-        self.dumpers_battery = [Machine(env=env, id=f"DU #{i+1}", **du_config) for i in range(num_du)]
-        self.excavator_battery = [Machine(env=env, id=f"EX #{i+1}", **ex_config) for i in range(num_ex_b)]
-        self.excavator_cable = [Machine(env=env, id=f"EX_C #{i+1}", **ex_config) for i in range(num_ex_c)]
+        # Machines, other_machines adds kinds from machine_settings as {"prefix", "count", "profile", "config"} where 
+        # profile tells if they follow the power profile like the excavators or draw a constant power
+        self.kinds: list[MachineKind] = [MachineKind(EXCAVATOR, "EX", True), MachineKind(DUMPER, "DU", False), MachineKind(WHEEL_LOADER, "WL", False)]
+        self.wheel_loaders_battery = [Machine(id=f"WL #{i+1}", kind=WHEEL_LOADER, **wl_config) for i in range(num_wl)]
+        self.dumpers_battery = [Machine(id=f"DU #{i+1}", kind=DUMPER, **du_config) for i in range(num_du)]
+        self.excavator_battery = [Machine(id=f"EX #{i+1}", kind=EXCAVATOR, **ex_config) for i in range(num_ex_b)]
+        self.excavator_cable = [Machine(id=f"EX_C #{i+1}", kind=EXCAVATOR, **ex_config) for i in range(num_ex_c)]
+        self.other_machines: list[Machine] = []
+        for group in other_machines:
+            kind: MachineKind = MachineKind(len(self.kinds), group["prefix"], group["profile"])
+            self.kinds.append(kind)
+            self.other_machines += [Machine(id=f"{kind.prefix} #{i+1}", kind=kind.code, **group["config"]) for i in range(group["count"])]
+
+        # Battery levels of the battery machines in the order the processes are started, indexed by machine.index
+        self.battery_machines: list[Machine] = self.excavator_battery + self.dumpers_battery + self.wheel_loaders_battery + self.other_machines
+        for index, machine in enumerate(self.battery_machines):
+            machine.index = index
+        self.levels: list[float] = [float(machine.battery_capacity) for machine in self.battery_machines]
+        self.profiles: dict[tuple, dict] = {}
+
+        # Battery levels and cycle positions carried over from a previous day, see state()
+        if initial_state is not None:
+            for machine in self.battery_machines:
+                self.levels[machine.index] = min(max(initial_state["battery_levels"][machine.id], 0), machine.battery_capacity)
+            for machine in self.battery_machines + self.excavator_cable:
+                machine.phase = initial_state["phase"].get(machine.id, 0)
+        self.waiting: dict[str, tuple] = {}
+        self.charging: dict[str, tuple] = {}
+        self.finished: bool = False
+
+        # Chargers, with the valley policy they share what the base load and the cable excavators leave under the grid limit
+        background: np.ndarray = None
+        if charging_policy == "valley":
+            background = np.full(workday, float(base_load))
+            for machine in self.excavator_cable:
+                background += cable_power(self.profile_of(machine).ratios, machine.operating_power, workday, break_1, break_2, 
+                                          break_duration, workday, machine.phase)
+        self.chargers: charging_station = charging_station(env, num_chargers, policy=charging_policy, charging_power=self.charging_power, 
+                                                           grid_limit=grid_limit, background=background, horizon=workday + break_duration + 2)
+
+        # Logs, one row of battery levels per battery machine. With a resolution other than 1 second only the KPIs and 
+        # the battery levels at that resolution are kept, None keeps only the KPIs
+        machine_ids: list[str] = [machine.id for machine in self.battery_machines]
+        self.data: telemetry = telemetry(workday, machine_ids) if resolution == 1 else kpi_telemetry(workday, machine_ids, resolution)
+
+        # Instrumentation, counts the events of every kind of process and samples the chargers and the wall clock every
+        # "instrument" seconds. Off by default, the processes then run without any wrapping
+        self.instruments: instrumentation = None
+        if instrument is not None:
+            self.instruments = instrumentation(machine_ids)
+            env.process(self.sample(instrument))
+
+        # Engine, "step" advances every process one second at a time while "event" jumps straight to the next state change
+        if engine == "step":
+            operate_battery, operate_cable = self.operate_battery, self.operate_cable
+        elif engine == "event":
+            operate_battery, operate_cable = self.operate_battery_event, self.operate_cable_event
+        else:
+            raise ValueError(f"Unknown engine: {engine}. Use \"step\" or \"event\".")
 
         for machine in self.excavator_battery:
-            env.process(self.operate_battery(machine))
+            self.start("operate_battery", operate_battery(machine))
 
         for machine in self.excavator_cable:
-            env.process(self.operate_cable(machine))
+            self.start("operate_cable", operate_cable(machine))
 
         for machine in self.dumpers_battery:
-            env.process(self.operate_battery(machine))
+            self.start("operate_battery", operate_battery(machine))
 
         for machine in self.wheel_loaders_battery:
-            env.process(self.operate_battery(machine))
+            self.start("operate_battery", operate_battery(machine))
+
+        for machine in self.other_machines:
+            self.start("operate_battery", operate_battery(machine))
+
+        # Stops the run as soon as the productivity target can no longer be reached
+        self.aborted: int = None
+        if productivity_target is not None:
+            self.start("monitor_productivity", self.monitor_productivity(productivity_target))
+
+    def start(self, kind: str, process):
+        # Starts a process, its events are counted under kind when the worksite is instrumented
+        if self.instruments is not None:
+            process = self.instruments.count(kind, process)
+        return self.env.process(process)
+
+    def sample(self, interval: int):
+        while True:
+            self.instruments.samples.append((self.env.now, perf_counter(), len(self.chargers.users), len(self.chargers.queue)))
+            yield self.env.timeout(interval)
             
     def operate_cable(self, machine):
         break_1: int = self.break_1
         break_2: int = self.break_2
         break_time: int = self.break_duration
         operating_power: int = machine.operating_power
+        ratios: list[float] = self.profile_of(machine).ratios.tolist()
 
         while True:
-            for power_ratio in self.epp:
+            for phase in range(machine.phase, len(ratios)):
+                machine.phase = phase
+                power_ratio: float = ratios[phase]
                 if self.env.now == break_1 or self.env.now == break_2:
                     yield self.env.timeout(break_time)
                 else:
                     yield self.env.timeout(1)
                     self.log_power(power_ratio*operating_power)
+            machine.phase = 0
 
     def operate_battery(self, machine):
-        if machine.id.startswith(("WL", "DU")):
-            operating_power: float = machine.operating_power
-        else:
-            operating_power: int = machine.operating_power
-            sum_power_cycle: float = 0
-            for power_ratio in self.epp:
-                sum_power_cycle += power_ratio*operating_power
+        constant: bool = not self.kinds[machine.kind].profile
+        operating_power: float = machine.operating_power
+        ratios: list[float] = self.profile_of(machine).ratios.tolist()
         
         charging_threshold: float = self.charging_threshold
         charging_time: int = self.break_duration
+        profile: dict = self.draw_profile(machine)
+        levels: list[float] = self.levels
+        index: int = machine.index
+        capacity: float = machine.battery_capacity
 
         break_1: int = self.break_1
         break_2: int = self.break_2
         no_charging: int = self.workday-1800
 
         while True:
-            if machine.id.startswith(("WL", "DU")):
+            if constant:
                 self.log_battery_level(machine)
-                self.log_machines()
                 yield self.env.timeout(1)
 
                 if self.env.now == break_1  or self.env.now == break_2:
-                    yield self.env.process(self.charge(machine, charging_time))
+                    yield self.start("charge", self.charge(machine, charging_time, profile))
 
-                if machine.battery.level > charging_threshold*machine.battery.capacity:
-                    yield machine.battery.get(operating_power)
+                if levels[index] > charging_threshold*capacity:
+                    levels[index] = max(levels[index] - operating_power, 0)
                 else:
                     if self.env.now < no_charging:
-                        yield self.env.process(self.charge(machine, charging_time))
+                        yield self.start("charge", self.charge(machine, charging_time, profile))
                     else:
-                        if machine.battery.level > operating_power:
-                            yield machine.battery.get(operating_power)
+                        if levels[index] > operating_power:
+                            levels[index] = max(levels[index] - operating_power, 0)
                         else:
-                            self.data["inactive_machines"][self.env.now-1] += 1
+                            self.data.inactive_machines[self.env.now-1] += 1
             else:
-                for power_ratio in self.epp:
+                for phase in range(machine.phase, len(ratios)):
+                    machine.phase = phase
+                    power_ratio: float = ratios[phase]
                     self.log_battery_level(machine)
-                    self.log_machines()
                     yield self.env.timeout(1)
                     if self.env.now == break_1 or self.env.now == break_2:
-                        yield self.env.process(self.charge(machine, charging_time))
+                        yield self.start("charge", self.charge(machine, charging_time, profile))
 
-                    if machine.battery.level > charging_threshold*machine.battery.capacity:
-                        yield machine.battery.get(max(power_ratio*operating_power/3600, 0.001))
+                    if levels[index] > charging_threshold*capacity:
+                        levels[index] = max(levels[index] - max(power_ratio*operating_power/3600, 0.001), 0)
                     else:
                         if self.env.now < no_charging:
-                            yield self.env.process(self.charge(machine, charging_time))
+                            yield self.start("charge", self.charge(machine, charging_time, profile))
                         else:
-                            if machine.battery.level > power_ratio*machine.operating_power:
-                                yield machine.battery.get(power_ratio*operating_power/3600)
+                            if levels[index] > power_ratio*machine.operating_power:
+                                # set_level as the profile has a sample just below zero
+                                self.set_level(machine, levels[index] - power_ratio*operating_power/3600)
                             else:
-                                self.data["inactive_machines"][self.env.now-1] += 1
+                                self.data.inactive_machines[self.env.now-1] += 1
+                machine.phase = 0
 
-    def charge(self, machine: object, duration: int):
+    def charge(self, machine: object, duration: int, profile: dict):
         charging_power: float = self.charging_power
         charging_power_kW: int = charging_power*3600
+        throttled: bool = self.chargers.throttled
         
-        with self.chargers.request() as request:
-            while not request.triggered:
-                if machine.id.startswith(("WL", "DU")):
-                    self.log_battery_level(machine)
-                    self.log_machines()
-                    yield self.env.timeout(1)
-                    if machine.battery.level > machine.operating_power:
-                        yield machine.battery.get(machine.operating_power)
-                    else:
-                        self.data["inactive_machines"][self.env.now-1] += 1
-                else:
-                    for power_ratio in self.epp:
-                        self.log_battery_level(machine)
-                        self.log_machines()
-                        yield self.env.timeout(1)
-                        if machine.battery.level > power_ratio*machine.operating_power/3600:
-                            yield machine.battery.get(max(power_ratio*machine.operating_power/3600, 0.001))
-                        else:
-                            self.data["inactive_machines"][self.env.now-1] += 1
-
-            yield request
+        levels: list[float] = self.levels
+        with self.chargers.request(priority=self.chargers.priority(machine, levels[machine.index])) as request:
+            level = yield from self.wait_for_charger(machine, request, profile, duration)
+            self.set_level(machine, level)
+            self.chargers.begin(self.env.now, duration)
             for s in range(duration):
                 self.log_battery_level(machine)
-                self.log_machines()
                 yield self.env.timeout(1)
-                if machine.battery.level + charging_power < machine.battery.capacity:
-                    yield machine.battery.put(charging_power)
+                if throttled:
+                    charging_power = self.chargers.power_at(self.env.now)
+                    charging_power_kW = charging_power*3600
+                if levels[machine.index] + charging_power < machine.battery_capacity:
+                    levels[machine.index] += charging_power
 
                 self.log_power(charging_power_kW)
+
+    def wait_for_charger(self, machine: object, request, profile: dict, duration: int):
+        # Machines keep working while queued, the wait is one event and the energy drawn during it is settled once the 
+        # charger is granted. Excavators only check the queue after a full cycle, from the grant they hold the charger
+        # until the end of the charge and count as inactive, not as empty. Everything is logged at the grant as the 
+        # charge of an excavator can start after the end of the workday. Returns the level at the start of the charge
+        start: int = self.env.now
+        level: float = self.levels[machine.index]
+        cycle: int = len(profile["draw"])
+        if request.triggered:
+            self.log_inactive_span(start, start + duration)
+            if self.instruments is not None:
+                self.instruments.waits[machine.id].append(0)
+            return level
+
+        self.waiting[machine.id] = (start, level, profile, None)
+        yield request
+        granted: int = self.env.now
+        waited: int = -(-(granted - start) // cycle)*cycle
+        levels, inactive = self.drain(level, 0, waited, profile["wait_check"], profile["draw"])
+        self.log_battery_span(machine, start, levels[:-1])
+        self.log_empty(start, [step for step in inactive if start + step < granted])
+        self.log_inactive_span(granted, start + waited + duration)
+        self.data.queue_wait[machine.index] += waited
+        if self.instruments is not None:
+            self.instruments.waits[machine.id].append(waited)
+        if waited > granted - start:
+            self.waiting[machine.id] = (start, level, profile, granted)
+            yield self.env.timeout(waited - (granted - start))
+        del self.waiting[machine.id]
+        return levels[-1]
+
+    def finish(self) -> None:
+        # Settles the machines still waiting for a charger at the end of the run the same way as a grant would, their 
+        # levels and empty seconds are otherwise never logged. The last draw was the one of the previous second, like 
+        # for every other machine. Only once, the levels themselves are left as they are for state()
+        if self.finished:
+            return
+        self.finished = True
+        now: int = int(self.env.now)
+        for machine in self.battery_machines:
+            if machine.id not in self.waiting or self.waiting[machine.id][3] is not None:
+                continue
+            start, level, profile, _ = self.waiting[machine.id]
+            levels, inactive = self.drain(level, 0, max(now - 1 - start, 0), profile["wait_check"], profile["draw"])
+            self.log_battery_span(machine, start, levels)
+            self.log_empty(start, inactive)
+            self.data.queue_wait[machine.index] += now - start
+            if self.instruments is not None:
+                self.instruments.waits[machine.id].append(now - start)
     
+    def profile_of(self, machine) -> "power_profile":
+        return self.epp.of(self.kinds[machine.kind].prefix, machine.id)
+
+    def draw_profile(self, machine) -> dict:
+        # Per-second battery draw over one duty cycle, machines with a constant power have a cycle of one second.
+        # Machines of the same kind, power profile and power share the draw profile, it is only read
+        ratios: power_profile = self.profile_of(machine)
+        key: tuple = (machine.kind, machine.operating_power, id(ratios))
+        if key not in self.profiles:
+            self.profiles[key] = self.make_profile(self.kinds[machine.kind], machine.operating_power, ratios)
+        return self.profiles[key]
+
+    def make_profile(self, kind: "MachineKind", operating_power: float, ratios: "power_profile") -> dict:
+        if not kind.profile:
+            operating_power = np.array([operating_power])
+            profile: dict = {"draw": operating_power, "wait_check": operating_power, 
+                             "tail_check": operating_power, "tail_draw": operating_power}
+        else:
+            power: np.ndarray = ratios.ratios*operating_power
+            profile: dict = {"draw": np.maximum(power/3600, 0.001), "wait_check": power/3600, 
+                             "tail_check": power, "tail_draw": power/3600}
+        profile["cumulative"] = np.concatenate(([0], np.cumsum(profile["draw"])))
+        return profile
+
+    def seconds_to_threshold(self, profile: dict, phase: int, level: float, threshold: float) -> int:
+        # Number of draws until the level is at or below the threshold, O(1) with the prefix sums
+        if level <= threshold:
+            return 0
+        cumulative: np.ndarray = profile["cumulative"]
+        cycle: int = len(profile["draw"])
+        target: float = level - threshold + cumulative[phase]
+        full_cycles: int = int(target // cumulative[-1])
+        offset: int = int(np.searchsorted(cumulative, target - full_cycles*cumulative[-1]))
+        return max(full_cycles*cycle + offset - phase, 1)
+
+    def drain(self, level: float, phase: int, steps: int, check: np.ndarray, draw: np.ndarray) -> tuple[np.ndarray, list]:
+        # Levels over "steps" seconds where a second only draws if the level is above the check value and never below 
+        # empty, returns the levels at every second (steps+1 values) and the offsets where the machine was inactive.
+        # The draws are taken one after the other so the levels round like in the step engine
+        cycle: int = len(draw)
+        positions: np.ndarray = (phase + np.arange(steps)) % cycle
+        levels: np.ndarray = np.subtract.accumulate(np.concatenate(([level], draw[positions])))
+        if steps == 0 or levels[-1] > max(check.max(), 0):
+            return levels, []
+
+        inactive: list = []
+        for step, position in enumerate(positions.tolist()):
+            if level > check[position]:
+                level = max(level - draw[position], 0)
+            else:
+                inactive.append(step)
+            levels[step+1] = level
+        return levels, inactive
+
+    def set_level(self, machine, level: float) -> None:
+        # Moves the battery level to level without going below empty or above full
+        self.levels[machine.index] = min(max(level, 0), machine.battery_capacity)
+
+    def state(self) -> dict:
+        # Battery levels, cycle positions and charger queue now, used to carry a worksite over to the next day. Machines still
+        # in the queue have their levels settled up to now the same way wait_for_charger does when the charger is granted,
+        # and the event engine already holds the level at the end of a charge so the one of the last second is used
+        levels: dict[str, float] = {}
+        now: int = int(self.env.now)
+        for machine in self.battery_machines:
+            level: float = self.levels[machine.index]
+            if machine.id in self.waiting:
+                start, level, profile, _ = self.waiting[machine.id]
+                level = self.drain(level, 0, max(now - 1 - start, 0), profile["wait_check"], profile["draw"])[0][-1]
+            elif machine.id in self.charging:
+                begin, charge_levels = self.charging[machine.id]
+                if np.ndim(charge_levels) == 0:
+                    # Throttled charges only know their levels up to now
+                    charge_levels = charge_levels_of(charge_levels, self.chargers.power(begin + 1, max(now, begin + 1)), machine.battery_capacity)
+                level = charge_levels[min(max(now - 1 - begin, 0), len(charge_levels) - 1)]
+            levels[machine.id] = float(level)
+        return {"battery_levels": levels,
+                "battery_capacity": {machine_id: float(capacity) for machine_id, capacity in zip(levels, self.capacities())},
+                "phase": {machine.id: int(machine.phase) for machine in self.battery_machines + self.excavator_cable 
+                          if self.kinds[machine.kind].profile},
+                "queue": list(self.waiting)}
+
+    def capacities(self) -> list[float]:
+        return [machine.battery_capacity for machine in self.battery_machines]
+
+    def next_break(self, time: int) -> int:
+        upcoming: list[int] = [b for b in (self.break_1, self.break_2) if b >= time]
+        return min(upcoming) if upcoming else None
+
+    def operate_cable_event(self, machine):
+        break_time: int = self.break_duration
+        workday: int = self.workday
+        power: np.ndarray = self.profile_of(machine).ratios*machine.operating_power
+        cycle: int = len(power)
+        phase: int = machine.phase
+
+        while True:
+            now: int = self.env.now
+            next_break: int = self.next_break(now)
+            if next_break == now:
+                phase = machine.phase = (phase + 1) % cycle
+                yield self.env.timeout(break_time)
+                continue
+
+            steps: int = (next_break if next_break is not None else workday) - now
+            self.log_power_span(now + 1, power[(phase + np.arange(steps)) % cycle])
+            phase = machine.phase = (phase + steps) % cycle
+            yield self.env.timeout(steps)
+
+    def operate_battery_event(self, machine):
+        profile: dict = self.draw_profile(machine)
+        cycle: int = len(profile["draw"])
+        threshold: float = self.charging_threshold*machine.battery_capacity
+        charging_time: int = self.break_duration
+        workday: int = self.workday
+        no_charging: int = self.workday-1800
+        phase: int = machine.phase
+
+        while True:
+            now: int = self.env.now
+            level: float = self.levels[machine.index]
+            next_break: int = self.next_break(now + 1)
+            steps: int = workday - 1 - now
+            if next_break is not None:
+                steps = min(steps, next_break - now - 1)
+
+            # Skip ahead to the last second before a break, a threshold crossing or the end of the workday
+            if level <= threshold and now + 1 >= no_charging:
+                levels, inactive = self.drain(level, phase, steps, profile["tail_check"], profile["tail_draw"])
+                # A negative sample of the power profile can lift the level back over the threshold, the machine
+                # then draws as usual again
+                over: np.ndarray = np.flatnonzero(levels[1:] > threshold)
+                if len(over):
+                    steps = int(over[0]) + 1
+                    levels, inactive = levels[:steps + 1], [step for step in inactive if step < steps]
+                self.log_empty(now, inactive)
+            else:
+                steps = min(steps, self.seconds_to_threshold(profile, phase, level, threshold))
+                levels = np.subtract.accumulate(np.concatenate(([level], profile["draw"][(phase + np.arange(steps)) % cycle])))
+                # The prefix sums can round the other way than the draws one by one, the machine stops at the first 
+                # level at the threshold like in the step engine
+                under: np.ndarray = np.flatnonzero(levels[:-1] <= threshold)
+                if len(under):
+                    steps = int(under[0])
+                    levels = levels[:steps + 1]
+            
+            self.log_battery_span(machine, now, levels)
+            phase = machine.phase = (phase + steps) % cycle
+            self.set_level(machine, levels[-1])
+            yield self.env.timeout(steps + 1)
+
+            if self.env.now == self.break_1 or self.env.now == self.break_2:
+                yield self.start("charge", self.charge_event(machine, charging_time, profile))
+
+            level = self.levels[machine.index]
+            if level > threshold:
+                self.set_level(machine, level - profile["draw"][phase])
+            elif self.env.now < no_charging:
+                yield self.start("charge", self.charge_event(machine, charging_time, profile))
+            elif level > profile["tail_check"][phase]:
+                self.set_level(machine, level - profile["tail_draw"][phase])
+            else:
+                self.data.inactive_machines[self.env.now-1] += 1
+            phase = machine.phase = (phase + 1) % cycle
+
+    def charge_event(self, machine: object, duration: int, profile: dict):
+        charging_power: float = self.charging_power
+        capacity: float = machine.battery_capacity
+        
+        with self.chargers.request(priority=self.chargers.priority(machine, self.levels[machine.index])) as request:
+            level = yield from self.wait_for_charger(machine, request, profile, duration)
+            begin: int = self.env.now
+            if self.chargers.throttled:
+                yield from self.throttled_charge_event(machine, duration, begin, level)
+                return
+            levels: np.ndarray = charge_levels_of(level, np.full(duration, charging_power), capacity)
+            self.log_battery_span(machine, begin, levels[:-1])
+            self.log_power_span(begin + 1, np.full(duration, charging_power*3600))
+            self.charging[machine.id] = (begin, levels)
+            self.set_level(machine, levels[-1])
+            yield self.env.timeout(duration)
+            del self.charging[machine.id]
+
+    def throttled_charge_event(self, machine: object, duration: int, begin: int, level: float):
+        # The power of a charger changes whenever another charge starts, so the levels are settled once the charge is over
+        # or, for a charge past the end of the workday, in its last second when the power up to then is known
+        end: int = begin + duration
+        settled: int = min(end, max(self.workday - 1, begin))
+        self.chargers.begin(begin, duration)
+        self.charging[machine.id] = (begin, level)
+        yield self.env.timeout(settled - begin)
+        power: np.ndarray = self.chargers.power(begin + 1, end + 1)
+        levels: np.ndarray = charge_levels_of(level, power, machine.battery_capacity)
+        self.log_battery_span(machine, begin, levels[:-1])
+        self.log_power_span(begin + 1, power*3600)
+        if settled < end:
+            yield self.env.timeout(end - settled)
+        self.set_level(machine, levels[-1])
+        del self.charging[machine.id]
+    
+    def active_machine_seconds(self, start: int, end: int) -> int:
+        # Sum of active machines over [start, end), cable excavators are inactive during the breaks
+        time: np.ndarray = np.arange(start, end)
+        on_break: np.ndarray = (((time > self.break_1) & (time < self.break_1 + self.break_duration)) | 
+                                ((time > self.break_2) & (time < self.break_2 + self.break_duration)))
+        total_machines: int = len(self.data.machine_ids) + len(self.excavator_cable)
+        return total_machines*(end - start) - int(self.data.inactive_machines[start:end].sum()) - len(self.excavator_cable)*int(on_break.sum())
+
+    def monitor_productivity(self, productivity_target: float, interval: int = 60):
+        # The inactive machines of a second can still change during the next one, so only seconds before now-1 are counted.
+        # Assuming every machine is active for the rest of the day gives an upper bound of the productivity
+        total_machines: int = len(self.data.machine_ids) + len(self.excavator_cable)
+        required: float = productivity_target*total_machines*8*3600
+        counted, active = 0, 0
+        while True:
+            yield self.env.timeout(interval)
+            active += self.active_machine_seconds(counted, self.env.now - 1)
+            counted = self.env.now - 1
+            if active + total_machines*(self.workday - counted) < required:
+                self.aborted = self.env.now
+                stop = self.env.event()
+                stop.callbacks.append(simpy.core.StopSimulation.callback)
+                stop.succeed()
+                return
+
     def log_battery_level(self, machine):
-        self.data["battery_levels"].append((self.env.now, machine.id, machine.battery.level))
+        self.data.record_battery(machine.index, self.env.now, self.levels[machine.index])
         
     def log_power(self, charging_power):
-        time: int = self.env.now
-        if time in self.data['power']:
-            self.data['power'][time] += charging_power
-        else:
-            self.data['power'][time] = charging_power
+        self.data.power[self.env.now] += charging_power
 
-    def log_machines(self):
-        time: int = self.env.now
-        self.data["inactive_machines"][time] = len(self.chargers.users)
+    def log_empty(self, start: int, steps: list) -> None:
+        # Seconds start+step a machine could not work since its battery was empty
+        self.data.inactive_machines[start + np.asarray(steps, dtype=int)] += 1
 
-@dataclass
+    def log_battery_span(self, machine, start: int, levels: np.ndarray):
+        levels = np.maximum(levels[:max(self.workday - start, 0)], 0)
+        self.data.record_battery_span(machine.index, start, levels)
+
+    def log_power_span(self, start: int, power: np.ndarray):
+        power = power[:max(self.workday - start, 0)]
+        self.data.power[start:start + len(power)] += power
+
+    def log_inactive_span(self, start: int, end: int):
+        self.data.inactive_machines[start:end] += 1
+
+# Codes of the machine kinds every worksite has, kinds added from machine_settings get the codes after them
+EXCAVATOR, DUMPER, WHEEL_LOADER = 0, 1, 2
+
+@dataclass(slots=True, frozen=True)
+class MachineKind:
+    code: int
+    prefix: str
+    profile: bool
+
+@dataclass(slots=True)
 class Machine:
-    env: simpy.Environment
+    # The battery level is kept by the worksite in worksite.levels[index]
     id: str
-    battery_capacity: int
+    kind: int
+    battery_capacity: float
     operating_power: float
-    battery: simpy.Container = field(init=False)
-
-    def __post_init__(self):
-        self.battery = simpy.Container(self.env, init=self.battery_capacity, capacity=self.battery_capacity)
-
-def simulation(simulation_settings, machine_settings, epp, save, show, grid):
+    index: int = -1
+    phase: int = 0
+
+# Charging policies, "fifo" and "soc" charge at full power in order of request or of lowest state of charge first, "capped" 
+# shares the grid limit between the chargers and "valley" shares what is left under it after the base load and cable excavators
+CHARGING_POLICIES: list[str] = ["fifo", "soc", "capped", "valley"]
+
+class charger_request(simpy.resources.resource.Request):
+    def __init__(self, resource, priority=0) -> None:
+        self.priority = priority
+        super().__init__(resource)
+
+class charger_queue():
+    # Waiting requests in a binary heap on their priority and then their order, simpy only reads and pops the first one.
+    # A removed request is only forgotten in the set and dropped from the heap once it comes up first, so a removal is O(1)
+    def __init__(self) -> None:
+        self.heap: list[tuple] = []
+        self.waiting: set = set()
+        self.order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def __getitem__(self, index: int):
+        if index != 0:
+            raise IndexError("Only the first request can be read from the charger queue.")
+        self.prune()
+        return self.heap[0][2]
+
+    def __iter__(self):
+        return (request for _, _, request in sorted(self.heap) if request in self.waiting)
+
+    def append(self, request) -> None:
+        heapq.heappush(self.heap, (request.priority, next(self.order), request))
+        self.waiting.add(request)
+
+    def pop(self, index: int = 0):
+        if index != 0:
+            raise IndexError("Only the first request can be taken from the charger queue.")
+        self.prune()
+        request = heapq.heappop(self.heap)[2]
+        self.waiting.remove(request)
+        return request
+
+    def remove(self, request) -> None:
+        try:
+            self.waiting.remove(request)
+        except KeyError:
+            raise ValueError("The request is not in the charger queue.") from None
+
+    def prune(self) -> None:
+        while self.heap and self.heap[0][2] not in self.waiting:
+            heapq.heappop(self.heap)
+
+class charger_users():
+    # Requests holding a charger, a dict so a release is O(1) instead of a list removal
+    def __init__(self) -> None:
+        self.requests: dict = {}
+
+    def __len__(self) -> int:
+        return len(self.requests)
+
+    def __iter__(self):
+        return iter(self.requests)
+
+    def append(self, request) -> None:
+        self.requests[request] = None
+
+    def remove(self, request) -> None:
+        try:
+            del self.requests[request]
+        except KeyError:
+            raise ValueError("The request does not hold a charger.") from None
+
+# Priority of the simpy events that run after every other event of the same second
+LAST: int = 2
+# Decimals of the state of charge the soc policy orders the queue by
+SOC_DECIMALS: int = 9
+
+class charging_station(simpy.Resource):
+    # Chargers of a worksite, granting and queueing are O(log n) in the number of waiting machines. The chargers are handed
+    # out once every request of the second is in, so they are ranked together like in the batch engine and not in the 
+    # order simpy happens to run the machines of a second. With 
+    # "capped" and "valley" every charger gets an equal share of the headroom under the grid limit up to the charging power, 
+    # recounted every second
+    PutQueue = charger_queue
+    request = simpy.core.BoundClass(charger_request)
+
+    def __init__(self, env, capacity: int, *, policy: str = "fifo", charging_power: float, grid_limit: float = None, 
+                 background: np.ndarray = None, horizon: int) -> None:
+        if policy not in CHARGING_POLICIES:
+            raise ValueError(f"Unknown charging policy: {policy}. Use {', '.join(CHARGING_POLICIES)}.")
+        super().__init__(env, capacity=capacity)
+        self.users = charger_users()
+        self.policy: str = policy
+        self.grant_pending: bool = False
+        self.charging_power: float = charging_power
+        self.throttled: bool = policy in ("capped", "valley")
+        if self.throttled:
+            if grid_limit is None or pd.isna(grid_limit):
+                raise ValueError(f"The {policy} charging policy needs a grid_limit.")
+            headroom: np.ndarray = np.full(horizon, float(grid_limit))
+            if background is not None:
+                headroom[:len(background)] -= background
+            self.headroom: np.ndarray = np.maximum(headroom, 0)/3600
+            self.sessions: np.ndarray = np.zeros(horizon, dtype=np.int32)
+
+    def priority(self, machine, level: float):
+        # In order of request and then machine like the batch engine, with "soc" lowest state of charge first. The state of 
+        # charge is rounded so the rounding errors of the engines do not order machines with the same level
+        if self.policy != "soc":
+            return (self._env.now, machine.index)
+        return (float(np.round(level/machine.battery_capacity, SOC_DECIMALS)), self._env.now, machine.index)
+
+    def _trigger_put(self, get_event) -> None:
+        if not self.grant_pending:
+            self.grant_pending = True
+            grant = simpy.events.Event(self._env)
+            grant._ok, grant._value = True, None
+            grant.callbacks.append(self.grant)
+            self._env.schedule(grant, LAST)
+
+    def grant(self, event) -> None:
+        self.grant_pending = False
+        while self.put_queue and len(self.users) < self.capacity:
+            super()._trigger_put(None)
+
+    def begin(self, start: int, duration: int) -> None:
+        # A charge from start draws in the seconds start+1 to start+duration
+        if self.throttled:
+            self.sessions[start + 1:start + duration + 1] += 1
+
+    def power(self, start: int, end: int) -> np.ndarray:
+        # Energy per second of every charger from start to end-1, only final for the seconds up to now
+        if not self.throttled:
+            return np.full(end - start, self.charging_power)
+        return np.minimum(self.charging_power, self.headroom[start:end]/np.maximum(self.sessions[start:end], 1))
+
+    def power_at(self, time: int) -> float:
+        return min(self.charging_power, self.headroom[time]/max(self.sessions[time], 1))
+
+def charge_levels_of(level: float, power: np.ndarray, capacity: float) -> np.ndarray:
+    # Levels over a charge that adds power[i] in second i if the battery stays below its capacity, like the step engine
+    levels: np.ndarray = np.add.accumulate(np.concatenate(([level], power)))
+    if levels[-1] < capacity:
+        return levels
+    # From the first second that would fill the battery only the seconds with less power than is missing can still add
+    first: int = int(np.argmax(levels[1:] >= capacity))
+    level = levels[first]
+    added: np.ndarray = np.zeros(len(power) - first)
+    for step in np.flatnonzero(power[first:] < capacity - level).tolist():
+        if level + power[first + step] < capacity:
+            level += power[first + step]
+            added[step] = power[first + step]
+    levels[first:] = np.add.accumulate(np.concatenate(([levels[first]], added)))
+    return levels
+
+class telemetry():
+    # Per-second logs preallocated for the whole workday, battery levels are stored as one row per battery machine
+    def __init__(self, workday: int, machine_ids: list[str]) -> None:
+        self.machine_ids: list[str] = machine_ids
+        self.battery_levels: np.ndarray = np.full((len(machine_ids), workday), np.nan, dtype=np.float32)
+        self.power: np.ndarray = np.zeros(workday)
+        self.inactive_machines: np.ndarray = np.zeros(workday, dtype=np.int32)
+        self.queue_wait: np.ndarray = np.zeros(len(machine_ids), dtype=np.int64)
+
+    def battery_levels_by_machine(self) -> dict[str, np.ndarray]:
+        # The rows are views into the log, nothing is copied
+        return dict(zip(self.machine_ids, self.battery_levels))
+
+    def queue_wait_by_machine(self) -> dict[str, int]:
+        # Seconds every battery machine spent waiting for a charger
+        return dict(zip(self.machine_ids, self.queue_wait.tolist()))
+
+    def min_battery_level_by_machine(self) -> dict[str, float]:
+        return dict(zip(self.machine_ids, np.nanmin(self.battery_levels, axis=1).tolist()))
+
+    def record_battery(self, index: int, time: int, level: float) -> None:
+        self.battery_levels[index, time] = level
+
+    def record_battery_span(self, index: int, start: int, levels: np.ndarray) -> None:
+        self.battery_levels[index, start:start + len(levels)] = levels
+
+class kpi_telemetry():
+    # Same logs as telemetry without the battery level of every machine at every second. Only the lowest level of every
+    # machine is kept and, with a resolution, the min/max/mean level over buckets of that many seconds. Grid power and
+    # inactive machines stay per second since the event engine writes them ahead and queued machines settle them afterwards
+    def __init__(self, workday: int, machine_ids: list[str], resolution: int = None) -> None:
+        self.machine_ids: list[str] = machine_ids
+        self.workday: int = workday
+        self.resolution: int = resolution
+        self.power: np.ndarray = np.zeros(workday)
+        self.inactive_machines: np.ndarray = np.zeros(workday, dtype=np.int32)
+        self.queue_wait: np.ndarray = np.zeros(len(machine_ids), dtype=np.int64)
+        self.min_level: np.ndarray = np.full(len(machine_ids), np.inf)
+        if resolution is not None:
+            shape: tuple = (len(machine_ids), -(-workday // resolution))
+            self.level_min: np.ndarray = np.full(shape, np.inf, dtype=np.float32)
+            self.level_max: np.ndarray = np.full(shape, -np.inf, dtype=np.float32)
+            self.level_sum: np.ndarray = np.zeros(shape)
+            self.level_count: np.ndarray = np.zeros(shape, dtype=np.int32)
+
+    def queue_wait_by_machine(self) -> dict[str, int]:
+        return dict(zip(self.machine_ids, self.queue_wait.tolist()))
+
+    def min_battery_level_by_machine(self) -> dict[str, float]:
+        return dict(zip(self.machine_ids, self.min_level.tolist()))
+
+    def record_battery(self, index: int, time: int, level: float) -> None:
+        if level < self.min_level[index]:
+            self.min_level[index] = level
+        if self.resolution is not None:
+            bucket: int = time // self.resolution
+            self.level_min[index, bucket] = min(self.level_min[index, bucket], level)
+            self.level_max[index, bucket] = max(self.level_max[index, bucket], level)
+            self.level_sum[index, bucket] += level
+            self.level_count[index, bucket] += 1
+
+    def record_battery_span(self, index: int, start: int, levels: np.ndarray) -> None:
+        if len(levels) == 0:
+            return
+        self.min_level[index] = min(self.min_level[index], levels.min())
+        if self.resolution is not None:
+            # Offsets where a new bucket starts, the span covers the buckets first to last
+            resolution: int = self.resolution
+            first, last = start // resolution, (start + len(levels) - 1) // resolution
+            edges: np.ndarray = np.concatenate(([0], np.arange((first + 1)*resolution, start + len(levels), resolution) - start))
+            buckets: slice = slice(first, last + 1)
+            self.level_min[index, buckets] = np.minimum(self.level_min[index, buckets], np.minimum.reduceat(levels, edges))
+            self.level_max[index, buckets] = np.maximum(self.level_max[index, buckets], np.maximum.reduceat(levels, edges))
+            self.level_sum[index, buckets] += np.add.reduceat(levels, edges)
+            self.level_count[index, buckets] += np.diff(np.append(edges, len(levels))).astype(np.int32)
+
+    def battery_levels_by_machine(self) -> tuple[dict, dict, dict]:
+        # Min, max and mean level of every bucket
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean: np.ndarray = (self.level_sum/self.level_count).astype(np.float32)
+        empty: np.ndarray = self.level_count == 0
+        minimum: np.ndarray = np.where(empty, np.nan, self.level_min)
+        maximum: np.ndarray = np.where(empty, np.nan, self.level_max)
+        return tuple(dict(zip(self.machine_ids, values)) for values in (minimum, maximum, mean))
+
+def decimate(values: np.ndarray, resolution: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Min, max and mean over buckets of resolution seconds, the last bucket can be shorter
+    padded: np.ndarray = np.full(-(-len(values) // resolution)*resolution, np.nan)
+    padded[:len(values)] = values
+    buckets: np.ndarray = padded.reshape(-1, resolution)
+    return np.nanmin(buckets, axis=1), np.nanmax(buckets, axis=1), np.nanmean(buckets, axis=1)
+
+# Edges in minutes of the queue wait histogram, charges that got a charger straight away are in the first bin
+QUEUE_WAIT_BINS: list[float] = [0, 1, 5, 10, 15, 30, 60, np.inf]
+
+class instrumentation():
+    # Event counts per kind of process, every charger wait and samples of (time, wall clock, chargers in use, queue length)
+    def __init__(self, machine_ids: list[str]) -> None:
+        self.events: dict[str, int] = {}
+        self.waits: dict[str, list[int]] = {machine_id: [] for machine_id in machine_ids}
+        self.samples: list[tuple] = []
+
+    def count(self, kind: str, process):
+        # Passes the events of a process through to simpy, and the values and interrupts back, counting every event
+        self.events.setdefault(kind, 0)
+        value, error = None, None
+        while True:
+            try:
+                event = process.throw(error) if error is not None else process.send(value)
+            except StopIteration as stop:
+                return stop.value
+            self.events[kind] += 1
+            value, error = None, None
+            try:
+                value = yield event
+            except BaseException as exception:
+                error = exception
+
+    def summary(self, num_chargers: int) -> dict:
+        samples: np.ndarray = np.array(self.samples, dtype=float).reshape(-1, 4)
+        time, wall, users, queue = samples.T
+        edges: np.ndarray = np.array(QUEUE_WAIT_BINS)
+        histograms: dict = {machine_id: np.histogram(np.array(waits)/60, bins=edges)[0].tolist()
+                            for machine_id, waits in self.waits.items()}
+        return {"events": dict(self.events),
+                "total_events": sum(self.events.values()),
+                "wall_time": float(wall[-1] - wall[0]) if len(wall) > 1 else 0.0,
+                "charger_utilization": float(users.mean()/num_chargers) if len(users) else np.nan,
+                "max_queue_length": int(queue.max()) if len(queue) else 0,
+                "samples": {"time": time.astype(int).tolist(),
+                            "wall_time": np.diff(wall, prepend=wall[:1]).tolist(),
+                            "chargers_in_use": users.astype(int).tolist(),
+                            "queue_length": queue.astype(int).tolist()},
+                "queue_wait": {machine_id: {"charges": len(waits), "mean": float(np.mean(waits)) if waits else 0.0,
+                                            "max": int(max(waits, default=0))} for machine_id, waits in self.waits.items()},
+                "queue_wait_histogram": {"bins": [f"{low:g}-{high:g}" for low, high in zip(edges[:-1], edges[1:])],
+                                         "machines": histograms}}
+
+# Machine states in the batch engine
+OPERATING, QUEUED, CHARGING, IDLE = 0, 1, 2, 3
+
+def cable_power(ratios: np.ndarray, operating_power: float, workday: int, break_1: int, break_2: int, break_duration: int, 
+                horizon: int, phase: int = 0) -> np.ndarray:
+    # Power of cable excavators that follow the same power profile from phase and pause during the breaks, like operate_cable
+    power: np.ndarray = np.zeros(horizon)
+    cycle: int = len(ratios)
+    time: int = 0
+    while time < workday:
+        upcoming: list[int] = [b for b in (break_1, break_2) if b >= time]
+        if upcoming and min(upcoming) == time:
+            time, phase = time + break_duration, phase + 1
+            continue
+        steps: int = (min(upcoming) if upcoming else workday) - time
+        end: int = min(time + 1 + steps, workday)
+        power[time + 1:end] = ratios[(phase + np.arange(end - time - 1)) % cycle]*operating_power
+        time, phase = time + steps, phase + steps
+    return power
+
+class batch_worksite():
+    # Runs many worksites at once in lock-step, one array operation per second for every machine of every scenario.
+    # Follows the step engine second by second, the charging queue is in order of request and then machine like the
+    # charging_station or lowest state of charge first with the soc policy.
+    def __init__(self, *, epp, scenarios: list[dict]) -> None:
+        epp = epp if isinstance(epp, power_profile) else power_profile(epp)
+        profiles: list[power_profile] = [epp.for_size(scenario["size_setting"]) if "size_setting" in scenario else epp for scenario in scenarios]
+        self.names: list[str] = [scenario["name"] for scenario in scenarios]
+
+        def column(key: str, dtype=float) -> np.ndarray:
+            return np.array([scenario[key] for scenario in scenarios], dtype=dtype)
+
+        # Scenarios
+        self.workday: np.ndarray = column("workday", int)
+        self.break_1: np.ndarray = column("break_1", int)
+        self.break_2: np.ndarray = column("break_2", int)
+        self.break_duration: np.ndarray = column("break_duration", int)
+        self.num_chargers: np.ndarray = column("num_chargers", int)
+        self.charging_power: np.ndarray = column("charging_power")/3600
+        self.base_load: np.ndarray = column("base_load")
+        self.num_ex_c: np.ndarray = column("num_ex_c", int)
+        policies: list[str] = [scenario.get("charging_policy", "fifo") for scenario in scenarios]
+        unknown: set[str] = set(policies) - set(CHARGING_POLICIES)
+        if unknown:
+            raise ValueError(f"Unknown charging policy: {', '.join(sorted(unknown))}. Use {', '.join(CHARGING_POLICIES)}.")
+        self.by_soc: np.ndarray = np.array([policy == "soc" for policy in policies])
+        self.capped: np.ndarray = np.array([policy == "capped" for policy in policies])
+        self.valley: np.ndarray = np.array([policy == "valley" for policy in policies])
+        self.grid_limit: np.ndarray = np.array([np.nan if scenario.get("grid_limit") is None else scenario["grid_limit"] for scenario in scenarios], dtype=float)
+        if np.isnan(self.grid_limit[self.capped | self.valley]).any():
+            raise ValueError("The capped and valley charging policies need a grid_limit.")
+        other_machines: list[list[dict]] = [scenario.get("other_machines", []) for scenario in scenarios]
+        self.total_machines: np.ndarray = (column("num_wl", int) + column("num_ex_b", int) + column("num_du", int) + self.num_ex_c + 
+                                           np.array([sum(group["count"] for group in groups) for groups in other_machines], dtype=int))
+
+        # Battery machines in the same order as the processes of the worksite, padded to the largest fleet. A machine 
+        # either follows a power profile like the excavators or draws a constant power (no profile)
+        fleets: list[list[tuple]] = [[(profile.of("EX", f"EX #{i+1}"), scenario["ex_config"]) for i in range(scenario["num_ex_b"])] + 
+                                     [(None, scenario["du_config"])]*scenario["num_du"] + [(None, scenario["wl_config"])]*scenario["num_wl"] + 
+                                     [(profile.of(group["prefix"], f"{group['prefix']} #{i+1}") if group["profile"] else None, group["config"]) 
+                                      for group in groups for i in range(group["count"])] 
+                                     for scenario, groups, profile in zip(scenarios, other_machines, profiles)]
+        shape: tuple = (len(scenarios), max([len(fleet) for fleet in fleets] + [1]))
+        self.mode: np.ndarray = np.full(shape, IDLE, dtype=np.int8)
+        self.capacity: np.ndarray = np.zeros(shape)
+        self.operating_power: np.ndarray = np.zeros(shape)
+        self.on_profile: np.ndarray = np.zeros(shape, dtype=bool)
+
+        # All power profiles one after the other, a machine reads its profile from offset to offset + length
+        offsets: dict[int, int] = {id(epp): 0}
+        tables: list[np.ndarray] = [epp.ratios]
+        self.offset: np.ndarray = np.zeros(shape, dtype=int)
+        self.length: np.ndarray = np.ones(shape, dtype=int)
+        for s, fleet in enumerate(fleets):
+            for m, (profile, config) in enumerate(fleet):
+                self.mode[s, m] = OPERATING
+                self.capacity[s, m] = config["battery_capacity"]
+                self.operating_power[s, m] = config["operating_power"]*(1 if profile is not None else 3600)
+                self.on_profile[s, m] = profile is not None
+                if profile is not None:
+                    if id(profile) not in offsets:
+                        offsets[id(profile)] = sum(len(table) for table in tables)
+                        tables.append(profile.ratios)
+                    self.offset[s, m], self.length[s, m] = offsets[id(profile)], len(profile)
+        self.table: np.ndarray = np.concatenate(tables)
+
+        self.level: np.ndarray = self.capacity.copy()
+        self.excavator_power: np.ndarray = np.where(self.on_profile, self.operating_power, 0)
+        self.constant_power: np.ndarray = np.where(self.on_profile, 0, self.operating_power)
+        self.minimum_draw: np.ndarray = np.where(self.on_profile, 0.001, -np.inf)
+        self.tail_scale: np.ndarray = np.where(self.on_profile, 1, 1/3600)
+        self.threshold: np.ndarray = column("charging_threshold")[:, None]*self.capacity
+        self.cycle: np.ndarray = np.where(self.on_profile, self.length, 1)
+        self.phase: np.ndarray = np.zeros(shape, dtype=int)
+
+        # Cable excavators with the same power profile are added up, they all follow the same cycle
+        self.cable_operating_power: np.ndarray = np.array([scenario["ex_config"]["operating_power"] for scenario in scenarios], dtype=float)
+        self.cable_groups: list[list[tuple]] = []
+        for scenario, profile in zip(scenarios, profiles):
+            groups: dict[int, tuple] = {}
+            for i in range(scenario["num_ex_c"]):
+                ratios: power_profile = profile.of("EX", f"EX_C #{i+1}")
+                groups.setdefault(id(ratios), (ratios, []))[1].append(i)
+            self.cable_groups.append(list(groups.values()))
+        self.cable_power: np.ndarray = np.stack([self.cable_load(s, np.ones(self.num_ex_c[s]), self.workday.max()) for s in range(len(scenarios))])
+
+    def cable_load(self, s: int, scales: np.ndarray, horizon: int) -> np.ndarray:
+        # Power of the cable excavators in a scenario with the operating power of every one of them scaled by scales
+        power: np.ndarray = np.zeros(horizon)
+        for ratios, machines in self.cable_groups[s]:
+            power += self.cable_profile(s, self.cable_operating_power[s]*np.sum(scales[machines]), horizon, ratios.ratios)
+        return power
+
+    def cable_profile(self, s: int, operating_power: float, horizon: int, ratios: np.ndarray) -> np.ndarray:
+        return cable_power(ratios, operating_power, self.workday[s], self.break_1[s], self.break_2[s], self.break_duration[s], horizon)
+
+    def power_ratio(self, position: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Battery draw, draw without the minimum and the check after the charging cutoff at every cycle position,
+        # the position of machines with a constant power is always 0 since their cycle is one second.
+        # A cycle longer or shorter than the power profile stretches the profile over the cycle
+        power: np.ndarray = self.table[self.offset + (position*self.length)//self.cycle]*self.excavator_power + self.constant_power
+        per_second: np.ndarray = power/3600
+        return np.maximum(per_second, self.minimum_draw), per_second, power*self.tail_scale
+
+    def perturb(self, seeds: list, *, cycle_jitter: float = 0.05, break_offset: int = 600, power_scale: float = 0.1) -> None:
+        # Random inputs for every scenario drawn from its own seed, so a replication gives the same result in any batch.
+        # Each machine gets its own power scaling and excavator cycle time, the breaks of the worksite move together
+        for s, seed in enumerate(seeds):
+            rng = np.random.default_rng(seed)
+            machines: int = int(np.count_nonzero(self.mode[s] != IDLE))
+            power: np.ndarray = np.maximum(rng.normal(1, power_scale, machines + self.num_ex_c[s]), 0.1)
+            cycle: np.ndarray = np.maximum(rng.normal(1, cycle_jitter, machines), 0.5)
+            offset: np.ndarray = rng.integers(-break_offset, break_offset + 1, 2)
+
+            self.excavator_power[s, :machines] *= power[:machines]
+            self.constant_power[s, :machines] *= power[:machines]
+            self.cycle[s, :machines] = np.where(self.on_profile[s, :machines], np.rint(self.length[s, :machines]*cycle).astype(int), 1)
+            self.break_1[s] = np.clip(self.break_1[s] + offset[0], 1, self.workday[s] - 1)
+            self.break_2[s] = np.clip(self.break_2[s] + offset[1], 1, self.workday[s] - 1)
+            self.cable_power[s] = self.cable_load(s, power[machines:], self.cable_power.shape[1])
+
+    def run(self, keep_series: bool = False, keep_power: bool = False) -> dict:
+        # keep_series returns the grid power, active machines and battery levels of every second, keep_power only the power
+        keep_power = keep_power or keep_series
+        scenarios, machines = self.level.shape
+        horizon: int = int(self.workday.max())
+        index: np.ndarray = np.arange(machines)[None, :]
+        rows: np.ndarray = np.arange(scenarios)[:, None]
+        no_charging: np.ndarray = self.workday - 1800
+
+        mode, level, phase = self.mode, self.level, self.phase
+        granted: np.ndarray = np.zeros(mode.shape, dtype=bool)
+        after_break: np.ndarray = np.zeros(mode.shape, dtype=bool)
+        wait_start: np.ndarray = np.zeros(mode.shape, dtype=int)
+        queue_key: np.ndarray = np.zeros(mode.shape, dtype=np.int64)
+        charge_end: np.ndarray = np.zeros(mode.shape, dtype=int)
+        users: np.ndarray = np.zeros(scenarios, dtype=int)
+        previous_users: np.ndarray = np.zeros(scenarios, dtype=int)
+        queue_soc: np.ndarray = np.zeros(mode.shape)
+
+        # Headroom under the grid limit in kWh per second for the charging of the throttled scenarios, infinite for the others
+        throttled: bool = bool((self.capped | self.valley).any())
+        if throttled:
+            headroom: np.ndarray = np.full((scenarios, horizon), np.inf)
+            headroom[self.capped] = self.grid_limit[self.capped, None]
+            headroom[self.valley] = (self.grid_limit - self.base_load)[self.valley, None] - self.cable_power[self.valley, :horizon]
+            headroom = np.maximum(headroom, 0)/3600
+
+        peak_power: np.ndarray = self.base_load.copy()
+        sum_power: np.ndarray = self.base_load.copy()
+        sum_active: np.ndarray = np.zeros(scenarios)
+        if keep_power:
+            power_series: np.ndarray = np.full((scenarios, horizon), np.nan)
+            power_series[:, 0] = self.base_load
+        if keep_series:
+            active_series: np.ndarray = np.full((scenarios, horizon), np.nan)
+            level_series: np.ndarray = np.full((scenarios, machines, horizon), np.nan, dtype=np.float32)
+            level_series[:, :, 0] = np.where(mode != IDLE, level, np.nan)
+
+        for time in range(1, horizon + 1):
+            alive: np.ndarray = (time < self.workday)[:, None]
+            operating: np.ndarray = (mode == OPERATING) & alive
+            queued: np.ndarray = (mode == QUEUED) & alive
+
+            # Charging machines fill up and the ones done with their charge release the charger, throttled chargers share the headroom
+            charging: np.ndarray = (mode == CHARGING) & alive
+            num_charging: np.ndarray = np.count_nonzero(charging, axis=1)
+            charging_power: np.ndarray = self.charging_power
+            if throttled:
+                charging_power = np.minimum(self.charging_power, headroom[:, min(time, horizon - 1)]/np.maximum(num_charging, 1))
+            level = np.where(charging & (level + charging_power[:, None] < self.capacity), level + charging_power[:, None], level)
+            ending: np.ndarray = charging & (charge_end == time)
+            mode[ending] = OPERATING
+            granted &= ~ending
+            users -= np.count_nonzero(ending, axis=1)
+
+            # Operating machines, a break starts a charge while others check the threshold
+            at_break: np.ndarray = ((time == self.break_1) | (time == self.break_2))[:, None]
+            break_request: np.ndarray = operating & at_break
+            check: np.ndarray = (operating & ~at_break) | (ending & after_break)
+            draw, per_second, tail_check = self.power_ratio(phase)
+            above: np.ndarray = level > self.threshold
+            level = np.where(check & above, np.maximum(level - draw, 0), level)
+            threshold_request: np.ndarray = check & ~above & (time < no_charging)[:, None]
+            tail: np.ndarray = check & ~above & (time >= no_charging)[:, None]
+            tail_draw: np.ndarray = tail & (level > tail_check)
+            level = np.where(tail_draw, np.maximum(level - per_second, 0), level)
+            empty: np.ndarray = np.count_nonzero(tail & ~tail_draw, axis=1)
+            phase = np.where(check, (phase + 1) % self.cycle, phase)
+
+            # Queued machines keep working, excavators start their cycle over while waiting. Once granted they hold the
+            # charger and count as inactive through the users, not as empty
+            if queued.any():
+                draw, per_second, _ = self.power_ratio((time - 1 - wait_start) % self.cycle)
+                wait_draw: np.ndarray = queued & (level > per_second)
+                level = np.where(wait_draw, np.maximum(level - draw, 0), level)
+                empty += np.count_nonzero(queued & ~granted & ~wait_draw, axis=1)
+
+            # New requests join the queue, free chargers go to the earliest requests
+            requests: np.ndarray = break_request | threshold_request
+            if requests.any():
+                after_break = np.where(requests, break_request, after_break)
+                mode[requests] = QUEUED
+                wait_start[requests] = time
+                queue_key[requests] = time*machines + np.broadcast_to(index, mode.shape)[requests]
+                queue_soc[requests] = np.where(self.by_soc[:, None], np.round(level/np.where(self.capacity > 0, self.capacity, 1), SOC_DECIMALS), 0)[requests]
+
+            waiting: np.ndarray = (mode == QUEUED) & ~granted & alive
+            free: np.ndarray = self.num_chargers - users
+            if (waiting.any(axis=1) & (free > 0)).any():
+                order: np.ndarray = np.argsort(np.where(waiting, queue_key, np.iinfo(np.int64).max), axis=1, kind="stable")
+                if self.by_soc.any():
+                    # Lowest state of charge first, the same state of charge in order of request
+                    order = order[rows, np.argsort(np.where(waiting, queue_soc, np.inf)[rows, order], axis=1, kind="stable")]
+                rank: np.ndarray = np.empty_like(order)
+                rank[rows, order] = index
+                new_grants: np.ndarray = waiting & (rank < free[:, None])
+                granted |= new_grants
+                users += np.count_nonzero(new_grants, axis=1)
+
+            starting: np.ndarray = (mode == QUEUED) & granted & ((time - wait_start) % self.cycle == 0)
+            mode[starting] = CHARGING
+            charge_end = np.where(starting, time + self.break_duration[:, None], charge_end)
+
+            # The inactive machines of the previous second are known once the empty batteries have been counted
+            previous: int = time - 1
+            in_break: np.ndarray = (((self.break_1 < previous) & (previous < self.break_1 + self.break_duration)) | 
+                                    ((self.break_2 < previous) & (previous < self.break_2 + self.break_duration)))
+            active: np.ndarray = self.total_machines - previous_users - empty - np.where(in_break, self.num_ex_c, 0)
+            finished: np.ndarray = time <= self.workday
+            sum_active += np.where(finished, active, 0)
+            previous_users = users.copy()
+
+            if time < horizon:
+                power: np.ndarray = self.base_load + self.cable_power[:, time] + num_charging*charging_power*3600
+                peak_power = np.where(alive[:, 0], np.maximum(peak_power, power), peak_power)
+                sum_power += np.where(alive[:, 0], power, 0)
+                if keep_power:
+                    power_series[:, time] = np.where(alive[:, 0], power, np.nan)
+                if keep_series:
+                    level_series[:, :, time] = np.where(alive & (mode != IDLE), level, np.nan)
+            if keep_series:
+                active_series[:, previous] = np.where(finished, active, np.nan)
+
+        self.mode, self.level, self.phase = mode, level, phase
+        mean_power: np.ndarray = sum_power/self.workday
+        total_work_hours: np.ndarray = self.total_machines*8
+        results: dict = {"name": self.names, 
+                         "peak_power": peak_power, 
+                         "average_power": mean_power, 
+                         "energy": mean_power*9, 
+                         "productivity": 1 - (total_work_hours - sum_active/3600)/total_work_hours}
+        if keep_power:
+            results["power"] = power_series
+        if keep_series:
+            results.update({"active_machines": active_series, "battery_levels": level_series})
+        return results
+
+    def run_coarse(self, time_step: int) -> dict:
+        # The same model as run in steps of time_step seconds, to screen many scenarios before running the promising ones 
+        # second by second. Breaks, charger grants and the start and end of every charge happen at their exact second and 
+        # the draw of a step is summed from the prefix sums of the duty cycle. Approximated are the second a battery 
+        # reaches the threshold (spread evenly over the step), the machines running empty after the charging cutoff and 
+        # the charge of throttled machines. The grid power is added up per second with the share of the headroom of every 
+        # second, the machines that keep or start charging fill up with the mean of those shares over the seconds they
+        # charge, and the ones finishing their charge in the step with the mean headroom split between the machines 
+        # charging at its start
+        scenarios, machines = self.level.shape
+        horizon: int = int(self.workday.max())
+        if time_step > min(self.break_duration.min(), np.abs(self.break_2 - self.break_1).min()):
+            raise ValueError(f"The time step of {time_step} s is longer than a break or the time between the breaks.")
+        index: np.ndarray = np.broadcast_to(np.arange(machines)[None, :], self.level.shape)
+        rows: np.ndarray = np.arange(scenarios)[:, None]
+        no_charging: np.ndarray = (self.workday - 1800)[:, None]
+        duration: np.ndarray = self.break_duration[:, None]
+        latest: int = np.iinfo(np.int64).max // 4
+
+        # Battery draw, draw without the minimum and check after the charging cutoff at every position of the cycle of every 
+        # machine, and the prefix sums of the draw so the draw from any position over any number of seconds is found in O(1)
+        cycle: np.ndarray = self.cycle
+        positions: np.ndarray = np.arange(cycle.max())
+        in_cycle: np.ndarray = positions < cycle[..., None]
+        power: np.ndarray = (self.table[self.offset[..., None] + (np.minimum(positions, cycle[..., None] - 1)*self.length[..., None])//cycle[..., None]]*
+                             self.excavator_power[..., None] + self.constant_power[..., None])
+        per_second: np.ndarray = np.where(in_cycle, power/3600, 0)
+        tail_check: np.ndarray = np.where(in_cycle, power*self.tail_scale[..., None], np.inf)
+        drawn: np.ndarray = np.concatenate((np.zeros(self.level.shape + (1,)), 
+                                            np.cumsum(np.where(in_cycle, np.maximum(per_second, self.minimum_draw[..., None]), 0), axis=2)), axis=2)
+        per_cycle: np.ndarray = np.take_along_axis(drawn, cycle[..., None], axis=2)[..., 0]
+        row_start: np.ndarray = np.arange(scenarios*machines).reshape(self.level.shape)*drawn.shape[2]
+        drawn = drawn.ravel()
+
+        def draw(position: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+            cycles, end = np.divmod(position + seconds, cycle)
+            return cycles*per_cycle + drawn[row_start + end] - drawn[row_start + position]
+
+        mode, level, phase = self.mode, self.level, self.phase
+        granted: np.ndarray = np.zeros(mode.shape, dtype=bool)
+        after_break: np.ndarray = np.zeros(mode.shape, dtype=bool)
+        wait_start: np.ndarray = np.zeros(mode.shape, dtype=int)
+        queue_key: np.ndarray = np.zeros(mode.shape, dtype=np.int64)
+        queue_soc: np.ndarray = np.zeros(mode.shape)
+        grant_time: np.ndarray = np.zeros(mode.shape, dtype=int)
+        charge_start: np.ndarray = np.zeros(mode.shape, dtype=int)
+        charge_end: np.ndarray = np.zeros(mode.shape, dtype=int)
+
+        throttled: bool = bool((self.capped | self.valley).any())
+        if throttled:
+            headroom: np.ndarray = np.full((scenarios, horizon), np.inf)
+            headroom[self.capped] = self.grid_limit[self.capped, None]
+            headroom[self.valley] = (self.grid_limit - self.base_load)[self.valley, None] - self.cable_power[self.valley, :horizon]
+            headroom = np.maximum(headroom, 0)/3600
+
+        other_power: np.ndarray = self.base_load[:, None] + np.concatenate((self.cable_power, np.zeros((scenarios, time_step))), axis=1)
+        full_share: np.ndarray = np.broadcast_to(self.charging_power[:, None], mode.shape)
+        offsets: np.ndarray = np.arange(1, time_step + 1)
+        step_row: np.ndarray = rows*(time_step + 1)
+        peak_power: np.ndarray = self.base_load.copy()
+        sum_power: np.ndarray = self.base_load.copy()
+        held_seconds: np.ndarray = np.zeros(scenarios)
+        empty_seconds: np.ndarray = np.zeros(scenarios)
+
+        def charged(level: np.ndarray, seconds: np.ndarray, share: np.ndarray) -> np.ndarray:
+            # A charger adds its share every second as long as the battery stays below its capacity, like run
+            puts: np.ndarray = np.maximum(np.ceil((self.capacity - level)/share) - 1, 0)
+            return level + share*np.minimum(seconds, puts)
+
+        for t in range(0, horizon - 1, time_step):
+            # The step covers the seconds t + 1 to end, a break in it starts at brk
+            end: np.ndarray = np.maximum(np.minimum(t + time_step, self.workday - 1), t)[:, None]
+            brk: np.ndarray = np.where((t < self.break_1) & (self.break_1 <= end[:, 0]), self.break_1, 
+                                       np.where((t < self.break_2) & (self.break_2 <= end[:, 0]), self.break_2, latest))[:, None]
+
+            # The machines done with their charge release the charger, they fill up first since they work again in the step.
+            # With throttled chargers they get the mean headroom of the step split between the machines charging at its 
+            # start. The others fill up with the mean of the per-second shares once the chargers of every second are known
+            charging: np.ndarray = mode == CHARGING
+            share: np.ndarray = full_share
+            if throttled:
+                span: np.ndarray = np.minimum(t + offsets, horizon - 1)
+                share = np.minimum(self.charging_power, headroom[:, span].mean(axis=1)/np.maximum(np.count_nonzero(charging, axis=1), 1))
+                share = np.broadcast_to(np.where(share > 0, share, 1e-12)[:, None], mode.shape)
+            ending: np.ndarray = charging & (charge_end <= end)
+            charges: list[tuple] = []
+            if charging.any():
+                level = np.where(ending, charged(level, charge_end - t, share), level)
+                charges.append((np.zeros_like(charge_end), np.where(charging, np.minimum(charge_end, end) - t, 0)))
+            free: np.ndarray = self.num_chargers - np.count_nonzero(granted, axis=1)
+            if granted.any():
+                held: np.ndarray = granted & (grant_time <= t)
+                held_seconds += np.sum(np.where(held, np.where(ending, charge_end - 1, end) - t, 0), axis=1)
+                mode[ending] = OPERATING
+                granted &= ~ending
+
+            # Operating machines draw up to the break or until they reach the threshold, a machine coming back from a charge 
+            # starts the second after it, or right away after a break
+            operating: np.ndarray = mode == OPERATING
+            start: np.ndarray = np.where(ending, charge_end - after_break, t)
+            last: np.ndarray = np.where((start < brk) & (brk <= end), brk - 1, end)
+            seconds: np.ndarray = np.where(operating, np.maximum(last - start, 0), 0)
+            above: np.ndarray = level > self.threshold
+            full: np.ndarray = draw(phase, seconds)
+            crossing: np.ndarray = operating & above & (full >= level - self.threshold)
+            drawing: np.ndarray = np.where(operating & above, seconds, 0)
+            level = level - np.where(drawing > 0, full, 0)
+            if crossing.any():
+                # The threshold is reached after the share of the step the draw above it takes
+                drawing = np.where(crossing, np.minimum(np.maximum(np.ceil(seconds*(level + full - self.threshold)/np.where(full > 0, full, 1)), 1), seconds).astype(int), drawing)
+                level = np.where(crossing, level + full - draw(phase, drawing), level)
+            check: np.ndarray = start + drawing + 1
+            below: np.ndarray = operating & (check <= last)
+            threshold_request: np.ndarray = below & (check < no_charging)
+            tail: np.ndarray = below & (check >= no_charging)
+            phase = (phase + drawing + threshold_request) % cycle
+            if tail.any():
+                # After the charging cutoff a machine below the threshold works as long as its battery lasts, the positions
+                # of the cycle it can still run are taken as evenly spread over the rest of the step
+                seconds = np.where(tail, last - check + 1, 0)
+                usable: np.ndarray = in_cycle & (tail_check < level[..., None])
+                count: np.ndarray = np.count_nonzero(usable, axis=2)
+                mean_draw: np.ndarray = np.sum(np.where(usable, per_second, 0), axis=2)/np.maximum(count, 1)
+                lasting: np.ndarray = np.where(mean_draw > 0, np.ceil(level/np.where(mean_draw > 0, mean_draw, 1)) - 1, seconds)
+                working: np.ndarray = np.clip(np.minimum(np.rint(seconds*count/cycle), lasting), 0, seconds).astype(int)
+                level = np.where(tail, level - working*mean_draw, level)
+                empty_seconds += np.sum(seconds - working, axis=1)
+                phase = np.where(tail, (phase + seconds) % cycle, phase)
+            break_request: np.ndarray = operating & (brk <= end) & (brk > start) & ~threshold_request
+
+            # New requests join the queue and free chargers go to the earliest requests, a charger released during the step
+            # is free from the second the charge ends
+            requests: np.ndarray = break_request | threshold_request
+            if requests.any():
+                request_time: np.ndarray = np.where(threshold_request, check, brk)
+                after_break = np.where(requests, break_request, after_break)
+                mode[requests] = QUEUED
+                wait_start = np.where(requests, request_time, wait_start)
+                queue_key = np.where(requests, request_time*machines + index, queue_key)
+                queue_soc = np.where(requests & self.by_soc[:, None], np.round(level/np.where(self.capacity > 0, self.capacity, 1), SOC_DECIMALS), queue_soc)
+
+            waiting: np.ndarray = (mode == QUEUED) & ~granted
+            if waiting.any():
+                order: np.ndarray = np.argsort(np.where(waiting, queue_key, np.iinfo(np.int64).max), axis=1, kind="stable")
+                if self.by_soc.any():
+                    # Lowest state of charge first among the machines waiting at the same time
+                    order = order[rows, np.argsort(np.where(waiting, queue_soc, np.inf)[rows, order], axis=1, kind="stable")]
+                    order = order[rows, np.argsort(np.where(waiting, np.where(self.by_soc[:, None], np.maximum(wait_start, t + 1), 0), latest)[rows, order], axis=1, kind="stable")]
+                rank: np.ndarray = np.empty_like(order)
+                rank[rows, order] = index
+                released: np.ndarray = np.sort(np.where(ending, charge_end, latest), axis=1)
+                later: np.ndarray = rank - free[:, None]
+                free_from: np.ndarray = np.where(later < 0, t + 1, released[rows, np.clip(later, 0, machines - 1)])
+                free_from = np.where(later < machines, free_from, latest)
+                grant: np.ndarray = np.maximum(wait_start, free_from)
+                new_grants: np.ndarray = waiting & (grant <= end)
+                granted |= new_grants
+                grant_time = np.where(new_grants, grant, grant_time)
+                charge_start = np.where(new_grants, wait_start + -(-(grant - wait_start)//cycle)*cycle, charge_start)
+                held_seconds += np.sum(np.where(new_grants, np.minimum(charge_start + duration - 1, end) - grant + 1, 0), axis=1)
+
+            # Queued machines keep working until their charge starts, excavators start their cycle over while waiting. From
+            # the grant they hold the charger and are not counted as empty as well
+            queued: np.ndarray = mode == QUEUED
+            if queued.any():
+                first: np.ndarray = np.maximum(wait_start, t)
+                seconds = np.where(queued, np.maximum(np.where(granted, np.minimum(charge_start, end), end) - first, 0), 0)
+                waited: np.ndarray = draw((first - wait_start) % cycle, seconds)
+                lasting = np.where(waited < level, seconds, np.floor(seconds*level/np.where(waited > 0, waited, 1)))
+                level = np.where(queued, level - waited*lasting/np.maximum(seconds, 1), level)
+                unheld: np.ndarray = np.minimum(seconds, np.where(granted, grant_time - first, seconds))
+                empty_seconds += np.sum(np.where(queued, np.maximum(unheld - lasting, 0), 0), axis=1)
+
+            starting: np.ndarray = queued & granted & (charge_start <= end)
+            if starting.any():
+                mode[starting] = CHARGING
+                charge_end = np.where(starting, charge_start + duration, charge_end)
+                charges.append((np.where(starting, charge_start - t, 0), np.where(starting, np.minimum(charge_end, end) - t, 0)))
+
+            # Grid power of every second of the step, a machine charges from the second after the start to its end
+            power = other_power[:, t + 1:t + 1 + time_step]
+            if charges:
+                # Charges that start at low and end at high as +1 and -1 at those offsets, summed up along the step
+                changes: np.ndarray = np.zeros(scenarios*(time_step + 1))
+                for low, high in charges:
+                    changes += (np.bincount((step_row + low)[low < high], minlength=len(changes)) - 
+                                np.bincount((step_row + high)[low < high], minlength=len(changes)))
+                chargers: np.ndarray = np.cumsum(changes.reshape(scenarios, -1), axis=1)[:, :time_step]
+                second_share: np.ndarray = self.charging_power[:, None]
+                if throttled:
+                    second_share = np.minimum(self.charging_power[:, None], headroom[:, span]/np.maximum(chargers, 1))
+                power = power + chargers*second_share*3600
+
+                # The other charging machines fill up with the mean share of the seconds they charge in the step
+                filling: np.ndarray = (charging & ~ending) | starting
+                low: np.ndarray = np.where(starting, charge_start - t, 0)
+                seconds = np.where(filling, np.minimum(charge_end, end) - t - low, 0)
+                if throttled:
+                    shared: np.ndarray = np.concatenate((np.zeros((scenarios, 1)), np.cumsum(second_share, axis=1)), axis=1)
+                    mean_share: np.ndarray = (shared[rows, low + seconds] - shared[rows, low])/np.maximum(seconds, 1)
+                    share = np.where(self.capped[:, None] | self.valley[:, None], np.where(mean_share > 0, mean_share, 1e-12), full_share)
+                level = np.where(filling, charged(level, seconds, share), level)
+            if (end < t + time_step).any():
+                alive: np.ndarray = offsets <= end - t
+                power = np.where(alive, power, np.nan)
+            peak_power = np.fmax(peak_power, np.nanmax(power, axis=1))
+            sum_power += np.nansum(power, axis=1)
+
+        self.mode, self.level, self.phase = mode, level, phase
+        # Machines that are not holding a charger, have a battery and the cable excavators outside the breaks are active
+        seconds: np.ndarray = np.arange(horizon)
+        in_break: np.ndarray = (((self.break_1[:, None] < seconds) & (seconds < (self.break_1 + self.break_duration)[:, None])) | 
+                                ((self.break_2[:, None] < seconds) & (seconds < (self.break_2 + self.break_duration)[:, None])))
+        break_seconds: np.ndarray = np.count_nonzero(in_break & (seconds < self.workday[:, None]), axis=1)
+        sum_active: np.ndarray = self.total_machines*self.workday - held_seconds - empty_seconds - self.num_ex_c*break_seconds
+        mean_power: np.ndarray = sum_power/self.workday
+        total_work_hours: np.ndarray = self.total_machines*8
+        return {"name": self.names, 
+                "peak_power": peak_power, 
+                "average_power": mean_power, 
+                "energy": mean_power*9, 
+                "productivity": 1 - (total_work_hours - sum_active/3600)/total_work_hours}
+
+def machine_rows(machine_settings) -> list[dict]:
+    # machine_settings as one dict per row, looking up a few machines in them is much faster than in the DataFrame
+    return machine_settings if isinstance(machine_settings, list) else machine_settings.to_dict("records")
+
+def scenario_config(simulation_row, machine_settings) -> dict:
+    # Settings of one row in simulation_settings with the machine configs of its size, machine_settings is the 
+    # DataFrame or its rows from machine_rows
+    size_setting: str = simulation_row["size_setting"]
+    machines: list[dict] = machine_rows(machine_settings)
+
+    def machine_config(prefix: str, per_second: bool) -> dict:
+        config: dict = next((machine for machine in machines if machine["machine_id"] == prefix+size_setting), None)
+        if config is None:
+            raise ValueError(f"There is no machine {prefix+size_setting} in machine_settings.")
+        operating_power: float = config["operating_power"]
+        return {'battery_capacity': config["battery_capacity"], 'operating_power': operating_power/3600 if per_second else operating_power}
+
+    return {"name": simulation_row["name"], 
+            "size_setting": str(size_setting), 
+            "workday": int(simulation_row["workday"]), 
+            "break_1": int(simulation_row["break_1"]), 
+            "break_2": int(simulation_row["break_2"]), 
+            "break_duration": int(simulation_row["break_duration"]), 
+            "num_chargers": int(simulation_row["num_chargers"]), 
+            "charging_power": float(simulation_row["charging_power"]), 
+            "charging_threshold": float(simulation_row["charging_threshold"])/100, 
+            "charging_policy": charging_policy(simulation_row), 
+            "grid_limit": grid_limit(simulation_row), 
+            "base_load": float(simulation_row["base_load"]), 
+            "num_wl": int(simulation_row["num_wheel_loaders"]), 
+            "num_ex_b": int(simulation_row["num_excavators_battery"]), 
+            "num_ex_c": int(simulation_row["num_excavators_cable"]), 
+            "num_du": int(simulation_row["num_dumpers"]), 
+            "wl_config": machine_config("wl_", True), 
+            "ex_config": machine_config("ex_", False), 
+            "du_config": machine_config("du_", True), 
+            "other_machines": other_machine_configs(simulation_row, machines)}
+
+def charging_policy(simulation_row) -> str:
+    # Optional charging_policy column of simulation_settings, first come first served at full power without it
+    policy = simulation_row.get("charging_policy")
+    return "fifo" if policy is None or pd.isna(policy) else str(policy).strip().lower()
+
+def grid_limit(simulation_row) -> float:
+    # Optional grid_limit column of simulation_settings in kW, used by the capped and valley charging policies
+    limit = simulation_row.get("grid_limit")
+    return None if limit is None or pd.isna(limit) else float(limit)
+
+def other_machine_configs(simulation_row, machine_settings) -> list[dict]:
+    # Machine kinds in machine_settings besides excavators, dump trucks and wheel loaders, e.g. tr_lar for trucks. 
+    # A scenario has num_<prefix> of them, 0 without the column, and they follow the power profile if their duty_cycle 
+    # is "epp" and draw their operating power constantly otherwise
+    size_setting: str = simulation_row["size_setting"]
+    groups: list[dict] = []
+    for row in machine_rows(machine_settings):
+        prefix, _, size = row["machine_id"].rpartition("_")
+        if prefix in ("ex", "du", "wl") or size != size_setting:
+            continue
+        count = simulation_row.get(f"num_{prefix}", 0)
+        profile: bool = str(row.get("duty_cycle", "constant")).strip().lower() == "epp"
+        groups.append({"prefix": prefix.upper(), "count": 0 if pd.isna(count) else int(count), "profile": profile, 
+                       "config": {"battery_capacity": row["battery_capacity"], 
+                                  "operating_power": row["operating_power"] if profile else row["operating_power"]/3600}})
+    return groups
+
+def prepare_data(site: worksite, base_load: float) -> tuple[dict, np.ndarray, np.ndarray]:
+    # Battery levels by machine, grid power and active machines at every second of a finished run
+    data = site.data
+    time_array: np.ndarray = np.arange(0, site.workday, 1)
+    num_excavators_cable: int = len(site.excavator_cable)
+    total_machines: int = len(data.machine_ids) + num_excavators_cable
+
+    battery_levels_by_machine: dict[str, np.ndarray] = data.battery_levels_by_machine()
+    grid_power: np.ndarray = data.power + base_load
+
+    on_break: np.ndarray = (((time_array > site.break_1) & (time_array < site.break_1 + site.break_duration)) | 
+                            ((time_array > site.break_2) & (time_array < site.break_2 + site.break_duration)))
+    active_machines: np.ndarray = total_machines - data.inactive_machines - np.where(on_break, num_excavators_cable, 0)
+
+    return battery_levels_by_machine, grid_power, active_machines
+
+def run_simulation(simulation_settings, machine_settings, epp, engine="step", productivity_target=None, resolution=1, instrument=None, 
+                   initial_state=None, keep_power=False) -> dict:
+    # Runs one scenario and returns its results and series, nothing is written or plotted so it can run in a worker process.
+    # With a productivity target the run is aborted as soon as the target can not be reached, the KPIs are then not known.
+    # A resolution above 1 second returns the series as min/max/mean buckets and None only returns the KPIs, or the KPIs
+    # and the grid power of every second with keep_power.
+    # With instrument the counters and samples taken every that many seconds are returned under "instrumentation".
+    # The worksite starts from initial_state if given, and its state at the end of the workday is returned under "end_state"
     env = simpy.Environment()
     simulation_name: str = simulation_settings["name"].iloc[0]
     size_setting: str = simulation_settings["size_setting"].iloc[0]
@@ -198,101 +1450,10 @@ def simulation(simulation_settings, machine_settings, epp, save, show, grid):
     num_excavators_battery: int = simulation_settings["num_excavators_battery"].iloc[0]
     num_excavators_cable: int = simulation_settings["num_excavators_cable"].iloc[0]
     num_dumpers: int = simulation_settings["num_dumpers"].iloc[0]
-    total_machines: int = num_wheel_loaders + num_dumpers + num_excavators_battery + num_excavators_cable
-
-    def prepare_data(data) -> tuple[list, list, list]:
-        battery_levels: tuple = data["battery_levels"]
-
-        battery_levels_by_machine: dict[str, tuple] = {}
-        for time, machine_id, level in battery_levels:
-            if machine_id not in battery_levels_by_machine:
-                battery_levels_by_machine[machine_id] = []
-            battery_levels_by_machine[machine_id].append((time, level))
-
-        grid_power_list: list[int] = []
-        for t in time_array:
-            grid_power_list.append(data['power'].get(t, 0) + base_load)
-
-        active_machines: list[int] = []
-        for t in time_array:
-            if t > break_1 and t < break_1 + break_duration:
-                active_machines.append(total_machines - num_excavators_cable - data["inactive_machines"][t])
-            elif t > break_2 and t < break_2 + break_duration:
-                active_machines.append(total_machines - num_excavators_cable - data["inactive_machines"][t])
-            else:
-                active_machines.append(total_machines - data["inactive_machines"][t])
-
-        return battery_levels_by_machine, grid_power_list, active_machines
-
-    def plot_data(battery_levels_by_machine: dict, grid_power_list: list, active_machines: list) -> None:    
-        plt.style.use('leostyle2.mplstyle')
-
-        def adjust_prop_cycler():
-            current_cycler = plt.rcParams['axes.prop_cycle']
-            color_cycle = current_cycler.by_key()['color']
-            linestyle_cycle = current_cycler.by_key()['linestyle']
-            
-            skipped_color_cycle = color_cycle[2:] + color_cycle[:2]
-            skipped_linestyle_cycle = linestyle_cycle[2:] + linestyle_cycle[:2]
-            
-            combined_cycler = cycler('color', skipped_color_cycle) + cycler('linestyle', skipped_linestyle_cycle)
-            return combined_cycler
-
-        def plot_setup(title: str, type: str, xlabel: str, ylabel: str, x_ticks: np.ndarray, formatter) -> None:
-            plt.title(title)
-            plt.xlabel(xlabel)
-            plt.ylabel(ylabel)
-            plt.xticks(x_ticks, rotation = 45)
-            plt.gca().xaxis.set_major_formatter(FuncFormatter(formatter))
-            plt.ylim(bottom=0)
-            if type == "POW" and title[5:8] == "150" and title[0:3] == "MED":
-                plt.ylim(top=1000)
-            elif type == "POW" and title[5:8] == "150" and title[0:3] == "LAR":
-                plt.ylim(top=1200)
-            elif type == "POW" and title[5:8] == "350":
-                plt.ylim(top=2200)
-            plt.tight_layout()
-            
-            if not os.path.exists("./figs_simulation/"):
-                os.makedirs("./figs_simulation/")
-                print("Directory '{./figs_simulation/}' created.")
-            else:
-                pass
-            
-            if save == True:
-                plt.savefig(f"./figs_simulation/{simulation_name}_{type}.png", dpi=300)
-                if show == False:
-                    plt.clf()
-            if show == True:
-                plt.show()
-
-        # Plot battery levels
-        if num_excavators_battery == 0:
-            new_cycle = adjust_prop_cycler()
-            plt.rc('axes', prop_cycle=new_cycle)
-
-        for machine_id, levels in battery_levels_by_machine.items():
-            times, battery_levels = zip(*levels)
-            plt.plot(times, battery_levels, label=f"{machine_id}")
-        plt.legend()
-        plot_setup(f"{simulation_name}, SoC over time", "BAT", "Time", "SoC [kWh]", x_ticks, ticks_to_time)
-
-        # Plot power usage
-        plt.style.use('leostyle2.mplstyle')
-        plt.plot(time_array, grid_power_list)
-        plt.axhline(y=mean_power, c = "k", alpha = 0.5, ls = '--', lw = 3, label = "Average power")
-        plt.legend(loc = "lower left")
-        plot_setup(f"{simulation_name}, power over time", "POW", "Time", "Power [kW]", x_ticks, ticks_to_time)
-
-        # Plot active machines
-        plt.plot(time_array, active_machines)
-        plot_setup(f"{simulation_name}, active machines over time", "ACT", "Time", "# active machines", x_ticks, ticks_to_time)
+    other_machines: list[dict] = other_machine_configs(simulation_settings.iloc[0], machine_settings)
+    total_machines: int = (num_wheel_loaders + num_dumpers + num_excavators_battery + num_excavators_cable + 
+                           sum(group["count"] for group in other_machines))
 
-    def ticks_to_time(x: int, pos) -> str:
-        hours: int = int((x+start_time) // 3600)
-        minutes: int = int(((x+start_time) % 3600) // 60)
-        return f'{hours:02d}:{minutes:02d}'
-    
     # Machine config
     df_excavator_conf = machine_settings.loc[machine_settings["machine_id"] == "ex_"+size_setting]
     df_wheel_loader_conf = machine_settings.loc[machine_settings["machine_id"] == "wl_"+size_setting]
@@ -303,45 +1464,546 @@ def simulation(simulation_settings, machine_settings, epp, save, show, grid):
     dumper_conf: dict = {'battery_capacity': df_dumper_conf["battery_capacity"].iloc[0], 'operating_power': df_dumper_conf["operating_power"].iloc[0]/3600}
 
     # Creating worksite
-    worksite_instance: worksite = worksite(env, epp=epp, num_chargers=num_chargers, charging_power=charging_power, charging_threshold=charging_threshold,
+    worksite_instance: worksite = worksite(env, epp=epp.for_size(size_setting) if isinstance(epp, power_profile) else epp, num_chargers=num_chargers, charging_power=charging_power, charging_threshold=charging_threshold,
                                            num_du=num_dumpers, num_ex_b=num_excavators_battery, num_ex_c=num_excavators_cable, num_wl=num_wheel_loaders, 
                                            workday=workday, break_1=break_1, break_2=break_2, break_duration=break_duration, 
-                                           wl_config=wheel_loader_conf, ex_config=excavator_conf, du_config=dumper_conf)
+                                           wl_config=wheel_loader_conf, ex_config=excavator_conf, du_config=dumper_conf, engine=engine, 
+                                           productivity_target=productivity_target, resolution=resolution, instrument=instrument, 
+                                           initial_state=initial_state, other_machines=other_machines, 
+                                           charging_policy=charging_policy(simulation_settings.iloc[0]), 
+                                           grid_limit=grid_limit(simulation_settings.iloc[0]), base_load=base_load)
 
     env.run(until=workday)
+    worksite_instance.finish()
 
-    time_array: np.ndarray = np.arange(0, workday, 1)
-    x_ticks: np.ndarray = np.arange(0, workday+1, 3600)
-
-    battery_levels, total_power, active_machines = prepare_data(worksite_instance.data)
-    sum_machines = sum(active_machines)
+    if resolution == 1:
+        battery_levels, total_power, active_machines = prepare_data(worksite_instance, base_load)
+        sum_machines = np.sum(active_machines)
+        peak_power, mean_power = np.max(total_power), np.mean(total_power)
+    else:
+        sum_machines = worksite_instance.active_machine_seconds(0, workday)
+        peak_power, mean_power = np.max(worksite_instance.data.power) + base_load, np.mean(worksite_instance.data.power) + base_load
     total_work_hours = total_machines*8
     total_worked_hours = sum_machines/3600
     missed_hours = total_work_hours - total_worked_hours
-    mean_power = np.mean(total_power)
 
-    with open("results.txt", "a") as f:
-        print(f"{simulation_name}", file=f)
-        print(f"Peak power [kW]: {max(total_power):.0f}", file=f)
-        print(f"Average power [kW]: {mean_power:.0f}", file=f)
-        print(f"Total energy demand [kWh]: {mean_power*9:.0f}", file=f)
-        print(f"Productivity: {1-(missed_hours/total_work_hours) :.1%}\n", file=f)
+    result: dict = {"name": simulation_name, 
+                    "workday": workday, 
+                    "start_time": start_time, 
+                    "num_excavators_battery": num_excavators_battery, 
+                    "peak_power": peak_power, 
+                    "average_power": mean_power, 
+                    "energy": mean_power*9, 
+                    "productivity": 1-(missed_hours/total_work_hours), 
+                    "queue_wait": worksite_instance.data.queue_wait_by_machine(), 
+                    "min_battery_level": worksite_instance.data.min_battery_level_by_machine(), 
+                    "end_state": worksite_instance.state()}
+    if resolution == 1:
+        result.update({"battery_levels": battery_levels, "power": total_power, "active_machines": active_machines})
+    elif resolution is not None:
+        # The power and active machines are only reduced to buckets here, the peak power above is still the exact one
+        (levels_min, levels_max, levels_mean), total_power, active_machines = prepare_data(worksite_instance, base_load)
+        _, power_max, power_mean = decimate(total_power, resolution)
+        result.update({"resolution": resolution, "battery_levels": levels_mean, "battery_levels_min": levels_min, 
+                       "battery_levels_max": levels_max, "power": power_mean, "power_max": power_max, 
+                       "active_machines": decimate(active_machines, resolution)[2]})
+    elif keep_power:
+        result["power"] = worksite_instance.data.power + base_load
+    if worksite_instance.instruments is not None:
+        result["instrumentation"] = worksite_instance.instruments.summary(num_chargers)
+    if worksite_instance.aborted is not None:
+        result.update({"aborted": worksite_instance.aborted, "productivity": np.nan})
+    return result
+
+class result_cache():
+    # On-disk cache of simulation results keyed on everything that affects them, the least recently used entries are 
+    # removed when the cache grows above max_size bytes
+    def __init__(self, directory: str = "./.simulation_cache/", max_size: int = 1024**3, refresh: bool = False) -> None:
+        self.directory: str = directory
+        self.max_size: int = max_size
+        self.refresh: bool = refresh
+
+    def key(self, simulation_settings, machine_settings, epp, engine: str) -> str:
+        scenario: dict = {column: simulation_settings[column].iloc[0] for column in simulation_settings.columns}
+        return scenario_key(scenario, machine_records(machine_settings), epp, engine)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key: str) -> dict:
+        if self.refresh or not os.path.isfile(self.path(key)):
+            return None
+        try:
+            with np.load(self.path(key)) as stored:
+                result: dict = {name: stored[name][()] for name in ("name", "workday", "start_time", "num_excavators_battery", 
+                                                                     "peak_power", "average_power", "energy", "productivity")}
+                result["name"] = str(result["name"])
+                result["battery_levels"] = dict(zip(stored["machine_ids"].tolist(), stored["battery_levels"]))
+                result["power"] = stored["power"]
+                result["active_machines"] = stored["active_machines"]
+                result["queue_wait"] = dict(zip(stored["machine_ids"].tolist(), stored["queue_wait"].tolist()))
+                result["min_battery_level"] = dict(zip(stored["machine_ids"].tolist(), stored["min_battery_level"].tolist()))
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(self.path(key))
+        return result
+
+    def put(self, key: str, result: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        levels: dict = result["battery_levels"]
+        temporary: str = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez_compressed(f, machine_ids=np.array(list(levels), dtype=str), 
+                                battery_levels=np.array(list(levels.values()), dtype=np.float32).reshape(len(levels), -1),
+                                queue_wait=np.array([result["queue_wait"][machine_id] for machine_id in levels], dtype=np.int64),
+                                min_battery_level=np.array([result["min_battery_level"][machine_id] for machine_id in levels]),
+                                **{name: value for name, value in result.items() if name not in ("battery_levels", "queue_wait", "min_battery_level", "end_state")})
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        entries: list = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size: int = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+def plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+def machine_records(machine_settings) -> list[dict]:
+    return [{column: plain(value) for column, value in row.items()} for row in machine_settings.sort_values("machine_id").to_dict("records")]
+
+def scenario_key(scenario: dict, machines: list[dict], epp, engine: str) -> str:
+    # Hash of everything that affects the results of a scenario, machines are the records of machine_records
+    content: str = json.dumps({"engine": engine, "version": ENGINE_VERSION, "scenario": {column: plain(value) for column, value in scenario.items()}, 
+                               "machines": machines}, sort_keys=True, default=str)
+    digest = hashlib.sha256(content.encode())
+    if isinstance(epp, power_profile):
+        epp.update_digest(digest)
+    else:
+        digest.update(np.asarray(epp, dtype=float).tobytes())
+    return digest.hexdigest()
+
+# Columns of simulation_settings that can be swept
+SWEEP_PARAMETERS: list[str] = ["num_chargers", "charging_power", "charging_threshold", "num_wheel_loaders", 
+                               "num_excavators_battery", "num_excavators_cable", "num_dumpers", "size_setting", 
+                               "charging_policy", "grid_limit"]
+KPI_COLUMNS: list[str] = ["peak_power", "average_power", "energy", "productivity"]
+
+# Columns of the results store besides the key, the settings of simulation_settings that are not a column are in settings
+STORE_PARAMETERS: list[str] = ["workday", "break_1", "break_2", "break_duration", "start_time", "base_load"] + SWEEP_PARAMETERS
+STORE_TYPES: dict[str, str] = {"base_load": "REAL", "charging_power": "REAL", "charging_threshold": "REAL", "size_setting": "TEXT", 
+                               "charging_policy": "TEXT", "grid_limit": "REAL"}
+STORE_COLUMNS: dict[str, str] = dict({"name": "TEXT", "engine": "TEXT", "created": "TEXT"}, 
+                                     **{parameter: STORE_TYPES.get(parameter, "INTEGER") for parameter in STORE_PARAMETERS}, 
+                                     **{kpi: "REAL" for kpi in KPI_COLUMNS}, 
+                                     queue_wait="REAL", aborted="INTEGER", settings="TEXT", machine_ids="TEXT", resolution="INTEGER")
+SERIES: list[str] = ["battery_levels", "power", "active_machines"]
+
+class results_store():
+    # Results of every run in an SQLite database, one row of settings and KPIs per scenario and engine keyed like the 
+    # result cache. The series of a run are written next to it as .npy files so they can be memory-mapped when read
+    def __init__(self, directory: str = "./results/") -> None:
+        self.directory: str = directory
+        self.connection: sqlite3.Connection = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.join(self.directory, "series"), exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.directory, "results.sqlite"), timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            columns: str = ", ".join(f"{column} {kind}" for column, kind in STORE_COLUMNS.items())
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, {columns})")
+            # Stores written before a column was added get it as NULL
+            existing: set[str] = {row[1] for row in self.connection.execute("PRAGMA table_info(results)")}
+            for column, kind in STORE_COLUMNS.items():
+                if column not in existing:
+                    self.connection.execute(f"ALTER TABLE results ADD COLUMN {column} {kind}")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_name ON results (name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_settings ON results (size_setting, num_chargers, charging_power)")
+            self.connection.commit()
+        return self.connection
+
+    def keys(self) -> set[str]:
+        return {key for key, in self.connect().execute("SELECT key FROM results")}
+
+    def put(self, entries: list[tuple]) -> None:
+        # Entries of (key, scenario, engine, result) where scenario is a row of simulation_settings as a dict, 
+        # all of them are written in one transaction
+        rows: list[tuple] = []
+        created: str = pd.Timestamp.now().isoformat(timespec="seconds")
+        for key, scenario, engine, result in entries:
+            levels = result.get("battery_levels")
+            machine_ids: list = list(levels) if isinstance(levels, dict) else None
+            if machine_ids is not None:
+                self.put_series(key, result)
+            queue_wait: dict = result.get("queue_wait")
+            row: dict = dict({"name": str(result["name"]), "engine": engine, "created": created}, 
+                             **{parameter: plain(scenario.get(parameter)) for parameter in STORE_PARAMETERS}, 
+                             **{kpi: float(result[kpi]) for kpi in KPI_COLUMNS}, 
+                             queue_wait=float(sum(queue_wait.values())) if queue_wait else None, 
+                             aborted=result.get("aborted"), 
+                             settings=json.dumps({column: plain(value) for column, value in scenario.items()}, default=str), 
+                             machine_ids=json.dumps(machine_ids) if machine_ids is not None else None, 
+                             resolution=result.get("resolution", 1) if machine_ids is not None else None)
+            rows.append((key, *row.values()))
+        with self.connect() as connection:
+            connection.executemany(f"INSERT OR REPLACE INTO results (key, {', '.join(STORE_COLUMNS)}) "
+                                   f"VALUES ({', '.join('?'*(len(STORE_COLUMNS) + 1))})", rows)
+
+    def series_path(self, key: str, name: str) -> str:
+        return os.path.join(self.directory, "series", key, f"{name}.npy")
+
+    def put_series(self, key: str, result: dict) -> None:
+        os.makedirs(os.path.dirname(self.series_path(key, "")), exist_ok=True)
+        levels: dict = result["battery_levels"]
+        arrays: dict = {"battery_levels": np.array(list(levels.values()), dtype=np.float32).reshape(len(levels), -1), 
+                        "power": np.asarray(result["power"], dtype=float), "active_machines": np.asarray(result["active_machines"], dtype=float)}
+        for name, values in arrays.items():
+            temporary: str = f"{self.series_path(key, name)}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, values)
+            os.replace(temporary, self.series_path(key, name))
+
+    def load(self, where: str = None, order: str = None, parameters: tuple = ()) -> pd.DataFrame:
+        # Stored rows as a DataFrame, where and order are SQL on the columns of STORE_COLUMNS and the values of the ? in
+        # where are bound from parameters
+        query: str = "SELECT * FROM results" + (f" WHERE {where}" if where else "") + (f" ORDER BY {order}" if order else "")
+        return pd.read_sql_query(query, self.connect(), params=parameters)
+
+    def series(self, key: str) -> dict:
+        # Series of a stored run memory-mapped from disk, battery_levels has one row per machine in machine_ids
+        machine_ids, = self.connect().execute("SELECT machine_ids FROM results WHERE key = ?", (key,)).fetchone()
+        if machine_ids is None:
+            return None
+        series: dict = {name: np.load(self.series_path(key, name), mmap_mode="r") for name in SERIES}
+        series["machine_ids"] = json.loads(machine_ids)
+        return series
+
+def load_results(directory: str = "./results/", where: str = None, order: str = None, parameters: tuple = ()) -> pd.DataFrame:
+    return results_store(directory).load(where, order, parameters)
+
+def store_result(store: results_store, simulation_settings, machine_settings, epp, engine: str, result: dict) -> None:
+    if store is None:
+        return
+    scenario: dict = simulation_settings.iloc[0].to_dict()
+    store.put([(scenario_key(scenario, machine_records(machine_settings), epp, engine), scenario, engine, result)])
+
+def print_query(store: results_store, where: str = None, order: str = None) -> pd.DataFrame:
+    # Compares stored scenarios without simulating them again
+    rows: pd.DataFrame = store.load(where, order)
+    if rows.empty:
+        print("No stored results match.")
+    else:
+        with pd.option_context("display.max_rows", None, "display.width", None):
+            print(rows[["name", "engine"] + SWEEP_PARAMETERS + KPI_COLUMNS + ["queue_wait"]].to_string(index=False))
+    return rows
+
+def cached_simulation(simulation_settings, machine_settings, epp, engine="step", cache: result_cache = None, resolution=1, instrument=None) -> dict:
+    # run_simulation that first looks for the result in the cache, only full resolution results without instrumentation are cached
+    if cache is None or resolution != 1 or instrument is not None:
+        return run_simulation(simulation_settings, machine_settings, epp, engine, resolution=resolution, instrument=instrument)
+
+    key: str = cache.key(simulation_settings, machine_settings, epp, engine)
+    result: dict = cache.get(key)
+    if result is None:
+        result = run_simulation(simulation_settings, machine_settings, epp, engine)
+        cache.put(key, result)
+    return result
+
+def simulation(simulation_settings, machine_settings, epp, save, show, grid, engine="step", cache=None, resolution=1, instrument=None, store=None, 
+               time_step=1, time_step_error=False):
+    if time_step > 1:
+        # Screening run with the batch engine in steps of time_step seconds, only the KPIs are known
+        if grid:
+            raise ValueError("A time step above 1 second only gives the KPIs, there are no series to plot.")
+        run_batch(simulation_settings, machine_settings, epp, store, time_step, time_step_error)
+        return
+    result: dict = cached_simulation(simulation_settings, machine_settings, epp, engine, cache, resolution, instrument)
+    print_results(result["name"], result["peak_power"], result["average_power"], result["productivity"], result["queue_wait"])
+    store_result(store, simulation_settings, machine_settings, epp, engine, result)
+    save_instrumentation(result)
 
     if grid == False:
-        plot_data(battery_levels, total_power, active_machines)
+        if save or show:
+            plot_data(result, save, show)
     else:
-        return battery_levels, total_power, active_machines
+        return result["battery_levels"], result["power"], result["active_machines"]
+
+
+# Resolution the figures are saved with, the series are reduced to two points per pixel column before plotting
+PLOT_DPI: int = 300
+
+def pyplot(headless: bool = False):
+    # matplotlib is only imported once a figure is made, so runs that only need the KPIs do not pay for it.
+    # Figures that are only saved use the non-interactive Agg backend
+    import matplotlib
+    if headless:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+def envelope(values, step: int, columns: int) -> tuple[np.ndarray, np.ndarray]:
+    # Shape-preserving downsampling for plotting, keeps the lowest and highest point of every one of columns buckets 
+    # in the order they occur so peaks and dips are drawn as with every point. Returns the times and the values, 
+    # where a point is step seconds
+    values = np.asarray(values, dtype=float)
+    if len(values) <= 2*columns:
+        return np.arange(len(values))*step, values
+    width: int = -(-len(values) // columns)
+    padded: np.ndarray = np.full(-(-len(values) // width)*width, np.nan)
+    padded[:len(values)] = values
+    buckets: np.ndarray = padded.reshape(-1, width)
+    missing: np.ndarray = np.isnan(buckets)
+    lowest: np.ndarray = np.argmin(np.where(missing, np.inf, buckets), axis=1)
+    highest: np.ndarray = np.argmax(np.where(missing, -np.inf, buckets), axis=1)
+    starts: np.ndarray = np.arange(len(buckets))*width
+    index: np.ndarray = np.column_stack([starts + np.minimum(lowest, highest), starts + np.maximum(lowest, highest)]).ravel()
+    return index*step, values[index]
+
+def plot_data(result: dict, save: bool, show: bool) -> None:    
+    plt = pyplot(headless=not show)
+    from matplotlib.ticker import FuncFormatter
+    from cycler import cycler
+
+    simulation_name: str = result["name"]
+    start_time: int = result["start_time"]
+    mean_power: float = result["average_power"]
+    step: int = result.get("resolution", 1)
+    x_ticks: np.ndarray = np.arange(0, result["workday"]+1, 3600)
+    plt.style.use('leostyle2.mplstyle')
+    columns: int = int(plt.rcParams["figure.figsize"][0]*PLOT_DPI)
+
+    def ticks_to_time(x: int, pos) -> str:
+        hours: int = int((x+start_time) // 3600)
+        minutes: int = int(((x+start_time) % 3600) // 60)
+        return f'{hours:02d}:{minutes:02d}'
+
+    def adjust_prop_cycler():
+        current_cycler = plt.rcParams['axes.prop_cycle']
+        color_cycle = current_cycler.by_key()['color']
+        linestyle_cycle = current_cycler.by_key()['linestyle']
+        
+        skipped_color_cycle = color_cycle[2:] + color_cycle[:2]
+        skipped_linestyle_cycle = linestyle_cycle[2:] + linestyle_cycle[:2]
+        
+        combined_cycler = cycler('color', skipped_color_cycle) + cycler('linestyle', skipped_linestyle_cycle)
+        return combined_cycler
+
+    def plot_setup(title: str, type: str, xlabel: str, ylabel: str, x_ticks: np.ndarray, formatter) -> None:
+        plt.title(title)
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        plt.xticks(x_ticks, rotation = 45)
+        plt.gca().xaxis.set_major_formatter(FuncFormatter(formatter))
+        plt.ylim(bottom=0)
+        if type == "POW" and title[5:8] == "150" and title[0:3] == "MED":
+            plt.ylim(top=1000)
+        elif type == "POW" and title[5:8] == "150" and title[0:3] == "LAR":
+            plt.ylim(top=1200)
+        elif type == "POW" and title[5:8] == "350":
+            plt.ylim(top=2200)
+        plt.tight_layout()
+        
+        if not os.path.exists("./figs_simulation/"):
+            os.makedirs("./figs_simulation/", exist_ok=True)
+            print("Directory '{./figs_simulation/}' created.")
+        else:
+            pass
+        
+        if save == True:
+            plt.savefig(f"./figs_simulation/{simulation_name}_{type}.png", dpi=PLOT_DPI)
+            if show == False:
+                plt.clf()
+        if show == True:
+            plt.show()
+
+    # Plot battery levels
+    if result["num_excavators_battery"] == 0:
+        new_cycle = adjust_prop_cycler()
+        plt.rc('axes', prop_cycle=new_cycle)
+
+    for machine_id, levels in result["battery_levels"].items():
+        plt.plot(*envelope(levels, step, columns), label=f"{machine_id}")
+    plt.legend()
+    plot_setup(f"{simulation_name}, SoC over time", "BAT", "Time", "SoC [kWh]", x_ticks, ticks_to_time)
+
+    # Plot power usage
+    plt.style.use('leostyle2.mplstyle')
+    plt.plot(*envelope(result["power"], step, columns))
+    plt.axhline(y=mean_power, c = "k", alpha = 0.5, ls = '--', lw = 3, label = "Average power")
+    plt.legend(loc = "lower left")
+    plot_setup(f"{simulation_name}, power over time", "POW", "Time", "Power [kW]", x_ticks, ticks_to_time)
+
+    # Plot active machines
+    plt.plot(*envelope(result["active_machines"], step, columns))
+    plot_setup(f"{simulation_name}, active machines over time", "ACT", "Time", "# active machines", x_ticks, ticks_to_time)
+
+def print_results(simulation_name: str, peak_power: float, mean_power: float, productivity: float, queue_wait: dict = None) -> None:
+    print(f"\n{simulation_name}")
+    print(f"Peak power [kW]: {peak_power:.0f}")
+    print(f"Average power [kW]: {mean_power:.0f}")
+    print(f"Total energy demand [kWh]: {mean_power*9:.0f}")
+    if queue_wait and any(queue_wait.values()):
+        longest: str = max(queue_wait, key=queue_wait.get)
+        print(f"Charger queue wait [min]: {sum(queue_wait.values())/60:.0f} in total, longest {longest} with {queue_wait[longest]/60:.0f}")
+    print(f"Productivity: {productivity :.1%}")
+
+def save_instrumentation(result: dict) -> None:
+    if "instrumentation" not in result:
+        return
+    os.makedirs("./instrumentation/", exist_ok=True)
+    with open(f"./instrumentation/{result['name']}.json", "w") as f:
+        json.dump(result["instrumentation"], f, indent=2)
+
+def time_step_engine(time_step: int) -> str:
+    # Engine the results of a time step are stored under, a coarse run is not the same result as the one at 1 second
+    return "batch" if time_step == 1 else f"batch_{time_step}s"
+
+def time_step_errors(coarse: dict, reference: dict) -> dict:
+    # Relative error of the KPIs of a coarse run against the same scenarios at 1 second
+    return {f"{kpi}_error": (np.asarray(coarse[kpi], dtype=float) - reference[kpi])/reference[kpi] for kpi in KPI_COLUMNS}
+
+def event_reference(simulation_settings, machine_settings, epp) -> dict:
+    # KPIs of every scenario with the event engine at 1 second, the reference of the coarse time step errors
+    results: list[dict] = [run_simulation(sim_df, machine_config, epp, "event", resolution=None) 
+                           for sim_df, machine_config in scenario_frames(simulation_settings, machine_settings)]
+    return {kpi: np.array([result[kpi] for result in results], dtype=float) for kpi in KPI_COLUMNS}
+
+def run_batch(simulation_settings, machine_settings, epp, store=None, time_step=1, time_step_error=False) -> pd.DataFrame:
+    # All scenarios with the batch engine, with a time step above 1 second as a coarse screening run and with 
+    # time_step_error also with the event engine at 1 second to report how far the coarse KPIs are off
+    if time_step < 1:
+        raise ValueError(f"The time step has to be at least 1 second, got {time_step}.")
+    scenarios: list[dict] = [scenario_config(sim, machine_settings) for _, sim in simulation_settings.iterrows()]
+    site: batch_worksite = batch_worksite(epp=epp, scenarios=scenarios)
+    results: dict = site.run() if time_step == 1 else site.run_coarse(time_step)
+    if time_step_error and time_step > 1:
+        results.update(time_step_errors(results, event_reference(simulation_settings, machine_settings, epp)))
+    for i, simulation_name in enumerate(results["name"]):
+        print_results(simulation_name, results["peak_power"][i], results["average_power"][i], results["productivity"][i])
+        if "peak_power_error" in results:
+            print(f"Error of the {time_step} s time step: peak power {results['peak_power_error'][i]:+.2%}, "
+                  f"energy {results['energy_error'][i]:+.2%}, productivity {results['productivity_error'][i]:+.2%}")
+    if store is not None:
+        engine: str = time_step_engine(time_step)
+        entries: list[tuple] = []
+        for i, (sim_df, machine_config) in enumerate(scenario_frames(simulation_settings, machine_settings)):
+            scenario: dict = sim_df.iloc[0].to_dict()
+            entries.append((scenario_key(scenario, machine_records(machine_config), epp, engine), scenario, engine, 
+                            {column: results[column][i] for column in ["name"] + KPI_COLUMNS}))
+        store.put(entries)
+    return pd.DataFrame(results)
+
+# Profiles with at least this many samples are handed to worker processes as a memory-mapped file instead of a copy
+SHARED_PROFILE_SAMPLES: int = 1 << 16
+# Files of shared profiles written by this process, removed when it exits
+shared_profile_files: set = set()
+
+@atexit.register
+def remove_shared_profiles() -> None:
+    # Forked workers inherit the set, only the process named in a file removes it
+    for path in list(shared_profile_files):
+        if path.endswith(f"_{os.getpid()}.npy"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            shared_profile_files.discard(path)
+
+class power_profile():
+    # A duty cycle as the fraction of the operating power drawn in every second. Indexing, len and np.asarray work as on
+    # the list of fractions, the engines build the prefix sums of their own battery draw from it.
+    # variants replace the profile for a kind of machine (e.g. "EX") or a single machine (e.g. "EX #2"), configs for 
+    # a machine config of machine_settings (e.g. "ex_lar") and are turned into variants by for_size
+    def __init__(self, ratios, variants: dict = None, configs: dict = None) -> None:
+        self.ratios: np.ndarray = np.array(ratios, dtype=float)
+        self.ratios.flags.writeable = False
+        self.variants: dict[str, power_profile] = dict(variants or {})
+        self.configs: dict[str, power_profile] = dict(configs or {})
+
+    def __len__(self) -> int:
+        return len(self.ratios)
+
+    def __getitem__(self, index):
+        return self.ratios[index]
+
+    def __iter__(self):
+        return iter(self.ratios.tolist())
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.ratios if dtype is None else self.ratios.astype(dtype)
+
+    def of(self, kind: str, machine_id: str) -> "power_profile":
+        if machine_id in self.variants:
+            return self.variants[machine_id]
+        return self.variants.get(kind, self)
+
+    def for_size(self, size: str) -> "power_profile":
+        # The profile with the configs of the size as variants of their kind, e.g. "ex_lar" as "EX" for "lar"
+        if not self.configs:
+            return self
+        sized: power_profile = copy.copy(self)
+        sized.variants = dict({machine_id.rpartition("_")[0].upper(): profile for machine_id, profile in self.configs.items() 
+                               if machine_id.rpartition("_")[2] == size}, **self.variants)
+        sized.configs = {}
+        return sized
+
+    def update_digest(self, digest) -> None:
+        # Adds the profile to a hash, a profile without variants hashes as its list of fractions
+        digest.update(self.ratios.tobytes())
+        for prefix, profiles in (("variant", self.variants), ("config", self.configs)):
+            for name in sorted(profiles):
+                digest.update(f"{prefix}:{name}".encode())
+                profiles[name].update_digest(digest)
+
+    def __getstate__(self) -> dict:
+        # Long profiles are written once per process to a file in the temporary directory and memory-mapped by every
+        # process that receives them, short ones are copied. The file is removed when the writing process exits.
+        state: dict = dict(self.__dict__)
+        if len(self.ratios) >= SHARED_PROFILE_SAMPLES:
+            digest = hashlib.sha256(self.ratios.tobytes())
+            path: str = os.path.join(tempfile.gettempdir(), 
+                                     f"ew_des_profile_{digest.hexdigest()[:16]}_{os.getpid()}.npy")
+            if path not in shared_profile_files:
+                temporary: str = f"{path}.tmp"
+                with open(temporary, "wb") as file:
+                    np.save(file, self.ratios)
+                os.replace(temporary, path)
+                shared_profile_files.add(path)
+            state.update(ratios=path)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if isinstance(self.ratios, str):
+            self.ratios = np.load(self.ratios, mmap_mode="r")
+
+def read_power_profile(path: str) -> np.ndarray:
+    # Power profile file with the fraction of the operating power in column y, separated by semicolons with decimal commas
+    return pd.read_csv(rf'{path}', sep=';', decimal=',', float_precision="round_trip")['y'].to_numpy(dtype=float)
 
 def setup_files(sim, mach, excav):
     simulation_settings = pd.read_csv(rf'{sim}', sep=',')
     machine_settings = pd.read_csv(rf'{mach}', sep=',')
-    excavator_power_profile = pd.read_csv(rf'{excav}', sep=';')
 
-    power_data = excavator_power_profile['y']
-    epp = [] 
-    for row in power_data:
-        power_value = float(row.replace(',', '.'))
-        epp.append(power_value)
+    # Machine configs with their own power profile in the optional power_profile column, relative to the machines file
+    configs: dict[str, power_profile] = {}
+    if "power_profile" in machine_settings.columns:
+        for _, row in machine_settings.dropna(subset=["power_profile"]).iterrows():
+            path: str = os.path.join(os.path.dirname(mach), row["power_profile"])
+            configs[row["machine_id"]] = power_profile(read_power_profile(path))
+    epp: power_profile = power_profile(read_power_profile(excav), configs=configs)
 
     return simulation_settings, machine_settings, epp
 
@@ -350,40 +2012,124 @@ def validate_file(file_path, description):
         return print(f"Error: {description} file not found: {file_path}")
     return file_path
 
-def run_all(simulation_settings, machine_settings, epp, show=False, save=True, grid=False):
+def scenario_frames(simulation_settings, machine_settings):
+    # Every row of simulation_settings as its own frame together with the machine configs of its size
     for _, sim in simulation_settings.iterrows():
         sim_df = sim.to_frame().T
         size_setting = sim_df["size_setting"].iloc[0]
-        machine_config = machine_settings.loc[machine_settings["size"] == str(size_setting)]
-        simulation(sim_df, machine_config, epp, save, show, grid)
-    if save == True:
-        return print("Finished. You can find the plots in figs_simulation and the results in results.txt.")
-    return print("Finished. You can find the results in results.txt")
+        yield sim_df, machine_settings.loc[machine_settings["size"] == str(size_setting)]
+
+def skip_stored(simulation_settings, machine_settings, epp, engine: str, store: results_store):
+    # Rows of simulation_settings that have no stored result for the engine yet
+    stored: set[str] = store.keys()
+    missing: list[bool] = [scenario_key(sim_df.iloc[0].to_dict(), machine_records(machine_config), epp, engine) not in stored 
+                           for sim_df, machine_config in scenario_frames(simulation_settings, machine_settings)]
+    if not all(missing):
+        print(f"Skipping {missing.count(False)} simulations that are already in the results store.")
+    return simulation_settings.loc[missing]
+
+def run_scenarios(simulation_settings, machine_settings, epp, engine="step", jobs=1, cache=None, resolution=1, instrument=None):
+    # Yields the results of every scenario in the order of simulation_settings, with jobs > 1 they run in a process pool
+    tasks: list[tuple] = [(sim_df, machine_config, epp, engine, cache, resolution, instrument) 
+                          for sim_df, machine_config in scenario_frames(simulation_settings, machine_settings)]
+
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield cached_simulation(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(tasks))) as executor:
+            yield from executor.map(cached_simulation, *zip(*tasks))
+
+def finished(plots: bool, store: results_store, note: str = "") -> None:
+    # Tells where the plots and the results of a run were written, nothing is stored with --no-results
+    places: list[str] = (["the plots in figs_simulation"] if plots else []) + (["the results in the results store"] if store is not None else [])
+    print("Finished." + (f" You can find {' and '.join(places)}." if places else "") + note)
+
+def run_all(simulation_settings, machine_settings, epp, show=False, save=True, grid=False, engine="step", jobs=1, cache=None, resolution=1, instrument=None, 
+            store=None, skip_existing=False, time_step=1, time_step_error=False):
+    if time_step > 1:
+        engine = time_step_engine(time_step)
+    if store is not None and skip_existing:
+        simulation_settings = skip_stored(simulation_settings, machine_settings, epp, engine, store)
+
+    if engine.startswith("batch"):
+        run_batch(simulation_settings, machine_settings, epp, store, time_step, time_step_error)
+        return finished(False, store, " The batch engine does not make any plots.")
+
+    # Figures that are only saved are made in a process pool while the next scenarios run
+    renderer = ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) if jobs != 1 and save and not show else None
+    figures: list = []
+    frames: list[tuple] = list(scenario_frames(simulation_settings, machine_settings))
+    for (sim_df, machine_config), result in zip(frames, run_scenarios(simulation_settings, machine_settings, epp, engine, jobs, cache, resolution, instrument)):
+        print_results(result["name"], result["peak_power"], result["average_power"], result["productivity"], result["queue_wait"])
+        store_result(store, sim_df, machine_config, epp, engine, result)
+        save_instrumentation(result)
+        if renderer is not None:
+            figures.append(renderer.submit(plot_data, result, save, show))
+        elif save or show:
+            plot_data(result, save, show)
+    if renderer is not None:
+        for figure in figures:
+            figure.result()
+        renderer.shutdown()
+    return finished(save == True, store)
         
-def run_single(simulation_name, simulation_settings, machine_settings, epp, save=False, show=True, grid=False):
+def run_single(simulation_name, simulation_settings, machine_settings, epp, save=False, show=True, grid=False, engine="step", cache=None, resolution=1, instrument=None, 
+               store=None, time_step=1, time_step_error=False):
     if simulation_name not in simulation_settings["name"].values:
         return print(f"There is no simulation with the name: {simulation_name}.")
     
     simulation_config = simulation_settings.loc[simulation_settings["name"] == simulation_name]
+    if engine == "batch" or time_step > 1:
+        run_batch(simulation_config, machine_settings, epp, store, time_step, time_step_error)
+        return finished(False, store, " The batch engine does not make any plots.")
+
     size_setting = simulation_config["size_setting"].iloc[0]
     machine_config = machine_settings.loc[machine_settings["size"] == str(size_setting)]
     
-    simulation(simulation_config, machine_config, epp, save, show, grid)
-    if save == True:
-        return print("Finished. You can find the plots in figs_simulation and the results in results.txt.")
-    return print("Finished. You can find the results in results.txt.")
+    simulation(simulation_config, machine_config, epp, save, show, grid, engine, cache, resolution, instrument, store)
+    return finished(save == True, store)
 
-def run_combined(simulation_settings, machine_settings, epp):
+def run_combined(simulation_settings, machine_settings, epp, engine="step", jobs=1, cache=None, resolution=1, instrument=None, store=None):
     simulation_groups = [["MED6B150", "MED3B150", "MED4C150", "MED2C150"],
                         ["LAR6B150", "LAR3B150", "LAR4C150", "LAR2C150"],
                         ["LAR6B350", "LAR3B350", "LAR4C350", "LAR2C350"]]
-    simulations_per_figure = len(simulation_groups[0])
 
     workday = simulation_settings["workday"].iloc[0]
     start_time: int = simulation_settings["start_time"].iloc[0]
-    num_excavators_battery: int = simulation_settings["num_excavators_battery"].iloc[0]
 
-    time_array: np.ndarray = np.arange(0, workday, 1)
+    # Only the downsampled series of every run are kept, an axes is a third of the 30 inch wide figure
+    columns: int = 10*PLOT_DPI
+    stored_runs = {}
+    frames: list[tuple] = list(scenario_frames(simulation_settings, machine_settings))
+    for (sim_df, machine_config), result in zip(frames, run_scenarios(simulation_settings, machine_settings, epp, engine, jobs, cache, resolution, instrument)):
+        print_results(result["name"], result["peak_power"], result["average_power"], result["productivity"], result["queue_wait"])
+        store_result(store, sim_df, machine_config, epp, engine, result)
+        save_instrumentation(result)
+        stored_runs[result["name"]] = ({machine_id: envelope(levels, resolution, columns) for machine_id, levels in result["battery_levels"].items()}, 
+                                       envelope(result["power"], resolution, columns), float(result["average_power"]), 
+                                       envelope(result["active_machines"], resolution, columns), result["num_excavators_battery"])
+
+    # Every figure is rendered in its own process with jobs other than 1
+    os.makedirs("./figs_simulation/", exist_ok=True)
+    tasks: list[tuple] = [(group, {simulation_name: stored_runs[simulation_name] for simulation_name in group}, workday, start_time) 
+                          for group in simulation_groups]
+    if jobs == 1:
+        for task in tasks:
+            render_combined(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(tasks))) as executor:
+            list(executor.map(render_combined, *zip(*tasks)))
+
+    return finished(True, store)
+
+def render_combined(group: list[str], runs: dict, workday: int, start_time: int) -> str:
+    # One figure of run_combined with a row of battery levels, power and active machines for every simulation in group
+    plt = pyplot(headless=True)
+    from matplotlib.ticker import FuncFormatter
+    from cycler import cycler
+
+    simulations_per_figure = len(group)
     x_ticks: np.ndarray = np.arange(0, workday+1, 3600)
 
     plt.style.use('leostyle2.mplstyle')
@@ -404,90 +2150,1015 @@ def run_combined(simulation_settings, machine_settings, epp):
         combined_cycler = cycler('color', skipped_color_cycle) + cycler('linestyle', skipped_linestyle_cycle)
         return combined_cycler
 
-    stored_runs = {}
-    for _, sim in simulation_settings.iterrows():
-        sim_df = sim.to_frame().T
-        size_setting = sim_df["size_setting"].iloc[0]
-        machine_config = machine_settings.loc[machine_settings["size"] == str(size_setting)]
-        bat, pow, act = simulation(sim_df, machine_config, epp, save=False, show=False, grid=True)
-        stored_runs[sim_df["name"].iloc[0]] = bat, pow, act
-
-    for group in simulation_groups:
-        def plot_setting(title: str, type: str, ax, xlabel: str, ylabel: str, x_ticks: np.ndarray, formatter) -> None:
-            ax.set_title(title)
-            ax.set_xlabel(xlabel)
-            ax.set_ylabel(ylabel)
-            ax.set_xticks(x_ticks)
-            for label in ax.get_xticklabels():
-                label.set_rotation(45)
-            ax.xaxis.set_major_formatter(FuncFormatter(formatter))
-            ax.set_ylim(bottom=0)
-            if type == "POW" and title[5:8] == "150" and title[0:3] == "MED":
-                ax.set_ylim(top=1000)
-            elif type == "POW" and title[5:8] == "150" and title[0:3] == "LAR":
-                ax.set_ylim(top=1200)
-            elif type == "POW" and title[5:8] == "350":
-                ax.set_ylim(top=2200)
-
-        fig, axes = plt.subplots(nrows=simulations_per_figure, ncols=3, figsize=(30, 40), dpi=300)
-        for i in range(simulations_per_figure):
-            simulation_name = group[i]
-            bat, pow, act = stored_runs[simulation_name]
-
-            # Plot battery levels
-            num_excavators_battery = simulation_settings.loc[simulation_settings["name"] == str(simulation_name)]["num_excavators_battery"].iloc[0]
-
-            if num_excavators_battery == 0:
-                new_cycle = adjust_prop_cycler()
-                axes[i, 0].set_prop_cycle(new_cycle)
-                
-            for machine_id, levels in bat.items():
-                times, battery_levels = zip(*levels)
-                axes[i, 0].plot(times, battery_levels, label=f"{machine_id}")
-            axes[i, 0].legend()
-            plot_setting(f"{simulation_name}, SoC over time", "BAT", axes[i, 0], "Time", "SoC [kWh]", x_ticks, ticks_to_time)
-
-            # Plot power usage
-            plt.style.use('leostyle2.mplstyle')
-            axes[i, 1].plot(time_array, pow)
-            axes[i, 1].axhline(y=np.mean(pow), c = "k", alpha = 0.5, ls = '--', lw = 3, label = "Average power")
-            axes[i, 1].legend(loc = "lower left")
-            plot_setting(f"{simulation_name}, power over time", "POW", axes[i, 1], "Time", "Power [kW]", x_ticks, ticks_to_time)
-
-            # Plot active machines
-            axes[i, 2].plot(time_array, act)
-            plot_setting(f"{simulation_name}, active machines over time", "ACT", axes[i, 2], "Time", "# active machines", x_ticks, ticks_to_time)
+    def plot_setting(title: str, type: str, ax, xlabel: str, ylabel: str, x_ticks: np.ndarray, formatter) -> None:
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_xticks(x_ticks)
+        for label in ax.get_xticklabels():
+            label.set_rotation(45)
+        ax.xaxis.set_major_formatter(FuncFormatter(formatter))
+        ax.set_ylim(bottom=0)
+        if type == "POW" and title[5:8] == "150" and title[0:3] == "MED":
+            ax.set_ylim(top=1000)
+        elif type == "POW" and title[5:8] == "150" and title[0:3] == "LAR":
+            ax.set_ylim(top=1200)
+        elif type == "POW" and title[5:8] == "350":
+            ax.set_ylim(top=2200)
+
+    fig, axes = plt.subplots(nrows=simulations_per_figure, ncols=3, figsize=(30, 40), dpi=PLOT_DPI)
+    for i in range(simulations_per_figure):
+        simulation_name = group[i]
+        bat, pow, mean_power, act, num_excavators_battery = runs[simulation_name]
 
-        plt.tight_layout()
-        plt.savefig(f"./figs_simulation/{group[0][0:3]}_{group[0][-3:]}.png")
+        # Plot battery levels
+        if num_excavators_battery == 0:
+            new_cycle = adjust_prop_cycler()
+            axes[i, 0].set_prop_cycle(new_cycle)
+            
+        for machine_id, levels in bat.items():
+            axes[i, 0].plot(*levels, label=f"{machine_id}")
+        axes[i, 0].legend()
+        plot_setting(f"{simulation_name}, SoC over time", "BAT", axes[i, 0], "Time", "SoC [kWh]", x_ticks, ticks_to_time)
+
+        # Plot power usage
+        plt.style.use('leostyle2.mplstyle')
+        axes[i, 1].plot(*pow)
+        axes[i, 1].axhline(y=mean_power, c = "k", alpha = 0.5, ls = '--', lw = 3, label = "Average power")
+        axes[i, 1].legend(loc = "lower left")
+        plot_setting(f"{simulation_name}, power over time", "POW", axes[i, 1], "Time", "Power [kW]", x_ticks, ticks_to_time)
+
+        # Plot active machines
+        axes[i, 2].plot(*act)
+        plot_setting(f"{simulation_name}, active machines over time", "ACT", axes[i, 2], "Time", "# active machines", x_ticks, ticks_to_time)
+
+    plt.tight_layout()
+    path: str = f"./figs_simulation/{group[0][0:3]}_{group[0][-3:]}.png"
+    plt.savefig(path)
+    plt.close(fig)
+    return path
+
+def sweep_values(values) -> list:
+    # A list, a single value or a "start:stop:step" range where the stop is included
+    if isinstance(values, list):
+        return values
+    if isinstance(values, str) and values.count(":") == 2:
+        start, stop, step = (float(value) for value in values.split(":"))
+        range_values: np.ndarray = np.arange(start, stop + step/2, step)
+        return [int(value) if float(value).is_integer() else float(value) for value in range_values]
+    return [values]
+
+def sweep_cases(spec: dict, simulation_settings):
+    # Lazily expands the cartesian product of the swept parameters on top of a base scenario
+    base_name: str = spec.get("base", simulation_settings["name"].iloc[0])
+    base_rows = simulation_settings.loc[simulation_settings["name"] == base_name]
+    if base_rows.empty:
+        raise ValueError(f"There is no simulation with the name: {base_name}.")
+    base: dict = base_rows.iloc[0].to_dict()
+
+    unknown: list[str] = [parameter for parameter in spec if parameter not in SWEEP_PARAMETERS + ["base", "engine", "chunk_size", "time_step", "shortlist"]]
+    if unknown:
+        raise ValueError(f"Parameters that can not be swept: {', '.join(unknown)}. Use {', '.join(SWEEP_PARAMETERS)}.")
+    parameters: list[str] = [parameter for parameter in SWEEP_PARAMETERS if parameter in spec]
+    for i, values in enumerate(itertools.product(*(sweep_values(spec[parameter]) for parameter in parameters))):
+        case: dict = dict(base, **dict(zip(parameters, values)))
+        case["name"] = f"{base_name}_{i}"
+        yield case
+
+def sweep_chunk(cases: list[dict], machine_settings, epp, engine: str = "batch", time_step: int = 1) -> list[dict]:
+    # Worker of run_sweep, returns the swept parameters and the KPIs of every case
+    if engine == "batch":
+        site: batch_worksite = batch_worksite(epp=epp, scenarios=[scenario_config(case, machine_settings) for case in cases])
+        results: dict = site.run() if time_step == 1 else site.run_coarse(time_step)
+        kpis: list[dict] = [{column: float(results[column][i]) for column in KPI_COLUMNS} for i in range(len(cases))]
+    else:
+        kpis: list[dict] = []
+        for case in cases:
+            machine_config = machine_settings.loc[machine_settings["size"] == str(case["size_setting"])]
+            result: dict = run_simulation(pd.DataFrame([case]), machine_config, epp, engine, resolution=None)
+            kpis.append({column: float(result[column]) for column in KPI_COLUMNS})
+    return [dict({"name": case["name"]}, **{parameter: case.get(parameter) for parameter in SWEEP_PARAMETERS}, **kpi) 
+            for case, kpi in zip(cases, kpis)]
+
+def pareto_front(rows: list[dict]) -> list[dict]:
+    # Cases that no other case beats on both lower peak power and higher productivity
+    front: list[dict] = []
+    best_productivity: float = -np.inf
+    for row in sorted(rows, key=lambda row: (row["peak_power"], -row["productivity"])):
+        if row["productivity"] > best_productivity:
+            front.append(row)
+            best_productivity = row["productivity"]
+    return front
+
+def run_sweep(spec: dict, simulation_settings, machine_settings, epp, jobs=1, output="./sweep", store=None, skip_existing=False) -> list[dict]:
+    # Streams the cases through the simulation in chunks and writes one row per case, only the current Pareto front
+    # and a bounded number of chunks in flight are kept in memory. Every case is also written to the results store, 
+    # with skip_existing the cases already in it are read from it instead so an interrupted sweep continues. 
+    # A time_step above 1 second screens the cases with the coarse batch engine, with shortlist the Pareto front is 
+    # then run again at 1 second
+    time_step: int = spec.get("time_step", 1)
+    engine: str = spec.get("engine", "batch")
+    if time_step > 1 and engine != "batch":
+        raise ValueError(f"A time step above 1 second needs the batch engine, got {engine}.")
+    chunk_size: int = spec.get("chunk_size", 512 if engine == "batch" else 16)
+    workers: int = jobs or os.cpu_count()
+
+    records: dict[str, list] = {}
+    def key(case: dict) -> str:
+        size: str = str(case["size_setting"])
+        if size not in records:
+            records[size] = machine_records(machine_settings.loc[machine_settings["size"] == size])
+        return scenario_key(case, records[size], epp, label)
+
+    label: str = time_step_engine(time_step) if engine == "batch" else engine
+    stored: set[str] = store.keys() if store is not None and skip_existing else set()
+    skipped: list[str] = []
+    def missing(cases):
+        for case in cases:
+            case_key: str = key(case) if store is not None else None
+            if case_key in stored:
+                skipped.append(case_key)
+            else:
+                yield case_key, case
+
+    cases = missing(sweep_cases(spec, simulation_settings))
+    chunks = iter(lambda: list(itertools.islice(cases, chunk_size)), [])
+
+    front: list[dict] = []
+    num_cases: int = 0
+    with open(f"{output}_results.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["name"] + SWEEP_PARAMETERS + KPI_COLUMNS)
+        writer.writeheader()
+
+        def collect(chunk: list[tuple], rows: list[dict]) -> None:
+            nonlocal front, num_cases
+            writer.writerows(rows)
+            front = pareto_front(front + rows)
+            num_cases += len(rows)
+            if store is not None:
+                store.put([(case_key, case, label, row) for (case_key, case), row in zip(chunk, rows)])
+
+        if workers == 1:
+            for chunk in chunks:
+                collect(chunk, sweep_chunk([case for _, case in chunk], machine_settings, epp, engine, time_step))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending: deque = deque()
+                for chunk in chunks:
+                    pending.append((chunk, executor.submit(sweep_chunk, [case for _, case in chunk], machine_settings, epp, engine, time_step)))
+                    if len(pending) >= 2*workers:
+                        chunk, future = pending.popleft()
+                        collect(chunk, future.result())
+                while pending:
+                    chunk, future = pending.popleft()
+                    collect(chunk, future.result())
+
+        if skipped:
+            print(f"Skipped {len(skipped)} cases that are already in the results store.")
+            rows: pd.DataFrame = store.load("engine = ?", parameters=(label,))
+            rows = rows.loc[rows["key"].isin(set(skipped)), ["name"] + SWEEP_PARAMETERS + KPI_COLUMNS]
+            collect([], rows.to_dict("records"))
+
+    with open(f"{output}_pareto.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["name"] + SWEEP_PARAMETERS + KPI_COLUMNS)
+        writer.writeheader()
+        writer.writerows(front)
+
+    print(f"Finished {num_cases} cases. You can find the results in {output}_results.csv and the Pareto front of peak power and productivity in {output}_pareto.csv.")
+    if spec.get("shortlist") and time_step > 1:
+        front = run_shortlist(spec, front, simulation_settings, machine_settings, epp, output, store)
+    return front
+
+def run_shortlist(spec: dict, front: list[dict], simulation_settings, machine_settings, epp, output="./sweep", store=None) -> list[dict]:
+    # Runs the cases of a screened Pareto front again at 1 second and writes their KPIs with the error of the screening
+    coarse: dict[str, dict] = {row["name"]: row for row in front}
+    cases: list[dict] = [case for case in sweep_cases(spec, simulation_settings) if case["name"] in coarse]
+    rows: list[dict] = sweep_chunk(cases, machine_settings, epp, "batch")
+    for row in rows:
+        row.update({column: float(error) for column, error in time_step_errors(coarse[row["name"]], row).items()})
+    if store is not None:
+        records: dict[str, list] = {}
+        for case in cases:
+            size: str = str(case["size_setting"])
+            records.setdefault(size, machine_records(machine_settings.loc[machine_settings["size"] == size]))
+        store.put([(scenario_key(case, records[str(case["size_setting"])], epp, "batch"), case, "batch", row) for case, row in zip(cases, rows)])
+
+    with open(f"{output}_shortlist.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["name"] + SWEEP_PARAMETERS + KPI_COLUMNS + [f"{kpi}_error" for kpi in KPI_COLUMNS])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Ran the {len(rows)} cases of the Pareto front again at 1 second. You can find them in {output}_shortlist.csv.")
+    return rows
+
+def find_min_chargers(simulation_name, simulation_settings, machine_settings, epp, productivity_target=0.98, charging_powers=None, engine="event") -> list[dict]:
+    # The fewest chargers that reach the productivity target for every charging power, found by bisection over the charger count.
+    # The productivity is not monotonic in the chargers, a charging machine is inactive while a queued one keeps working, so
+    # the search for the next charging power starts from the previous answer but falls back to one charger per battery 
+    # machine if that misses the target. Runs that can no longer reach the target are aborted early
+    simulation_config = simulation_settings.loc[simulation_settings["name"] == simulation_name]
+    if simulation_config.empty:
+        raise ValueError(f"There is no simulation with the name: {simulation_name}.")
+    size_setting = simulation_config["size_setting"].iloc[0]
+    machine_config = machine_settings.loc[machine_settings["size"] == str(size_setting)]
+    num_battery_machines: int = int(simulation_config[["num_wheel_loaders", "num_excavators_battery", "num_dumpers"]].iloc[0].sum())
+    runs: list[dict] = []
+
+    def reaches_target(num_chargers: int, charging_power: float) -> dict:
+        sim_df = simulation_config.copy()
+        sim_df["num_chargers"] = num_chargers
+        sim_df["charging_power"] = charging_power
+        result: dict = run_simulation(sim_df, machine_config, epp, engine, productivity_target, resolution=None)
+        runs.append(result)
+        return result if "aborted" not in result and result["productivity"] >= productivity_target else None
+
+    answers: list[dict] = []
+    bound: int = max(num_battery_machines, 1)
+    high: int = bound
+    for charging_power in sorted(charging_powers or [simulation_config["charging_power"].iloc[0]]):
+        best: dict = reaches_target(high, charging_power)
+        if best is None and high < bound:
+            high = bound
+            best = reaches_target(high, charging_power)
+        if best is None:
+            answers.append({"charging_power": charging_power, "num_chargers": None, "peak_power": np.nan, "productivity": np.nan})
+            continue
+
+        low: int = 1
+        while low < high:
+            middle: int = (low + high)//2
+            result: dict = reaches_target(middle, charging_power)
+            if result is not None:
+                high, best = middle, result
+            else:
+                low = middle + 1
+        answers.append({"charging_power": charging_power, "num_chargers": high, "peak_power": best["peak_power"], "productivity": best["productivity"]})
+
+    print(f"{simulation_name}, fewest chargers for a productivity of at least {productivity_target:.1%}")
+    for answer in answers:
+        if answer["num_chargers"] is None:
+            print(f"Charging power {answer['charging_power']:g} kW: not reachable with one charger per battery machine")
+        else:
+            print(f"Charging power {answer['charging_power']:g} kW: {answer['num_chargers']} chargers, "
+                  f"peak power {answer['peak_power']:.0f} kW, productivity {answer['productivity']:.1%}")
+    aborted: list[dict] = [run for run in runs if "aborted" in run]
+    print(f"{len(runs)} runs, {len(aborted)} of them aborted early after on average {np.mean([run['aborted'] for run in aborted] or [0])/3600:.1f} h.")
+    return answers
+
+def overnight_charge(levels: dict, capacities: dict, queue: list, num_chargers: int, charging_power: float, duration: int) -> tuple[dict, float]:
+    # Depot charging between two workdays with the chargers of the site. The machines left in the charger queue go first and 
+    # then the emptiest ones, every charger charges one machine at a time for at most duration seconds in total.
+    # Returns the new levels and the energy charged
+    if num_chargers == 0:
+        return dict(levels), 0.0
+    order: list[str] = queue + sorted([machine_id for machine_id in levels if machine_id not in queue], 
+                                      key=lambda machine_id: levels[machine_id]/capacities[machine_id])
+    free: list[float] = [0.0]*num_chargers
+    charged: dict[str, float] = dict(levels)
+    for machine_id in order:
+        start: float = heapq.heappop(free)
+        seconds: float = min((capacities[machine_id] - levels[machine_id])/charging_power*3600, max(duration - start, 0))
+        charged[machine_id] += seconds*charging_power/3600
+        heapq.heappush(free, start + seconds)
+    return charged, sum(charged.values()) - sum(levels.values())
+
+def days_engine(engine: str, day: int) -> str:
+    # Engine the results of a day of a multi-day run are stored under, it depends on the days before it
+    return f"{engine}_day{day}"
+
+def checkpoint_key(simulation_settings, machine_settings, epp) -> str:
+    # Hash of the settings, machines, power profile and engine version a checkpoint was made with, the engines give the same
+    # results so a run can continue from the checkpoint of another engine
+    size_setting: str = str(simulation_settings["size_setting"].iloc[0])
+    machines: list[dict] = machine_records(machine_settings.loc[machine_settings["size"] == size_setting])
+    return scenario_key(simulation_settings.iloc[0].to_dict(), machines, epp, "days")[:16]
+
+def run_days(simulation_settings, machine_settings, epp, days: int, engine="event", checkpoints=None, from_day=None) -> list[dict]:
+    # Runs a scenario for a number of workdays in a row. The battery levels, cycle positions and charger queue at the end of
+    # a day are carried over to the next one with depot charging in between. With a checkpoint directory the state at the 
+    # end of every day is written there and the run continues from the last stored day, or from_day if given. Checkpoints
+    # are named after the hash of checkpoint_key, so a scenario with changed settings starts over
+    if from_day is not None and checkpoints is None:
+        raise ValueError("from_day continues from a stored day and needs a checkpoint directory.")
+    if from_day is not None and not 0 <= from_day <= days:
+        raise ValueError(f"from_day has to be between 0 and days ({days}), got {from_day}.")
+    name: str = simulation_settings["name"].iloc[0]
+    workday: int = int(simulation_settings["workday"].iloc[0])
+    num_chargers: int = int(simulation_settings["num_chargers"].iloc[0])
+    charging_power: float = float(simulation_settings["charging_power"].iloc[0])
+
+    rows: list[dict] = []
+    state: dict = None
+    first_day: int = 0
+    if checkpoints is not None:
+        os.makedirs(checkpoints, exist_ok=True)
+        prefix: str = f"{name}_{checkpoint_key(simulation_settings, machine_settings, epp)}"
+        pattern = re.compile(rf"{re.escape(prefix)}_day(\d+)\.json")
+        stored: list[int] = sorted(int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(checkpoints)) if match)
+        if from_day is not None and from_day != 0 and from_day not in stored:
+            raise ValueError(f"There is no checkpoint of {name} with these settings after day {from_day} in {checkpoints}.")
+        first_day = from_day if from_day is not None else max([day for day in stored if day <= days], default=0)
+        if first_day > 0:
+            with open(os.path.join(checkpoints, f"{prefix}_day{first_day:03d}.json")) as f:
+                checkpoint: dict = json.load(f)
+            state, rows = checkpoint["state"], checkpoint["days"][:first_day]
+
+    for day in range(first_day, days):
+        initial_state: dict = None
+        overnight_energy: float = 0
+        if state is not None:
+            levels, overnight_energy = overnight_charge(state["battery_levels"], state["battery_capacity"], state["queue"], 
+                                                        num_chargers, charging_power, 24*3600 - workday)
+            initial_state = dict(state, battery_levels=levels)
+        result: dict = run_simulation(simulation_settings, machine_settings, epp, engine, resolution=None, initial_state=initial_state)
+        rows.append(dict({"name": name, "day": day + 1}, **{column: float(result[column]) for column in KPI_COLUMNS}, 
+                         overnight_energy=overnight_energy, min_battery_level=min(result["min_battery_level"].values(), default=np.nan)))
+        state = result["end_state"]
+
+        if checkpoints is not None:
+            path: str = os.path.join(checkpoints, f"{prefix}_day{day + 1:03d}.json")
+            with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+                json.dump({"name": name, "day": day + 1, "state": state, "days": rows}, f)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return rows
+
+def run_multi_day(simulation_settings, machine_settings, epp, days: int, engine="event", jobs=1, checkpoints=None, from_day=None, output="./multi_day", 
+                  store=None) -> pd.DataFrame:
+    # Every scenario runs its days in order in one process, with jobs > 1 the scenarios run side by side. Every day is also
+    # written to the results store under the engine of days_engine
+    tasks: list[tuple] = [(sim.to_frame().T, machine_settings, epp, days, engine, checkpoints, from_day) for _, sim in simulation_settings.iterrows()]
+    if jobs == 1 or len(tasks) < 2:
+        scenario_rows: list[list[dict]] = [run_days(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(tasks))) as executor:
+            scenario_rows: list[list[dict]] = list(executor.map(run_days, *zip(*tasks)))
+    if store is not None:
+        entries: list[tuple] = []
+        for (sim_df, machine_config), rows in zip(scenario_frames(simulation_settings, machine_settings), scenario_rows):
+            scenario: dict = sim_df.iloc[0].to_dict()
+            machines: list[dict] = machine_records(machine_config)
+            entries += [(scenario_key(scenario, machines, epp, days_engine(engine, row["day"])), scenario, days_engine(engine, row["day"]), row) 
+                        for row in rows]
+        store.put(entries)
+
+    results: pd.DataFrame = pd.DataFrame([row for rows in scenario_rows for row in rows])
+    results.to_csv(f"{output}_days.csv", index=False)
+    print(f"{days} workdays with depot charging between them")
+    for name, rows in results.groupby("name", sort=False):
+        print(f"{name}: peak power {rows['peak_power'].max():.0f} kW, average power {rows['average_power'].mean():.0f} kW, "
+              f"energy demand {rows['energy'].sum() + rows['overnight_energy'].sum():.0f} kWh of which {rows['overnight_energy'].sum():.0f} kWh overnight, "
+              f"productivity {rows['productivity'].mean():.1%}, lowest battery level {rows['min_battery_level'].min():.0f} kWh")
+    print(f"You can find the results of every day in {output}_days.csv.")
+    return results
+
+# Spread of the random inputs of a Monte Carlo run, can be changed in the Monte Carlo file
+MONTE_CARLO_SPREAD: dict = {"cycle_jitter": 0.05, "break_offset": 600, "power_scale": 0.1}
+MONTE_CARLO_QUANTILES: list[float] = [0.5, 0.95, 0.99]
+
+def quantile_interval(values: np.ndarray, quantile: float, confidence: float = 0.95) -> tuple[float, float, float]:
+    # Quantile with a distribution free confidence interval from the order statistics around it
+    ordered: np.ndarray = np.sort(values)
+    n: int = len(ordered)
+    spread: float = NormalDist().inv_cdf(0.5 + confidence/2)*np.sqrt(n*quantile*(1 - quantile))
+    low: int = int(np.clip(np.floor(n*quantile - spread) - 1, 0, n - 1))
+    high: int = int(np.clip(np.ceil(n*quantile + spread), 0, n - 1))
+    return float(np.quantile(ordered, quantile)), float(ordered[low]), float(ordered[high])
+
+def mean_interval(values: np.ndarray, confidence: float = 0.95) -> tuple[float, float, float]:
+    # Mean with a normal confidence interval
+    spread: float = NormalDist().inv_cdf(0.5 + confidence/2)*np.std(values, ddof=1)/np.sqrt(len(values)) if len(values) > 1 else np.nan
+    return float(np.mean(values)), float(np.mean(values) - spread), float(np.mean(values) + spread)
+
+def capacity_samples(path: str, machine_settings) -> pd.DataFrame:
+    # Battery capacities from linear_regression_battery_capacity.py, one row per sample and one column per machine_id
+    # of machine_settings, the sample column is optional
+    samples: pd.DataFrame = pd.read_csv(path).drop(columns="sample", errors="ignore")
+    unknown: list[str] = sorted(set(samples.columns) - {machine["machine_id"] for machine in machine_rows(machine_settings)})
+    if unknown:
+        raise ValueError(f"There is no machine {', '.join(unknown)} in machine_settings.")
+    if samples.empty or samples.isna().any().any() or (samples <= 0).any().any():
+        raise ValueError(f"The battery capacities in {path} must be positive numbers.")
+    return samples
+
+def capacity_scenarios(simulation_row, machine_settings, samples: pd.DataFrame, replications: int) -> list[dict]:
+    # Scenario of every replication where replication i uses the battery capacities in row i of samples, starting over
+    # at the first row when there are fewer samples than replications
+    machines: list[dict] = machine_rows(machine_settings)
+    capacities: list[dict] = samples.to_dict("records")
+    return [scenario_config(simulation_row, [dict(machine, battery_capacity=capacities[i % len(capacities)][machine["machine_id"]]) 
+                                             if machine["machine_id"] in samples.columns else machine for machine in machines]) 
+            for i in range(replications)]
+
+def monte_carlo_chunk(scenarios: list[dict], seeds: list, epp, spread: dict) -> dict:
+    # Runs the replications of one scenario with the given seeds side by side in the batch engine, one scenario per 
+    # replication so they can differ in their machines
+    batch: batch_worksite = batch_worksite(epp=epp, scenarios=scenarios)
+    batch.perturb(seeds, **spread)
+    results: dict = batch.run()
+    return {column: results[column] for column in KPI_COLUMNS}
+
+def run_monte_carlo(spec: dict, simulation_settings, machine_settings, epp, jobs=1, output="./monte_carlo") -> pd.DataFrame:
+    # Replications of every scenario with random cycle times, break starts and machine powers, and battery capacities 
+    # from the file in battery_capacity. Replication i of the scenario in row r of simulation_settings always uses the 
+    # seed (seed, r, i) and capacity sample i, independent of chunks and jobs
+    names: list[str] = spec.get("scenarios", list(simulation_settings["name"]))
+    unknown: list[str] = [name for name in names if name not in set(simulation_settings["name"])]
+    if unknown:
+        raise ValueError(f"There is no simulation with the name: {', '.join(unknown)}.")
+    replications: int = spec.get("replications", 1000)
+    seed: int = spec.get("seed", 0)
+    confidence: float = spec.get("confidence", 0.95)
+    chunk_size: int = spec.get("chunk_size", 250)
+    spread: dict = {key: spec.get(key, value) for key, value in MONTE_CARLO_SPREAD.items()}
+    samples: pd.DataFrame = capacity_samples(spec["battery_capacity"], machine_settings) if spec.get("battery_capacity") else None
+    workers: int = jobs or os.cpu_count()
+
+    tasks: list[tuple] = []
+    for row, sim in simulation_settings.iterrows():
+        if sim["name"] not in names:
+            continue
+        if samples is None:
+            scenarios: list[dict] = [scenario_config(sim, machine_settings)]*replications
+        else:
+            scenarios: list[dict] = capacity_scenarios(sim, machine_settings, samples, replications)
+        seeds: list = np.random.SeedSequence(seed, spawn_key=(int(row),)).spawn(replications)
+        tasks += [(scenarios[start:start + chunk_size], seeds[start:start + chunk_size], epp, spread) for start in range(0, replications, chunk_size)]
+
+    if workers == 1:
+        chunks: list[dict] = [monte_carlo_chunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks: list[dict] = list(executor.map(monte_carlo_chunk, *zip(*tasks)))
+
+    kpis: dict[str, dict] = {}
+    for (scenarios, *_), chunk in zip(tasks, chunks):
+        kpis.setdefault(scenarios[0]["name"], {column: [] for column in KPI_COLUMNS})
+        for column in KPI_COLUMNS:
+            kpis[scenarios[0]["name"]][column].append(chunk[column])
+
+    replication_rows: list[dict] = []
+    summary_rows: list[dict] = []
+    for name, columns in kpis.items():
+        values: dict[str, np.ndarray] = {column: np.concatenate(parts) for column, parts in columns.items()}
+        replication_rows += [dict({"name": name, "replication": i}, **({} if samples is None else {"capacity_sample": i % len(samples)}), 
+                                  **{column: values[column][i] for column in KPI_COLUMNS}) for i in range(replications)]
+        for column in KPI_COLUMNS:
+            summary: dict = {"name": name, "kpi": column}
+            summary["mean"], summary["mean_low"], summary["mean_high"] = mean_interval(values[column], confidence)
+            for quantile in MONTE_CARLO_QUANTILES:
+                label: str = f"p{quantile*100:g}"
+                summary[label], summary[f"{label}_low"], summary[f"{label}_high"] = quantile_interval(values[column], quantile, confidence)
+            summary_rows.append(summary)
+
+    pd.DataFrame(replication_rows).to_csv(f"{output}_replications.csv", index=False)
+    summary_df: pd.DataFrame = pd.DataFrame(summary_rows)
+    summary_df.to_csv(f"{output}_summary.csv", index=False)
+
+    print(f"{replications} replications per scenario, {confidence:.0%} confidence intervals in brackets")
+    for row in summary_rows:
+        if row["kpi"] not in ("peak_power", "productivity"):
+            continue
+        label: str = "peak power [kW]" if row["kpi"] == "peak_power" else "productivity"
+        value = (lambda v: f"{v:.0f}") if row["kpi"] == "peak_power" else (lambda v: f"{v:.1%}")
+        quantiles: str = ", ".join(f"P{quantile*100:g} {value(row[f'p{quantile*100:g}'])} [{value(row[f'p{quantile*100:g}_low'])}, {value(row[f'p{quantile*100:g}_high'])}]" 
+                                   for quantile in MONTE_CARLO_QUANTILES)
+        print(f"{row['name']}, {label}: {quantiles}")
+    print(f"You can find every replication in {output}_replications.csv and the statistics in {output}_summary.csv.")
+    return summary_df
+
+# Sample designs of run_sensitivity, Sobol indices from a Saltelli design or elementary effects from Morris trajectories
+SENSITIVITY_METHODS: list[str] = ["sobol", "morris"]
+
+def sensitivity_parameters(spec: dict, simulation_settings, machine_settings) -> list[tuple[str, list]]:
+    # The varied inputs as (name, values) where a name is a column of simulation_settings or machine_id.column of 
+    # machine_settings (e.g. "ex_lar.battery_capacity"). values is a [low, high] range, whole numbers if both are, 
+    # or a list of choices such as sizes or charging policies
+    parameters: list[tuple[str, list]] = []
+    for name, values in spec.get("parameters", {}).items():
+        machine_id, _, column = name.rpartition(".")
+        if machine_id:
+            if machine_id not in set(machine_settings["machine_id"]) or column not in machine_settings.columns:
+                raise ValueError(f"There is no machine setting {name}, use machine_id.column of machine_settings.")
+        elif name not in simulation_settings.columns and name not in SWEEP_PARAMETERS and not name.startswith("num_"):
+            raise ValueError(f"There is no simulation setting {name}.")
+        if not isinstance(values, list) or len(values) < 2:
+            raise ValueError(f"The values of {name} have to be a [low, high] range or a list of choices.")
+        parameters.append((name, values))
+    if not parameters:
+        raise ValueError("A sensitivity analysis needs at least one parameter.")
+    return parameters
+
+def sensitivity_values(values: list, unit: np.ndarray) -> np.ndarray:
+    # Inputs scaled from 0..1 to the range or choices of a parameter, every whole number or choice equally likely
+    if all(isinstance(value, (int, float)) for value in values) and len(values) == 2:
+        low, high = values
+        if isinstance(low, int) and isinstance(high, int):
+            return np.minimum(low + np.floor(unit*(high - low + 1)), high).astype(int)
+        return low + unit*(high - low)
+    return np.array(values, dtype=object)[np.minimum((unit*len(values)).astype(int), len(values) - 1)]
+
+def saltelli_design(parameters: int, samples: int, seed: int) -> np.ndarray:
+    # Points in 0..1 as the blocks A, B and A with column i taken from B for every parameter i, samples rows each.
+    # A and B are the two halves of a scrambled Sobol sequence
+    from scipy.stats import qmc
+    base: np.ndarray = qmc.Sobol(2*parameters, scramble=True, seed=seed).random(samples)
+    a, b = base[:, :parameters], base[:, parameters:]
+    mixed: np.ndarray = np.repeat(a[None], parameters, axis=0)
+    for i in range(parameters):
+        mixed[i, :, i] = b[:, i]
+    return np.concatenate((a, b, mixed.reshape(-1, parameters)))
+
+def morris_design(parameters: int, trajectories: int, levels: int, seed: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # One-at-a-time trajectories through a grid of levels in 0..1, each moving every parameter once by delta in a 
+    # random order and direction. Returns the points, trajectory by trajectory, the parameter moved at every step and its sign
+    rng = np.random.default_rng(seed)
+    delta: float = levels/(2*(levels - 1))
+    start: np.ndarray = rng.integers(0, levels//2, (trajectories, parameters))/(levels - 1)
+    order: np.ndarray = np.argsort(rng.random((trajectories, parameters)), axis=1)
+    sign: np.ndarray = rng.choice([-1, 1], (trajectories, parameters))
+    # Parameters that move down start delta higher so every point stays in 0..1
+    points: np.ndarray = np.repeat((start + np.where(sign < 0, delta, 0))[:, None], parameters + 1, axis=1)
+    rows: np.ndarray = np.arange(trajectories)
+    for step in range(parameters):
+        moved: np.ndarray = order[:, step]
+        points[rows, step + 1:, moved] += (sign[rows, moved]*delta)[:, None]
+    return points.reshape(-1, parameters), order, np.take_along_axis(sign, order, axis=1)*delta
+
+def sobol_indices(outputs: np.ndarray, parameters: int, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # First order (Saltelli 2010) and total order (Jansen) indices of every parameter for every set of sample rows,
+    # outputs is one KPI of a Saltelli design and rows has a set of rows of the A and B blocks per line. The outputs
+    # are centered first, a KPI far from 0 such as productivity otherwise adds a lot of noise to the first order index
+    samples: int = len(outputs)//(parameters + 2)
+    a: np.ndarray = outputs[:samples][rows]
+    b: np.ndarray = outputs[samples:2*samples][rows]
+    mixed: np.ndarray = outputs[2*samples:].reshape(parameters, samples)[:, rows]
+    mean: np.ndarray = np.concatenate((a, b), axis=-1).mean(axis=-1, keepdims=True)
+    a, b, mixed = a - mean, b - mean, mixed - mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance: np.ndarray = np.var(np.concatenate((a, b), axis=-1), axis=-1)
+        first: np.ndarray = np.mean(b*(mixed - a), axis=-1)/variance
+        total: np.ndarray = 0.5*np.mean((a - mixed)**2, axis=-1)/variance
+    return first, total
+
+def bootstrap_interval(statistic, count: int, resamples: int, confidence: float, rng, batch: int = 100) -> tuple[np.ndarray, np.ndarray]:
+    # Percentile interval of statistic(rows) over resamples of count rows drawn with replacement, in batches of resamples
+    # so the arrays of every batch stay small. statistic returns one value per parameter and resample
+    estimates: list[np.ndarray] = []
+    for start in range(0, resamples, batch):
+        estimates.append(statistic(rng.integers(0, count, (min(batch, resamples - start), count))))
+    estimates: np.ndarray = np.concatenate(estimates, axis=-1)
+    return tuple(np.nanquantile(estimates, [(1 - confidence)/2, (1 + confidence)/2], axis=-1))
+
+def sensitivity_chunk(base: dict, rows: list[dict], machine_settings, epp, time_step: int = 1) -> np.ndarray:
+    # Worker of run_sensitivity, the KPIs of every row of inputs as one row each, all of them run as one batch
+    records: list[dict] = machine_rows(machine_settings)
+    scenarios: list[dict] = []
+    for row in rows:
+        case: dict = dict(base)
+        machines: list[dict] = [dict(record) for record in records]
+        for name, value in row.items():
+            machine_id, _, column = name.rpartition(".")
+            if machine_id:
+                for machine in machines:
+                    if machine["machine_id"] == machine_id:
+                        machine[column] = value
+            else:
+                case[name] = value
+        scenarios.append(scenario_config(case, machines))
+    site: batch_worksite = batch_worksite(epp=epp, scenarios=scenarios)
+    results: dict = site.run() if time_step == 1 else site.run_coarse(time_step)
+    return np.column_stack([results[column] for column in KPI_COLUMNS])
+
+def run_sensitivity(spec: dict, simulation_settings, machine_settings, epp, jobs=1, output="./sensitivity") -> pd.DataFrame:
+    # Global sensitivity of the KPIs of a base scenario to the parameters of spec. The design is evaluated in chunks
+    # with the batch engine spread over jobs processes, only the inputs and KPIs of every point are kept
+    base_name: str = spec.get("base", simulation_settings["name"].iloc[0])
+    base_rows = simulation_settings.loc[simulation_settings["name"] == base_name]
+    if base_rows.empty:
+        raise ValueError(f"There is no simulation with the name: {base_name}.")
+    method: str = spec.get("method", "sobol")
+    if method not in SENSITIVITY_METHODS:
+        raise ValueError(f"Unknown sensitivity method: {method}. Use {', '.join(SENSITIVITY_METHODS)}.")
+    parameters: list[tuple[str, list]] = sensitivity_parameters(spec, simulation_settings, machine_settings)
+    names: list[str] = [name for name, _ in parameters]
+    seed: int = spec.get("seed", 0)
+    resamples: int = spec.get("resamples", 1000)
+    confidence: float = spec.get("confidence", 0.95)
+    chunk_size: int = spec.get("chunk_size", 512)
+    time_step: int = spec.get("time_step", 1)
+    workers: int = jobs or os.cpu_count()
+
+    if method == "sobol":
+        # The Sobol sequence is balanced for a power of two of samples
+        samples: int = 1 << int(np.ceil(np.log2(spec.get("samples", 1024))))
+        unit: np.ndarray = saltelli_design(len(parameters), samples, seed)
+    else:
+        trajectories: int = spec.get("samples", 100)
+        unit, order, delta = morris_design(len(parameters), trajectories, spec.get("levels", 4), seed)
+    inputs: dict[str, np.ndarray] = {name: sensitivity_values(values, unit[:, i]) for i, (name, values) in enumerate(parameters)}
+    print(f"Evaluating {len(unit)} points of the {method} design over {len(parameters)} parameters...")
+
+    base: dict = base_rows.iloc[0].to_dict()
+    rows: list[dict] = [{name: plain(inputs[name][i]) for name in names} for i in range(len(unit))]
+    chunks: list[list[dict]] = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+    if workers == 1:
+        outputs: np.ndarray = np.concatenate([sensitivity_chunk(base, chunk, machine_settings, epp, time_step) for chunk in chunks])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outputs: np.ndarray = np.concatenate(list(executor.map(sensitivity_chunk, itertools.repeat(base), chunks, 
+                                                                   itertools.repeat(machine_settings), itertools.repeat(epp), 
+                                                                   itertools.repeat(time_step))))
+
+    samples_df: pd.DataFrame = pd.DataFrame(dict(inputs, **{column: outputs[:, j] for j, column in enumerate(KPI_COLUMNS)}))
+    samples_df.to_csv(f"{output}_samples.csv", index=False)
+
+    rng = np.random.default_rng(seed)
+    index_rows: list[dict] = []
+    for j, column in enumerate(KPI_COLUMNS):
+        if method == "sobol":
+            statistic = lambda rows: sobol_indices(outputs[:, j], len(parameters), rows)
+            first, total = statistic(np.arange(samples)[None])
+            first_low, first_high = bootstrap_interval(lambda rows: statistic(rows)[0], samples, resamples, confidence, rng)
+            total_low, total_high = bootstrap_interval(lambda rows: statistic(rows)[1], samples, resamples, confidence, rng)
+            index_rows += [{"kpi": column, "parameter": name, "first": first[i, 0], "first_low": first_low[i], "first_high": first_high[i], 
+                            "total": total[i, 0], "total_low": total_low[i], "total_high": total_high[i]} for i, name in enumerate(names)]
+        else:
+            # Elementary effect of every step of a trajectory on the parameter it moved
+            values: np.ndarray = outputs[:, j].reshape(trajectories, len(parameters) + 1)
+            effects: np.ndarray = np.empty((trajectories, len(parameters)))
+            np.put_along_axis(effects, order, np.diff(values, axis=1)/delta, axis=1)
+            low, high = bootstrap_interval(lambda rows: np.abs(effects[rows]).mean(axis=1).T, trajectories, resamples, confidence, rng)
+            index_rows += [{"kpi": column, "parameter": name, "mu": effects[:, i].mean(), "mu_star": np.abs(effects[:, i]).mean(), 
+                            "mu_star_low": low[i], "mu_star_high": high[i], "sigma": effects[:, i].std(ddof=1) if trajectories > 1 else np.nan} 
+                           for i, name in enumerate(names)]
+    indices: pd.DataFrame = pd.DataFrame(index_rows)
+    indices.to_csv(f"{output}_indices.csv", index=False)
+
+    measure: str = "total" if method == "sobol" else "mu_star"
+    print(f"{'first order and ' if method == 'sobol' else ''}{measure} indices of {base_name}, {confidence:.0%} bootstrap intervals in brackets")
+    for column in ("peak_power", "productivity"):
+        print(f"\n{column}")
+        for _, row in indices.loc[indices["kpi"] == column].sort_values(measure, ascending=False).iterrows():
+            first: str = f"first {row['first']:.3f} [{row['first_low']:.3f}, {row['first_high']:.3f}], " if method == "sobol" else ""
+            print(f"  {row['parameter']:<28}{first}{measure} {row[measure]:.3g} [{row[f'{measure}_low']:.3g}, {row[f'{measure}_high']:.3g}]")
+    print(f"\nYou can find every evaluated point in {output}_samples.csv and the indices in {output}_indices.csv.")
+    return indices
+
+# Seconds of the day the aggregate load curve of run_sites covers, sites that work past midnight wrap around
+DAY: int = 24*3600
+
+def site_cases(spec: dict, simulation_settings):
+    # Expands the sites of a sites file, every entry is a base scenario with settings replaced and count copies of it.
+    # The start time of copy i is value i of start_time, which can be a list or a "start:stop:step" range
+    for entry in spec["sites"]:
+        base_name: str = entry.get("base", simulation_settings["name"].iloc[0])
+        base_rows = simulation_settings.loc[simulation_settings["name"] == base_name]
+        if base_rows.empty:
+            raise ValueError(f"There is no simulation with the name: {base_name}.")
+        count: int = entry.get("count", 1)
+        start_times: list = sweep_values(entry.get("start_time", base_rows["start_time"].iloc[0]))
+        for i in range(count):
+            site: dict = dict(base_rows.iloc[0].to_dict(), **entry.get("settings", {}))
+            site["name"] = entry.get("name", base_name) + (f"_{i}" if count > 1 else "")
+            site["start_time"] = int(start_times[i % len(start_times)])
+            yield site
+
+def sites_chunk(sites: list[dict], machine_settings, epp, engine: str = "event") -> tuple[np.ndarray, list[dict]]:
+    # Worker of run_sites, returns the sum of the grid power of its sites over the day and the KPIs of every site. 
+    # Only the grid power of a site is kept and dropped as soon as it is added, so a worker only holds one site at a time
+    load: np.ndarray = np.zeros(DAY)
+    rows: list[dict] = []
+    if engine == "batch":
+        results: dict = batch_worksite(epp=epp, scenarios=[scenario_config(site, machine_settings) for site in sites]).run(keep_power=True)
+        powers = (np.nan_to_num(results["power"][i, :site["workday"]]) for i, site in enumerate(sites))
+        productivity: list[float] = list(results["productivity"])
+    else:
+        productivity: list[float] = []
+        def run(site: dict) -> np.ndarray:
+            machine_config = machine_settings.loc[machine_settings["size"] == str(site["size_setting"])]
+            result: dict = run_simulation(pd.DataFrame([site]), machine_config, epp, engine, resolution=None, keep_power=True)
+            productivity.append(result["productivity"])
+            return result["power"]
+        powers = (run(site) for site in sites)
+
+    for site, power in zip(sites, powers):
+        # Workdays past midnight, or longer than a day, fold over the same clock
+        load += np.bincount((site["start_time"] + np.arange(len(power))) % DAY, weights=power, minlength=DAY)
+        peak: int = int(np.argmax(power))
+        rows.append({"name": site["name"], "start_time": site["start_time"], "num_chargers": site["num_chargers"], 
+                     "charging_power": site["charging_power"], "peak_power": float(power[peak]), 
+                     "peak_time": (site["start_time"] + peak) % DAY, "average_power": float(np.mean(power)), 
+                     "energy": float(np.sum(power)/3600), "productivity": float(productivity[len(rows)])})
+    return load, rows
+
+def clock(seconds: int) -> str:
+    return f"{int(seconds)//3600 % 24:02d}:{int(seconds) % 3600//60:02d}"
+
+def run_sites(spec: dict, simulation_settings, machine_settings, epp, jobs=1, output="./sites") -> dict:
+    # Many sites on the same grid connection, sharded over processes. Only the summed load curve of a shard and 
+    # one row per site come back, and the shards are added in order so the result does not depend on the jobs
+    engine: str = spec.get("engine", "event")
+    resolution: int = spec.get("resolution", 60)
+    chunk_size: int = spec.get("chunk_size", 32 if engine == "batch" else 8)
+    workers: int = jobs or os.cpu_count()
+    sites = site_cases(spec, simulation_settings)
+    chunks = iter(lambda: list(itertools.islice(sites, chunk_size)), [])
+
+    load: np.ndarray = np.zeros(DAY)
+    rows: list[dict] = []
+    if workers == 1:
+        parts = (sites_chunk(chunk, machine_settings, epp, engine) for chunk in chunks)
+        for part_load, part_rows in parts:
+            load += part_load
+            rows += part_rows
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for part_load, part_rows in executor.map(sites_chunk, chunks, itertools.repeat(machine_settings), 
+                                                     itertools.repeat(epp), itertools.repeat(engine)):
+                load += part_load
+                rows += part_rows
+    if not rows:
+        raise ValueError("The sites file has no sites.")
+
+    # The coincident peak is the highest load of all sites together, the diversity factor is the sum of the peaks of
+    # the single sites over it and the share of a site is its power when the coincident peak happens
+    peak_time: int = int(np.argmax(load))
+    sum_of_peaks: float = sum(row["peak_power"] for row in rows)
+    summary: dict = {"sites": len(rows), 
+                     "coincident_peak": float(load[peak_time]), 
+                     "coincident_peak_time": clock(peak_time), 
+                     "sum_of_site_peaks": sum_of_peaks, 
+                     "diversity_factor": sum_of_peaks/load[peak_time], 
+                     "coincidence_factor": load[peak_time]/sum_of_peaks, 
+                     "average_power": float(np.mean(load)), 
+                     "load_factor": float(np.mean(load)/load[peak_time]), 
+                     "energy": float(np.sum(load)/3600)}
+
+    pd.DataFrame(rows).to_csv(f"{output}_sites.csv", index=False)
+    _, load_max, load_mean = decimate(load, resolution)
+    pd.DataFrame({"time": [clock(time) for time in range(0, DAY, resolution)], "power": load_mean, "power_max": load_max}).to_csv(f"{output}_load.csv", index=False)
+    with open(f"{output}_summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"{summary['sites']} sites, coincident peak {summary['coincident_peak']:.0f} kW at {summary['coincident_peak_time']}, "
+          f"sum of the site peaks {summary['sum_of_site_peaks']:.0f} kW, diversity factor {summary['diversity_factor']:.2f}, "
+          f"load factor {summary['load_factor']:.2f}, energy {summary['energy']:.0f} kWh")
+    print(f"You can find the sites in {output}_sites.csv, the load curve in {output}_load.csv and the summary in {output}_summary.json.")
+    return summary
+
+# Settings loaded once in every worker of serve, see service_worker
+SERVICE_SETTINGS: dict = {}
+
+def service_worker(simulation_settings, machine_settings, epp) -> None:
+    SERVICE_SETTINGS.update(simulation_settings=simulation_settings, machine_settings=machine_settings, epp=epp)
+
+def service_ready() -> int:
+    return os.getpid()
+
+def service_series(values) -> list:
+    # Series as a JSON list with null where there is no value
+    values = np.asarray(values, dtype=float)
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+def service_request(request: dict) -> dict:
+    # Answers one request of serve. The scenario is the row "name" of simulation_settings (the first if not given) with 
+    # the columns in "settings" replaced, and "series" adds the series at "resolution" seconds per point (60 by default)
+    simulation_settings, machine_settings, epp = (SERVICE_SETTINGS[key] for key in ("simulation_settings", "machine_settings", "epp"))
+    name: str = request.get("name", simulation_settings["name"].iloc[0])
+    rows = simulation_settings.loc[simulation_settings["name"] == name]
+    if rows.empty:
+        raise ValueError(f"There is no simulation with the name: {name}.")
+    unknown: list[str] = [column for column in request.get("settings", {}) if column not in simulation_settings.columns and not column.startswith("num_")]
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}.")
+    scenario: dict = dict(rows.iloc[0].to_dict(), **request.get("settings", {}))
+    machine_config = machine_settings.loc[machine_settings["size"] == str(scenario["size_setting"])]
+    engine: str = request.get("engine", "event")
+
+    if engine == "batch":
+        if request.get("series"):
+            raise ValueError("The batch engine does not return series, use the step or event engine.")
+        results: dict = batch_worksite(epp=epp, scenarios=[scenario_config(scenario, machine_config)]).run()
+        return {"name": name, **{column: float(results[column][0]) for column in KPI_COLUMNS}}
+    if engine not in ("step", "event"):
+        raise ValueError(f"Unknown engine: {engine}.")
+
+    resolution: int = int(request.get("resolution", 60)) if request.get("series") else None
+    result: dict = run_simulation(pd.DataFrame([scenario]), machine_config, epp, engine, resolution=resolution)
+    response: dict = dict({"name": name}, **{column: float(result[column]) for column in KPI_COLUMNS}, 
+                          queue_wait={machine_id: int(wait) for machine_id, wait in result["queue_wait"].items()}, 
+                          min_battery_level={machine_id: float(level) for machine_id, level in result["min_battery_level"].items()})
+    if resolution is not None:
+        response["series"] = {"resolution": resolution, "power": service_series(result["power"]), 
+                              "active_machines": service_series(result["active_machines"]), 
+                              "battery_levels": {machine_id: service_series(levels) for machine_id, levels in result["battery_levels"].items()}}
+    return response
+
+class service():
+    # Long-lived headless mode, answers scenario requests given as JSON lines with a pool of warm worker processes that 
+    # have loaded the settings once. Requests run concurrently and every response is one JSON line with the id of its 
+    # request, so the responses come in the order the simulations finish
+    def __init__(self, simulation_settings, machine_settings, epp, jobs: int = 1) -> None:
+        self.workers: int = jobs or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=service_worker, 
+                                            initargs=(simulation_settings, machine_settings, epp))
+        # Starts the workers before the first request
+        for future in [self.executor.submit(service_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, line: str, respond) -> None:
+        # Starts the request on a line and calls respond with the response line once it is done
+        try:
+            request: dict = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request has to be a JSON object.")
+        except ValueError as error:
+            respond(json.dumps({"id": None, "error": str(error)}))
+            return
+        started: float = perf_counter()
+
+        def done(future) -> None:
+            try:
+                response: dict = dict({"id": request.get("id")}, **future.result())
+            except Exception as error:
+                response = {"id": request.get("id"), "error": str(error)}
+            response["wall_time"] = perf_counter() - started
+            respond(json.dumps(response))
+        self.executor.submit(service_request, request).add_done_callback(done)
+
+    def serve_stream(self, stream_in, stream_out) -> None:
+        # Reads requests until the end of stream_in and returns when all of them are answered
+        lock = threading.Lock()
+        pending = threading.Semaphore(0)
+        count: int = 0
+
+        def respond(line: str) -> None:
+            with lock:
+                stream_out.write(line + "\n")
+                stream_out.flush()
+            pending.release()
+
+        for line in stream_in:
+            if line.strip():
+                count += 1
+                self.submit(line, respond)
+        for _ in range(count):
+            pending.acquire()
+
+    def serve_port(self, port: int) -> None:
+        # Accepts connections on localhost, every connection sends JSON lines and gets a response line for each
+        owner: service = self
+
+        class handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                lines = (line.decode() for line in self.rfile)
+                output = self.wfile
+                class stream_out():
+                    def write(self, text: str) -> None:
+                        output.write(text.encode())
+                    def flush(self) -> None:
+                        output.flush()
+                owner.serve_stream(lines, stream_out())
+
+        class server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        with server(("127.0.0.1", port), handler) as listener:
+            print(f"Serving on 127.0.0.1:{listener.server_address[1]} with {self.workers} workers.", file=sys.stderr)
+            try:
+                listener.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+def serve(simulation_settings, machine_settings, epp, jobs=1, port=None) -> None:
+    # Answers requests on stdin, or on a local port if given, until stdin ends or the server is stopped
+    runner: service = service(simulation_settings, machine_settings, epp, jobs)
+    try:
+        if port is None:
+            print(f"Reading requests from stdin with {runner.workers} workers.", file=sys.stderr)
+            runner.serve_stream(sys.stdin, sys.stdout)
+        else:
+            runner.serve_port(port)
+    finally:
+        runner.close()
 
+def main(power_profile, machines, simulation_settings, save=False, show=True, grid=False, engine="step", jobs=1, cache=None, sweep=None, 
+         min_chargers=None, target=98, charging_powers=None, monte_carlo=None, resolution=1, instrument=None, days=None, 
+         checkpoints=None, from_day=None, store=None, skip_existing=False, query=None, order=None, serve_requests=False, port=None, sites=None, 
+         time_step=1, time_step_error=False, sensitivity=None):
+    if query is not None:
+        print_query(store or results_store(), query or None, order)
+        return
 
-    return print("Finished. You can find the plots in figs_simulation and the results in results.txt.")
+    if skip_existing and store is None:
+        return print("--skip-existing reads the results store and can not be used with --no-results.")
 
-def main(power_profile, machines, simulation_settings, save=False, show=True, grid=False):
     if power_profile == None or machines == None or simulation_settings == None:
         return print("All needed files are not provided.")
 
+    if serve_requests:
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        serve(simulation_settings, machines, power_profile, jobs=jobs, port=port)
+        return
+
+    if min_chargers is not None:
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        powers: list = None
+        if charging_powers is not None:
+            powers = [float(power) for power in charging_powers.split(",")] if ":" not in charging_powers else sweep_values(charging_powers)
+        find_min_chargers(min_chargers, simulation_settings, machines, power_profile, productivity_target=target/100, 
+                          charging_powers=powers, engine="event" if engine == "batch" else engine)
+        return
+
+    if sweep is not None:
+        print(f"Running the sweep in {sweep}...")
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        with open(sweep) as f:
+            spec: dict = json.load(f)
+        run_sweep(spec, simulation_settings, machines, power_profile, jobs=jobs, output=os.path.splitext(sweep)[0], store=store, skip_existing=skip_existing)
+        return
+
+    if sites is not None:
+        print(f"Running the sites in {sites}...")
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        with open(sites) as f:
+            spec: dict = json.load(f)
+        run_sites(spec, simulation_settings, machines, power_profile, jobs=jobs, output=os.path.splitext(sites)[0])
+        return
+
+    if sensitivity is not None:
+        print(f"Running the sensitivity analysis in {sensitivity}...")
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        with open(sensitivity) as f:
+            spec: dict = json.load(f)
+        run_sensitivity(spec, simulation_settings, machines, power_profile, jobs=jobs, output=os.path.splitext(sensitivity)[0])
+        return
+
+    if monte_carlo is not None:
+        print(f"Running the Monte Carlo simulation in {monte_carlo}...")
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        with open(monte_carlo) as f:
+            spec: dict = json.load(f)
+        run_monte_carlo(spec, simulation_settings, machines, power_profile, jobs=jobs, output=os.path.splitext(monte_carlo)[0])
+        return
+
+    if days is not None:
+        if from_day is not None and checkpoints is None:
+            return print("--from-day continues from a stored day and needs --checkpoints.")
+        if from_day is not None and not 0 <= from_day <= days:
+            return print(f"--from-day has to be between 0 and --days ({days}), got {from_day}.")
+        print(f"Running {days} workdays in a row...")
+        simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
+        run_multi_day(simulation_settings, machines, power_profile, days, engine="event" if engine == "batch" else engine, jobs=jobs, 
+                      checkpoints=checkpoints, from_day=from_day, output=os.path.join(checkpoints or ".", "multi_day"), store=store)
+        return
+
+    if resolution < 1:
+        return print(f"The resolution has to be at least 1 second, got {resolution}.")
+
+    if time_step < 1:
+        return print(f"The time step has to be at least 1 second, got {time_step}.")
+
+    if time_step > 1 and (grid == True or instrument is not None):
+        return print("A time step above 1 second only gives the KPIs, use a time step of 1 second with the grid and instrument flags.")
+
+    if instrument is not None and engine == "batch":
+        return print("The batch engine can not be instrumented, use the step or event engine with the instrument flag.")
+
+    if grid == True and engine == "batch":
+        return print("The batch engine does not make any plots, use the step or event engine with the grid flag.")
+
     if grid == True:
         print("Special flag called. Plots combined figures, make sure the source code finds the correct scenarios. Specified in the function \"run_combined\".")
         simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
-        run_combined(simulation_settings, machines, power_profile)
+        run_combined(simulation_settings, machines, power_profile, engine=engine, jobs=jobs, cache=cache, resolution=resolution, instrument=instrument, store=store)
     else:
         print(f"Power profile file: {power_profile}")
         print(f"Machines file: {machines}")
         print(f"Simulation settings file: {simulation_settings}")
         print(f"Save plots: {save}")
         print(f"Show plots: {show}")
+        print(f"Engine: {engine}")
+        print(f"Jobs: {jobs}")
+        print(f"Resolution [s]: {resolution}")
+        print(f"Time step [s]: {time_step}")
+        print(f"Instrumentation sample interval [s]: {instrument}")
+        print(f"Results store: {store.directory if store is not None else None}")
         simulation_settings, machines, power_profile = setup_files(simulation_settings, machines, power_profile)
         all_or_one = input("Do you want to run all simulations? Please answer y/n. ")
         if all_or_one.lower().strip() == "y":
             print("\nRunning all simulations...")
-            run_all(simulation_settings, machines, power_profile, save=save, show=show)
+            run_all(simulation_settings, machines, power_profile, save=save, show=show, engine=engine, jobs=jobs, cache=cache, resolution=resolution, instrument=instrument, 
+                    store=store, skip_existing=skip_existing, time_step=time_step, time_step_error=time_step_error)
         elif all_or_one.lower().strip() == "n":
             which_sim = input("Which simulation do you want to run? Please answer with simulation name i.e. \"LAR3B350\". ")
             try:
                 print(f"\nRunning {which_sim}...")
-                run_single(which_sim, simulation_settings, machines, power_profile, save=save, show=show, grid=False)
+                run_single(which_sim, simulation_settings, machines, power_profile, save=save, show=show, grid=False, engine=engine, cache=cache, resolution=resolution, instrument=instrument, 
+                           store=store, time_step=time_step, time_step_error=time_step_error)
             except:
                 return print("Could not run the simulation.")
         else:
@@ -503,22 +3174,57 @@ if __name__ == "__main__":
         parser.add_argument("--save", action="store_true", help="Called to save the plots")
         parser.add_argument("--noshow", action="store_false", help="Called to not show the plots")
         parser.add_argument("--grid", action="store_true", help="Special flag called to plot on grid")
+        parser.add_argument("--engine", default="step", choices=["step", "event", "batch"], help="Simulation engine, \"event\" skips ahead to the next state change instead of stepping every second and \"batch\" runs all scenarios at once as arrays")
+        parser.add_argument("--jobs", type=int, default=1, help="Number of scenarios to run in parallel processes, 0 uses every core")
+        parser.add_argument("--no-cache", action="store_true", help="Called to always simulate and not use the result cache")
+        parser.add_argument("--refresh", action="store_true", help="Called to simulate again and overwrite the cached results")
+        parser.add_argument("--cache-dir", default="./.simulation_cache/", help="Directory of the result cache")
+        parser.add_argument("--cache-size", type=int, default=1024, help="Maximum size of the result cache in MB")
+        parser.add_argument("--sweep", default=None, help="Path to a sweep file (e.g., './sweep.json'), runs every combination of the swept settings")
+        parser.add_argument("--monte-carlo", default=None, help="Path to a Monte Carlo file (e.g., './monte_carlo.json'), runs replications with random duty cycles")
+        parser.add_argument("--sensitivity", default=None, help="Path to a sensitivity file (e.g., './sensitivity.json'), ranks the settings by their Sobol or Morris indices on the KPIs")
+        parser.add_argument("--sites", default=None, help="Path to a sites file (e.g., './sites.json'), runs many sites on the same grid connection and sums their load")
+        parser.add_argument("--min-chargers", default=None, help="Name of a simulation to find the fewest chargers that reach the productivity target for")
+        parser.add_argument("--target", type=float, default=98, help="Productivity target in percent used with --min-chargers")
+        parser.add_argument("--charging-powers", default=None, help="Charging powers to search with --min-chargers, a comma separated list or a range \"start:stop:step\"")
+        parser.add_argument("--days", type=int, default=None, help="Number of workdays to run every simulation for in a row, with the batteries carried over and charged overnight")
+        parser.add_argument("--checkpoints", default=None, help="Directory to store the state at the end of every day in with --days, a run continues from the last stored day")
+        parser.add_argument("--from-day", type=int, default=None, help="Day to continue from with --days and --checkpoints instead of the last stored one, 0 starts over")
+        parser.add_argument("--instrument", type=int, nargs="?", const=60, default=None, help="Called to count the events of every process and sample the chargers every INSTRUMENT seconds (60 if not given), written to ./instrumentation/")
+        parser.add_argument("--resolution", type=int, default=1, help="Seconds per point of the plotted series, above 1 only min/max/mean buckets are kept instead of every second")
+        parser.add_argument("--time-step", type=int, default=1, help="Seconds per step of a coarse screening run with the batch engine (e.g., 10 or 60), only the KPIs are computed")
+        parser.add_argument("--time-step-error", action="store_true", help="Called to also run at 1 second with --time-step and print the error of the peak power, energy and productivity")
+        parser.add_argument("--results", default="./results/", help="Directory of the results store every run is written to")
+        parser.add_argument("--no-results", action="store_true", help="Called to not write the runs to the results store")
+        parser.add_argument("--skip-existing", action="store_true", help="Called to skip the simulations and sweep cases that are already in the results store")
+        parser.add_argument("--query", nargs="?", const="", default=None, help="Called to list the stored results instead of running, optionally only those matching an SQL condition (e.g., \"num_chargers >= 4 AND productivity > 0.95\")")
+        parser.add_argument("--order", default=None, help="Column to sort the stored results by with --query (e.g., \"peak_power DESC\")")
+        parser.add_argument("--serve", action="store_true", help="Called to answer scenario requests given as JSON lines on stdin with --jobs warm worker processes instead of running")
+        parser.add_argument("--port", type=int, default=None, help="Local port to answer requests on with --serve instead of stdin")
         args = parser.parse_args()
 
-        power_profile = validate_file(args.power, "Power profile")
+        power_profile_file = validate_file(args.power, "Power profile")
         machines = validate_file(args.machine, "Machines")
         simulation_settings = validate_file(args.simulation, "Simulation settings")
+        cache = None if args.no_cache else result_cache(args.cache_dir, args.cache_size*1024**2, args.refresh)
+        # A query only reads the store, so it is opened even with --no-results
+        store = None if args.no_results and args.query is None else results_store(args.results)
 
-        main(power_profile, machines, simulation_settings, save=args.save, show=args.noshow, grid=args.grid)
+        main(power_profile_file, machines, simulation_settings, save=args.save, show=args.noshow, grid=args.grid, engine=args.engine, jobs=args.jobs, cache=cache, sweep=args.sweep, 
+             min_chargers=args.min_chargers, target=args.target, charging_powers=args.charging_powers, monte_carlo=args.monte_carlo, resolution=args.resolution, 
+             instrument=args.instrument, days=args.days, checkpoints=args.checkpoints, from_day=args.from_day, store=store, 
+             skip_existing=args.skip_existing, query=args.query, order=args.order, serve_requests=args.serve, port=args.port, 
+             sites=args.sites, time_step=args.time_step, time_step_error=args.time_step_error, 
+             sensitivity=args.sensitivity)
 
     else:
         print("No command-line arguments provided. Running with default configuration...")
 
-        power_profile = "./epp.csv"
+        power_profile_file = "./epp.csv"
         machines = "./machine_settings.csv"
         simulation_settings = "./simulation_settings.csv"
         
-        power_profile = validate_file(power_profile, "Default power profile")
+        power_profile_file = validate_file(power_profile_file, "Default power profile")
         machines = validate_file(machines, "Default machine settings")
         simulation_settings = validate_file(simulation_settings, "Default simulation settings")
 
@@ -526,4 +3232,4 @@ if __name__ == "__main__":
         show = True
         grid = False
 
-        main(power_profile, machines, simulation_settings, save=save, show=show, grid=grid)
+        main(power_profile_file, machines, simulation_settings, save=save, show=show, grid=grid, cache=result_cache(), store=results_store())
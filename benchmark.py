@@ -0,0 +1,203 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import simpy
+
+from EW_DES import worksite, prepare_data, setup_files, run_simulation
+
+# Default cases, the fleet is the total number of machines and the contention is chargers per battery machine. The 168h
+# workday is one long workday with the breaks of the 9h one, it measures how the engines scale with the horizon
+FLEETS: list[int] = [6, 60, 1000]
+WORKDAYS: dict[str, int] = {"9h": 9*3600, "168h": 168*3600}
+CONTENTION: dict[str, float] = {"none": 1, "moderate": 0.5, "severe": 0.1}
+ENGINES: list[str] = ["event", "step"]
+# worksite times the stages of a run on their own, run_simulation times the whole run the way the main program makes it
+PATHS: list[str] = ["worksite", "run_simulation"]
+
+class counting_environment(simpy.Environment):
+    # Counts every event the simulation processes
+    def __init__(self) -> None:
+        super().__init__()
+        self.events: int = 0
+
+    def step(self) -> None:
+        self.events += 1
+        super().step()
+
+def fleet(machines: int) -> dict:
+    # Every six machines are two wheel loaders, two dump trucks, one battery and one cable excavator
+    num_wl: int = machines//3
+    num_du: int = machines//3
+    num_ex_c: int = (machines - num_wl - num_du)//2
+    return {"num_wl": num_wl, "num_du": num_du, "num_ex_b": machines - num_wl - num_du - num_ex_c, "num_ex_c": num_ex_c}
+
+def cases(fleets: list[int], workdays: list[str], contention: list[str], engines: list[str], resolution: int,
+          max_step: float = None, max_series: float = None, paths: list[str] = PATHS) -> list[dict]:
+    # Cases as plain dicts so they can be sent to a fresh process. The ones over a budget are marked as skipped
+    selected: list[dict] = []
+    for path in paths:
+        for engine in engines:
+            for machines in fleets:
+                for workday in workdays:
+                    for level in contention:
+                        counts: dict = fleet(machines)
+                        battery_machines: int = machines - counts["num_ex_c"]
+                        name: str = f"{engine}-{machines}m-{workday}-{level}" + ("" if path == "worksite" else f"-{path}")
+                        case: dict = dict(counts, name=name, path=path, engine=engine, machines=machines, workday=WORKDAYS[workday], 
+                                          num_chargers=max(1, round(battery_machines*CONTENTION[level])), resolution=resolution)
+                        machine_seconds: int = machines*WORKDAYS[workday]
+                        series_mb: float = battery_machines*WORKDAYS[workday]*4/1024**2 if resolution == 1 else 0
+                        if max_step is not None and engine == "step" and machine_seconds > max_step:
+                            case["skipped"] = f"{machine_seconds:.2g} machine-seconds is over --max-step"
+                        elif max_series is not None and series_mb > max_series:
+                            case["skipped"] = f"{series_mb:.0f} MB of battery levels is over --max-series"
+                        selected.append(case)
+    return selected
+
+def run_case(case: dict, machine_settings, epp) -> dict:
+    # Builds and runs one worksite the same way as run_simulation and times every stage, runs in its own process
+    # so the peak memory is the one of this case
+    if case.get("path", "worksite") == "run_simulation":
+        return run_simulation_case(case, machine_settings, epp)
+    size: str = "lar"
+    def config(prefix: str, per_second: bool) -> dict:
+        row = machine_settings.loc[machine_settings["machine_id"] == prefix+size].iloc[0]
+        return {"battery_capacity": row["battery_capacity"], "operating_power": row["operating_power"]/3600 if per_second else row["operating_power"]}
+
+    env = counting_environment()
+    start: float = time.perf_counter()
+    site: worksite = worksite(env, epp=epp, num_chargers=case["num_chargers"], charging_power=150, charging_threshold=0.1,
+                              num_wl=case["num_wl"], num_ex_b=case["num_ex_b"], num_ex_c=case["num_ex_c"], num_du=case["num_du"],
+                              workday=case["workday"], wl_config=config("wl_", True), ex_config=config("ex_", False),
+                              du_config=config("du_", True), engine=case["engine"], resolution=case["resolution"])
+    built: float = time.perf_counter()
+    env.run(until=case["workday"])
+    site.finish()
+    simulated: float = time.perf_counter()
+    _, grid_power, active_machines = prepare_data(site, 18)
+    prepared: float = time.perf_counter()
+
+    return dict(case, events=env.events,
+                setup_s=built - start,
+                run_s=simulated - built,
+                prepare_s=prepared - simulated,
+                events_per_s=env.events/(simulated - built),
+                sim_seconds_per_s=case["workday"]/(simulated - built),
+                peak_power=float(np.max(grid_power)),
+                active_machine_hours=float(np.sum(active_machines)/3600),
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024)
+
+def run_simulation_case(case: dict, machine_settings, epp) -> dict:
+    # The same worksite through run_simulation, which makes its own environment, so only the whole run is timed and
+    # the events are not counted
+    simulation_settings = pd.DataFrame([{"name": case["name"], "workday": case["workday"], "break_1": 2*3600, "break_2": 5*3600, 
+                                         "break_duration": 30*60, "start_time": 7*3600, "num_chargers": case["num_chargers"], 
+                                         "charging_power": 150, "charging_threshold": 10, "base_load": 18, 
+                                         "num_wheel_loaders": case["num_wl"], "num_excavators_battery": case["num_ex_b"], 
+                                         "num_excavators_cable": case["num_ex_c"], "num_dumpers": case["num_du"], "size_setting": "lar"}])
+    start: float = time.perf_counter()
+    result: dict = run_simulation(simulation_settings, machine_settings.loc[machine_settings["size"] == "lar"], epp, case["engine"], 
+                                  resolution=case["resolution"])
+    simulated: float = time.perf_counter()
+
+    return dict(case, events=None,
+                setup_s=None,
+                run_s=simulated - start,
+                prepare_s=None,
+                events_per_s=None,
+                sim_seconds_per_s=case["workday"]/(simulated - start),
+                peak_power=float(result["peak_power"]),
+                active_machine_hours=float(result["productivity"]*case["machines"]*8),
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024)
+
+def number(value: float, spec: str) -> str:
+    # A column of the printed table, run_simulation cases have no events or prepare time
+    return "-" if value is None else format(value, spec)
+
+def run_benchmark(selected: list[dict], power_profile: str, machines: str, simulation: str, output: str) -> list[dict]:
+    _, machine_settings, epp = setup_files(simulation, machines, power_profile)
+    results: list[dict] = []
+    print(f"{'case':<40}{'events/s':>12}{'sim s/s':>12}{'prepare [s]':>13}{'peak RSS [MB]':>15}")
+    for case in selected:
+        if "skipped" in case:
+            print(f"{case['name']:<40}skipped, {case['skipped']}")
+            results.append(case)
+            continue
+        # A new process for every case, they run one at a time so they do not compete for the cores
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result: dict = executor.submit(run_case, case, machine_settings, epp).result()
+        print(f"{result['name']:<40}{number(result['events_per_s'], '.0f'):>12}{result['sim_seconds_per_s']:>12.0f}"
+              f"{number(result['prepare_s'], '.3f'):>13}{result['peak_rss_mb']:>15.0f}")
+        results.append(result)
+
+    with open(output, "w") as f:
+        json.dump({"python": platform.python_version(), "numpy": np.__version__, "simpy": simpy.__version__,
+                   "platform": platform.platform(), "cases": results}, f, indent=2)
+    print(f"Finished. You can find the results in {output}.")
+    return results
+
+def compare(baseline: str, current: str, tolerance: float) -> bool:
+    # Speed and memory of every case in both files, a case regresses when it is more than tolerance percent
+    # slower or uses more than tolerance percent more memory
+    with open(baseline) as f:
+        old: dict = {case["name"]: case for case in json.load(f)["cases"] if "skipped" not in case}
+    with open(current) as f:
+        new: dict = {case["name"]: case for case in json.load(f)["cases"] if "skipped" not in case}
+
+    regressions: list[str] = []
+    print(f"{'case':<40}{'sim s/s':>24}{'change':>9}{'peak RSS [MB]':>20}{'change':>9}")
+    for name in [name for name in old if name in new]:
+        before, after = old[name], new[name]
+        if before["resolution"] != after["resolution"]:
+            print(f"{name:<40}not compared, resolution {before['resolution']} s vs {after['resolution']} s")
+            continue
+        speed: float = after["sim_seconds_per_s"]/before["sim_seconds_per_s"] - 1
+        memory: float = after["peak_rss_mb"]/before["peak_rss_mb"] - 1
+        flag: str = ""
+        if speed < -tolerance/100 or memory > tolerance/100:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40}{before['sim_seconds_per_s']:>11.0f} -> {after['sim_seconds_per_s']:<9.0f}{speed:>+9.0%}"
+              f"{before['peak_rss_mb']:>9.0f} -> {after['peak_rss_mb']:<8.0f}{memory:>+9.0%}{flag}")
+    for name in sorted(old.keys() ^ new.keys()):
+        print(f"{name:<40}only in {baseline if name in old else current}")
+
+    if regressions:
+        print(f"{len(regressions)} of the cases regressed by more than {tolerance:g}%.")
+    else:
+        print(f"No case regressed by more than {tolerance:g}%.")
+    return not regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the speed and memory of the simulation engines on synthetic worksites.")
+    parser.add_argument("--power", default="./epp.csv", help="Path to the power profile file")
+    parser.add_argument("--machine", default="./machine_settings.csv", help="Path to the machines file, the large machines are used")
+    parser.add_argument("--simulation", default="./simulation_settings.csv", help="Path to the simulation settings file")
+    parser.add_argument("--fleets", default=",".join(str(machines) for machines in FLEETS), help="Comma separated number of machines")
+    parser.add_argument("--workdays", default=",".join(WORKDAYS), help=f"Comma separated workdays out of {', '.join(WORKDAYS)}")
+    parser.add_argument("--contention", default=",".join(CONTENTION), help=f"Comma separated charger contention out of {', '.join(CONTENTION)}")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma separated engines out of step, event")
+    parser.add_argument("--paths", default=",".join(PATHS), help=f"Comma separated ways to run a case out of {', '.join(PATHS)}")
+    parser.add_argument("--resolution", type=int, default=1, help="Seconds per point of the battery level series, see EW_DES.py --resolution")
+    parser.add_argument("--max-step", type=float, default=2e7, help="Skip step engine cases with more machine-seconds than this, inf runs them all")
+    parser.add_argument("--max-series", type=float, default=1024, help="Skip cases whose battery levels at 1 second take more MB than this, inf runs them all")
+    parser.add_argument("--output", default="./benchmark.json", help="Path to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), default=None, help="Compare two result files instead of running")
+    parser.add_argument("--tolerance", type=float, default=10, help="Allowed slowdown or memory growth in percent with --compare")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        sys.exit(0 if compare(*args.compare, args.tolerance) else 1)
+
+    selected: list[dict] = cases([int(machines) for machines in args.fleets.split(",")], args.workdays.split(","),
+                                 args.contention.split(","), args.engines.split(","), args.resolution, args.max_step, args.max_series, 
+                                 args.paths.split(","))
+    run_benchmark(selected, args.power, args.machine, args.simulation, args.output)
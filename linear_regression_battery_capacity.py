@@ -1,10 +1,10 @@
-import matplotlib.pyplot as plt 
+import argparse
+
+import matplotlib.pyplot as plt
 import pandas as pd
 from scipy import stats
 import numpy as np
 
-plt.style.use('leostyle3.mplstyle')
-
 data_all: dict = {"Vikt": [24550,2730,1830,1960,1201,1907,11900,25400,4550,5085,20300,6005,2260,2950,5200,18000,900,1120,19000], "Batterikapacitet": [264,20,16,20,12.7,17.3,150,300,40,40,237,64,23.4,28,141,282,6,9,282]}
 
 df_all = pd.DataFrame(data=data_all)
@@ -16,7 +16,72 @@ dump_stor_vikt = 39000
 hjul_stor_vikt = 32150
 band_stor_vikt = 49400
 
+# Machines of machine_settings.csv whose battery capacity is estimated from their weight, with the machines the line
+# is fitted to. There are no battery dump trucks in the data so they use all machines, ex_med and wl_med are in the data
+CLASSES: dict = {"ex": df_ex, "wl": df_wl, "all": df_all}
+MACHINES: dict = {"ex_lar": ("ex", band_stor_vikt), "wl_lar": ("wl", hjul_stor_vikt),
+                  "du_lar": ("all", dump_stor_vikt), "du_med": ("all", dump_liten_vikt)}
+
+def fit_lines(weights: np.ndarray, capacities: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Least squares lines along the last axis, so one call fits every bootstrap resample. Returns nan for a resample
+    # where all weights are the same
+    weight_mean: np.ndarray = weights.mean(axis=-1, keepdims=True)
+    capacity_mean: np.ndarray = capacities.mean(axis=-1, keepdims=True)
+    spread: np.ndarray = weights - weight_mean
+    sxx: np.ndarray = np.sum(spread**2, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope: np.ndarray = np.sum(spread*(capacities - capacity_mean), axis=-1)/sxx
+    return slope, capacity_mean[..., 0] - slope*weight_mean[..., 0]
+
+def bootstrap_lines(weights: np.ndarray, capacities: np.ndarray, resamples: int, rng) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Lines fitted to resamples of the machines drawn with replacement, as (slope, intercept, residual) where residual is
+    # the deviation of a random machine of the resample from its line, scaled up for the degrees of freedom of the fit
+    n: int = len(weights)
+    picks: np.ndarray = rng.integers(0, n, (resamples, n))
+    slope, intercept = fit_lines(weights[picks], capacities[picks])
+    flat: np.ndarray = np.isnan(slope)
+    while flat.any():
+        # The rare resample of a single machine has no line, it is drawn again
+        picks[flat] = rng.integers(0, n, (int(flat.sum()), n))
+        slope[flat], intercept[flat] = fit_lines(weights[picks[flat]], capacities[picks[flat]])
+        flat = np.isnan(slope)
+    rows: np.ndarray = np.arange(resamples)
+    machine: np.ndarray = picks[rows, rng.integers(0, n, resamples)]
+    residual: np.ndarray = (capacities[machine] - intercept - slope*weights[machine])*np.sqrt(n/(n - 2))
+    return slope, intercept, residual
+
+def capacity_samples(resamples: int = 5000, seed: int = 0, scatter: bool = True) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # Battery capacities of the machines in MACHINES for every bootstrap resample, one column per machine_id. Machines
+    # of the same class share the resample. With scatter the capacities include the deviation of single machines from
+    # the line, without it only the uncertainty of the line
+    rng = np.random.default_rng(seed)
+    samples: dict = {"sample": np.arange(resamples)}
+    summary: list[dict] = []
+    for name, df in CLASSES.items():
+        weights: np.ndarray = df["Vikt"].to_numpy(dtype=float)
+        capacities: np.ndarray = df["Batterikapacitet"].to_numpy(dtype=float)
+        slope, intercept, residual = bootstrap_lines(weights, capacities, resamples, rng)
+        fit_slope, fit_intercept = fit_lines(weights, capacities)
+        for machine_id, (group, weight) in MACHINES.items():
+            if group != name:
+                continue
+            # At least 1 kWh, a line through light machines can go below zero far from the data
+            samples[machine_id] = np.maximum(intercept + slope*weight + (residual if scatter else 0), 1)
+            low, median, high = np.percentile(samples[machine_id], [2.5, 50, 97.5])
+            summary.append({"machine_id": machine_id, "class": name, "weight": weight, "battery_capacity": float(fit_intercept + fit_slope*weight),
+                            "p2.5": low, "p50": median, "p97.5": high})
+    return pd.DataFrame(samples), pd.DataFrame(summary)
+
+def update_machine_settings(path: str, summary: pd.DataFrame) -> None:
+    # Writes the fitted capacities rounded to whole kWh into the battery_capacity column of a machine_settings file
+    machine_settings: pd.DataFrame = pd.read_csv(path)
+    fitted: pd.Series = summary.set_index("machine_id")["battery_capacity"].round()
+    rows: pd.Series = machine_settings["machine_id"].isin(fitted.index)
+    machine_settings.loc[rows, "battery_capacity"] = machine_settings.loc[rows, "machine_id"].map(fitted).astype(machine_settings["battery_capacity"].dtype)
+    machine_settings.to_csv(path, index=False)
+
 def all_in_same():
+    plt.style.use('leostyle3.mplstyle')
     all_slope, all_intercept, all_r_value, all_p_value, all_std_err = stats.linregress(df_all['Vikt'], df_all['Batterikapacitet'])
     ex_slope, ex_intercept, ex_r_value, ex_p_value, ex_std_err = stats.linregress(df_ex['Vikt'], df_ex['Batterikapacitet'])
     wl_slope, wl_intercept, wl_r_value, wl_p_value, wl_std_err = stats.linregress(df_wl['Vikt'], df_wl['Batterikapacitet'])
@@ -44,11 +109,24 @@ def all_in_same():
     plt.tight_layout()
     plt.savefig(f"./lin_reg/lin_reg_all_in_same.png", dpi=300)
     plt.show()
-    
-
-if __name__ == "__main__":
-    all_in_same()
-
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate battery capacities from machine weights with bootstrapped linear regressions.")
+    parser.add_argument("--resamples", type=int, default=5000, help="Number of bootstrap resamples, one battery capacity per machine each")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the resampling")
+    parser.add_argument("--line-only", action="store_true", help="Only the uncertainty of the fitted lines, without the scatter of single machines around them")
+    parser.add_argument("--output", default="./battery_capacity_samples.csv", help="Path to write the battery capacities of every resample to")
+    parser.add_argument("--update", default=None, help="Path to a machines file (e.g., './machine_settings.csv') to write the fitted battery capacities to")
+    parser.add_argument("--plot", action="store_true", help="Plot the lines and machines")
+    args = parser.parse_args()
 
+    samples, summary = capacity_samples(args.resamples, args.seed, not args.line_only)
+    samples.to_csv(args.output, index=False)
+    print(summary.to_string(index=False, float_format=lambda value: f"{value:.1f}"))
+    print(f"You can find the battery capacities of {args.resamples} resamples in {args.output}.")
+    if args.update is not None:
+        update_machine_settings(args.update, summary)
+        print(f"The fitted battery capacities are written to {args.update}.")
+    if args.plot:
+        all_in_same()
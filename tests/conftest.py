@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import EW_DES
+
+
+@pytest.fixture(scope="session")
+def settings():
+    # The simulation settings, machines and power profile shipped with the repository
+    return EW_DES.setup_files(os.path.join(ROOT, "simulation_settings.csv"), os.path.join(ROOT, "machine_settings.csv"),
+                              os.path.join(ROOT, "epp.csv"))
@@ -0,0 +1,227 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import EW_DES
+
+# The step, event and batch engines count the same inactive machine seconds and take the same draws one after the
+# other, their KPIs only differ by the rounding of the sums
+TOLERANCE: float = 1e-9
+
+
+def random_config(rng, policy: str) -> dict:
+    # A worksite with random breaks, chargers and fleet, every kind of machine and every threshold up to well above the
+    # charging cutoff is drawn now and then
+    workday: int = int(rng.integers(5, 11))*3600
+    break_duration: int = int(rng.choice([600, 1200, 1800]))
+    break_1: int = int(rng.integers(1800, workday//2 - break_duration))
+    break_2: int = int(rng.integers(break_1 + break_duration + 60, workday - break_duration - 1800))
+    config: dict = {"name": "random", "workday": workday, "break_1": break_1, "break_2": break_2, "break_duration": break_duration,
+                    "start_time": 25200, "num_chargers": int(rng.integers(1, 5)), "charging_power": int(rng.choice([50, 100, 150, 250, 350])),
+                    "charging_threshold": int(rng.choice([0, 5, 10, 20, 30, 60])), "base_load": 18,
+                    "num_wheel_loaders": int(rng.integers(0, 4)), "num_excavators_battery": int(rng.integers(0, 3)),
+                    "num_excavators_cable": int(rng.integers(0, 3)), "num_dumpers": int(rng.integers(0, 4)),
+                    "size_setting": str(rng.choice(["lar", "med"])), "charging_policy": policy,
+                    "grid_limit": float(rng.choice([300, 600, 900])) if policy in ("capped", "valley") else np.nan}
+    if config["num_wheel_loaders"] + config["num_excavators_battery"] + config["num_dumpers"] == 0:
+        config["num_dumpers"] = 1
+    return config
+
+
+def configs(seed: int, count: int) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    return [random_config(rng, policy) for _ in range(count) for policy in EW_DES.CHARGING_POLICIES]
+
+
+def kpis(result: dict, i: int = None) -> list[float]:
+    return [float(result[kpi] if i is None else result[kpi][i]) for kpi in EW_DES.KPI_COLUMNS]
+
+
+@pytest.fixture(scope="module")
+def engine_results(settings):
+    # 3 random worksites of every charging policy with every engine, the batch engine runs them all at once
+    _, machine_settings, epp = settings
+    cases: list[dict] = configs(2024, 3)
+    batch: dict = EW_DES.batch_worksite(epp=epp, scenarios=[EW_DES.scenario_config(case, machine_settings) for case in cases]).run()
+    results: list[dict] = []
+    for i, case in enumerate(cases):
+        machine_config = machine_settings.loc[machine_settings["size"] == case["size_setting"]]
+        results.append({"case": case, "batch": kpis(batch, i),
+                        **{engine: kpis(EW_DES.run_simulation(pd.DataFrame([case]), machine_config, epp, engine))
+                           for engine in ("step", "event")}})
+    return results
+
+
+@pytest.mark.parametrize("index", range(3*len(EW_DES.CHARGING_POLICIES)))
+def test_engines_agree_on_random_worksites(engine_results, index):
+    result: dict = engine_results[index]
+    assert result["event"] == pytest.approx(result["step"], rel=TOLERANCE), result["case"]
+    assert result["batch"] == pytest.approx(result["step"], rel=TOLERANCE), result["case"]
+
+
+def test_engines_agree_on_series(settings):
+    # Every second of the power, active machines and battery levels, on a site where machines queue, run empty after the
+    # charging cutoff and excavators wait for the end of their cycle
+    simulation_settings, machine_settings, epp = settings
+    case: dict = dict(simulation_settings.iloc[6].to_dict(), num_chargers=1, charging_power=50, charging_threshold=30,
+                      charging_policy="fifo", grid_limit=np.nan)
+    machine_config = machine_settings.loc[machine_settings["size"] == case["size_setting"]]
+    step: dict = EW_DES.run_simulation(pd.DataFrame([case]), machine_config, epp, "step")
+    event: dict = EW_DES.run_simulation(pd.DataFrame([case]), machine_config, epp, "event")
+    batch: dict = EW_DES.batch_worksite(epp=epp, scenarios=[EW_DES.scenario_config(case, machine_settings)]).run(keep_series=True)
+    workday: int = case["workday"]
+
+    assert min(step["active_machines"]) < max(step["active_machines"]) - 1
+    np.testing.assert_array_equal(event["active_machines"], step["active_machines"])
+    np.testing.assert_array_equal(batch["active_machines"][0][:workday], step["active_machines"])
+    np.testing.assert_allclose(event["power"], step["power"], rtol=TOLERANCE)
+    np.testing.assert_allclose(batch["power"][0][1:workday], np.asarray(step["power"])[1:], rtol=TOLERANCE)
+    for m, machine_id in enumerate(step["battery_levels"]):
+        np.testing.assert_array_equal(event["battery_levels"][machine_id], step["battery_levels"][machine_id])
+        np.testing.assert_allclose(batch["battery_levels"][0][m][1:workday], step["battery_levels"][machine_id][1:], rtol=1e-6)
+
+
+def test_sweep_is_the_same_on_batch_and_event(settings, tmp_path):
+    simulation_settings, machine_settings, epp = settings
+    spec: dict = {"base": "LAR3B150", "num_chargers": "1:2:1", "charging_power": [50, 150], "charging_threshold": [10, 40]}
+    rows: dict = {}
+    for engine in ("batch", "event"):
+        EW_DES.run_sweep(dict(spec, engine=engine), simulation_settings, machine_settings, epp, output=str(tmp_path/engine))
+        rows[engine] = pd.read_csv(tmp_path/f"{engine}_results.csv")
+    assert len(rows["batch"]) == 8
+    pd.testing.assert_frame_equal(rows["batch"][["name"] + EW_DES.SWEEP_PARAMETERS], rows["event"][["name"] + EW_DES.SWEEP_PARAMETERS])
+    for kpi in EW_DES.KPI_COLUMNS:
+        np.testing.assert_allclose(rows["batch"][kpi], rows["event"][kpi], rtol=TOLERANCE)
+
+
+def test_monte_carlo_is_the_same_on_batch_and_event(settings, tmp_path):
+    # Without random cycle times, breaks and powers a replication only differs in the battery capacities of its sample,
+    # which the event engine runs as its own machine settings
+    simulation_settings, machine_settings, epp = settings
+    samples: pd.DataFrame = pd.DataFrame({"wl_lar": [120, 200, 320], "du_lar": [90, 150, 400], "ex_lar": [180, 264, 150]})
+    samples.to_csv(tmp_path/"capacities.csv", index=False)
+    spec: dict = {"scenarios": ["LAR3B150"], "replications": 3, "battery_capacity": str(tmp_path/"capacities.csv"), 
+                  "cycle_jitter": 0, "break_offset": 0, "power_scale": 0}
+    EW_DES.run_monte_carlo(spec, simulation_settings, machine_settings, epp, output=str(tmp_path/"monte_carlo"))
+    replications: pd.DataFrame = pd.read_csv(tmp_path/"monte_carlo_replications.csv")
+    simulation = simulation_settings.loc[simulation_settings["name"] == "LAR3B150"]
+    for i, capacities in samples.iterrows():
+        machines = machine_settings.copy()
+        machines.loc[machines["machine_id"].isin(samples.columns), "battery_capacity"] = machines["machine_id"].map(capacities)
+        event: dict = EW_DES.run_simulation(simulation, machines.loc[machines["size"] == "lar"], epp, "event", resolution=None)
+        assert kpis(replications.iloc[i]) == pytest.approx(kpis(event), rel=TOLERANCE), i
+
+
+def test_sensitivity_is_the_same_on_batch_and_event(settings, tmp_path):
+    # Every point of the design run again with the event engine, with settings and a machine setting among the inputs
+    simulation_settings, machine_settings, epp = settings
+    spec: dict = {"base": "MED3B150", "method": "morris", "samples": 2, "levels": 4, "resamples": 10, 
+                  "parameters": {"num_chargers": [1, 2], "charging_threshold": [5, 40], "wl_med.battery_capacity": [30, 80], 
+                                 "charging_policy": ["fifo", "soc"]}}
+    EW_DES.run_sensitivity(spec, simulation_settings, machine_settings, epp, output=str(tmp_path/"sensitivity"))
+    points: pd.DataFrame = pd.read_csv(tmp_path/"sensitivity_samples.csv")
+    base: dict = simulation_settings.loc[simulation_settings["name"] == "MED3B150"].iloc[0].to_dict()
+    for _, point in points.iterrows():
+        machines = machine_settings.copy()
+        machines.loc[machines["machine_id"] == "wl_med", "battery_capacity"] = point["wl_med.battery_capacity"]
+        case: dict = dict(base, num_chargers=point["num_chargers"], charging_threshold=point["charging_threshold"], 
+                          charging_policy=point["charging_policy"])
+        event: dict = EW_DES.run_simulation(pd.DataFrame([case]), machines.loc[machines["size"] == "med"], epp, "event", resolution=None)
+        assert kpis(point) == pytest.approx(kpis(event), rel=TOLERANCE), case
+
+
+@pytest.mark.parametrize("time_step", [10, 60])
+def test_coarse_time_step_against_event(settings, time_step):
+    # The coarse batch engine against the event engine on the shipped worksites with every policy, peak power is exact and
+    # energy and productivity stay within the accuracy the README states
+    simulation_settings, machine_settings, epp = settings
+    cases: list[dict] = [dict(row, charging_policy=policy, grid_limit=600 if policy in ("capped", "valley") else np.nan)
+                         for row in simulation_settings.iloc[::3].to_dict("records") for policy in EW_DES.CHARGING_POLICIES]
+    coarse: dict = EW_DES.batch_worksite(epp=epp, scenarios=[EW_DES.scenario_config(case, machine_settings) for case in cases]).run_coarse(time_step)
+    for i, case in enumerate(cases):
+        machine_config = machine_settings.loc[machine_settings["size"] == case["size_setting"]]
+        event: dict = EW_DES.run_simulation(pd.DataFrame([case]), machine_config, epp, "event")
+        assert coarse["peak_power"][i] == pytest.approx(event["peak_power"], rel=TOLERANCE), case
+        assert coarse["energy"][i] == pytest.approx(event["energy"], rel=2e-3), case
+        assert coarse["productivity"][i] == pytest.approx(event["productivity"], rel=5e-3), case
+
+
+def test_charger_queue_removal():
+    queue = EW_DES.charger_queue()
+    requests: list = [type("request", (), {"priority": (time, 0)})() for time in (3, 1, 2, 0)]
+    for request in requests:
+        queue.append(request)
+    queue.remove(requests[3])
+    queue.remove(requests[1])
+    with pytest.raises(ValueError):
+        queue.remove(requests[1])
+
+    assert len(queue) == 2
+    assert list(queue) == [requests[2], requests[0]]
+    assert queue[0] is requests[2]
+    assert queue.pop() is requests[2]
+    assert queue.pop() is requests[0]
+    assert not queue
+
+
+def test_shared_profile_file_is_removed():
+    # A long profile travels as a memory-mapped file, which the process that wrote it removes at exit
+    profile = EW_DES.power_profile(np.random.default_rng(0).random(EW_DES.SHARED_PROFILE_SAMPLES))
+    copy = pickle.loads(pickle.dumps(profile))
+    assert isinstance(copy.ratios, np.memmap)
+    assert np.array_equal(copy.ratios, profile.ratios)
+    (path,) = [path for path in EW_DES.shared_profile_files if path.endswith(f"_{os.getpid()}.npy")]
+    del copy
+    EW_DES.remove_shared_profiles()
+    assert not os.path.exists(path)
+    assert path not in EW_DES.shared_profile_files
+
+
+def test_sites_fold_a_workday_longer_than_a_day(settings):
+    # A site that starts in the evening and works for 30 hours adds its power to the same clock twice
+    simulation_settings, machine_settings, epp = settings
+    site: dict = dict(simulation_settings.iloc[0].to_dict(), name="long", start_time=20*3600, workday=30*3600,
+                      charging_policy="fifo", grid_limit=np.nan)
+    machine_config = machine_settings.loc[machine_settings["size"] == site["size_setting"]]
+    power: np.ndarray = np.asarray(EW_DES.run_simulation(pd.DataFrame([site]), machine_config, epp, "event")["power"])
+    expected: np.ndarray = np.zeros(EW_DES.DAY)
+    for time, value in enumerate(power):
+        expected[(site["start_time"] + time) % EW_DES.DAY] += value
+
+    event_load, (event_row,) = EW_DES.sites_chunk([site], machine_settings, epp, "event")
+    batch_load, (batch_row,) = EW_DES.sites_chunk([site], machine_settings, epp, "batch")
+    np.testing.assert_allclose(event_load, expected, rtol=TOLERANCE)
+    np.testing.assert_allclose(batch_load, expected, rtol=TOLERANCE)
+    assert event_row["energy"] == pytest.approx(batch_row["energy"], rel=TOLERANCE)
+
+
+def test_overnight_charge_without_chargers():
+    levels: dict = {"wl_1": 10.0, "du_1": 50.0}
+    capacities: dict = {"wl_1": 100.0, "du_1": 100.0}
+    assert EW_DES.overnight_charge(levels, capacities, ["wl_1"], 0, 50, 8*3600) == (levels, 0.0)
+    charged, energy = EW_DES.overnight_charge(levels, capacities, ["wl_1"], 1, 50, 3600)
+    assert charged == {"wl_1": 60.0, "du_1": 50.0}
+    assert energy == pytest.approx(50)
+
+
+def test_run_days_rejects_from_day_it_can_not_continue_from(settings, tmp_path):
+    simulation_settings, machine_settings, epp = settings
+    sim_df = simulation_settings.iloc[[0]]
+    machine_config = machine_settings.loc[machine_settings["size"] == sim_df["size_setting"].iloc[0]]
+    with pytest.raises(ValueError, match="checkpoint"):
+        EW_DES.run_days(sim_df, machine_config, epp, 2, from_day=1)
+    with pytest.raises(ValueError, match="between 0 and days"):
+        EW_DES.run_days(sim_df, machine_config, epp, 2, checkpoints=str(tmp_path), from_day=3)
+
+
+def test_sweep_reads_skipped_cases_from_the_store(settings, tmp_path):
+    simulation_settings, machine_settings, epp = settings
+    spec: dict = {"base": "LAR3B150", "num_chargers": "1:2:1", "charging_power": [50, 150], "engine": "batch"}
+    store = EW_DES.results_store(str(tmp_path/"results"))
+    EW_DES.run_sweep(spec, simulation_settings, machine_settings, epp, output=str(tmp_path/"first"), store=store)
+    EW_DES.run_sweep(spec, simulation_settings, machine_settings, epp, output=str(tmp_path/"again"), store=store, skip_existing=True)
+    first, again = (pd.read_csv(tmp_path/f"{run}_results.csv").sort_values("name", ignore_index=True) for run in ("first", "again"))
+    pd.testing.assert_frame_equal(again[first.columns], first, check_dtype=False, rtol=TOLERANCE)